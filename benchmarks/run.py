@@ -0,0 +1,219 @@
+"""Benchmark the client against the local OneSignal stand-in.
+
+Every scenario is run in every mode and the requests per second,
+latency percentiles and, with ``--memory``, peak memory are written as
+JSON. Pass a previous result with ``--compare`` to fail on regressions::
+
+   python -m benchmarks.run --requests 2000 --output bench.json
+   python -m benchmarks.run --compare bench.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import yaosac
+from benchmarks.server import StandInServer
+
+
+os.environ.setdefault('OS_APP_ID', 'bench-app-id')
+os.environ.setdefault('OS_APP_AUTH_KEY', 'bench-app-key')
+os.environ.setdefault('OS_USER_AUTH_KEY', 'bench-user-key')
+
+PAGE_SIZE = 300
+
+
+def create_notification(client, index, devices):
+    return client.create_notification(
+        'Benchmark', include_player_ids=['device-%d' % index])
+
+
+def view_devices(client, index, devices):
+    offset = index * PAGE_SIZE % devices
+    return client.view_devices(limit=PAGE_SIZE, offset=offset)
+
+
+def increment_session_length(client, index, devices):
+    return client.increment_session_length('device-%d' % index, 10)
+
+
+SCENARIOS = {'create_notification': create_notification,
+             'view_devices': view_devices,
+             'increment_session_length': increment_session_length}
+
+
+def _timed(scenario, client, index, devices):
+    started = time.perf_counter()
+    response = scenario(client, index, devices)
+    return time.perf_counter() - started, response.status_code
+
+
+def run_sync(scenario, url, requests, concurrency, devices):
+    """A request after another, without reusing connections"""
+    client = yaosac.Client()
+    client.OS_URL = url
+    for index in range(requests):
+        yield _timed(scenario, client, index, devices)
+        client.close()
+
+
+def run_pooled(scenario, url, requests, concurrency, devices):
+    """A request after another over the connection pool"""
+    with yaosac.Client() as client:
+        client.OS_URL = url
+        for index in range(requests):
+            yield _timed(scenario, client, index, devices)
+
+
+def run_threaded(scenario, url, requests, concurrency, devices):
+    """`concurrency` threads sharing the connection pool"""
+    with yaosac.Client(pool_maxsize=concurrency) as client:
+        client.OS_URL = url
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            yield from executor.map(_timed, [scenario] * requests,
+                                    [client] * requests, range(requests),
+                                    [devices] * requests)
+
+
+def run_async(scenario, url, requests, concurrency, devices):
+    """`concurrency` coroutines sharing the `AsyncClient` pool"""
+    async def timed(client, semaphore, index):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await scenario(client, index, devices)
+            return time.perf_counter() - started, response.status
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        async with yaosac.AsyncClient(pool_maxsize=concurrency) as client:
+            client.OS_URL = url
+            return await asyncio.gather(*[timed(client, semaphore, index)
+                                          for index in range(requests)])
+    return asyncio.run(run())
+
+
+MODES = {'sync': run_sync,
+         'pooled': run_pooled,
+         'threaded': run_threaded,
+         'async': run_async}
+
+
+def percentile(samples, percent):
+    return samples[max(math.ceil(percent / 100 * len(samples)) - 1, 0)]
+
+
+def benchmark(scenario, mode, url, requests, concurrency, devices,
+              memory=False):
+    """Run a scenario in a mode, returns its result dict"""
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    samples = list(MODES[mode](SCENARIOS[scenario], url, requests,
+                               concurrency, devices))
+    elapsed = time.perf_counter() - started
+    result = {'scenario': scenario, 'mode': mode, 'requests': requests}
+    if memory:
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    latencies = sorted(latency for latency, _ in samples)
+    result.update({
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed,
+        'errors': sum(1 for _, status in samples if status >= 400),
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99)})
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of `results` against `baseline` beyond `tolerance`"""
+    previous = {(result['scenario'], result['mode']): result
+                for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        before = previous.get((result['scenario'], result['mode']))
+        if before is None:
+            continue
+        if (result['requests_per_second']
+                < before['requests_per_second'] * (1 - tolerance)):
+            regressions.append('%(scenario)s/%(mode)s requests per second '
+                               % result + '%.1f -> %.1f' % (
+                                   before['requests_per_second'],
+                                   result['requests_per_second']))
+        if result['p99'] > before['p99'] * (1 + tolerance):
+            regressions.append('%(scenario)s/%(mode)s p99 ' % result
+                               + '%.4f -> %.4f' % (before['p99'],
+                                                   result['p99']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS))
+    parser.add_argument('--mode', action='append', choices=list(MODES))
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added by the server to every response')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--devices', type=int, default=3000)
+    parser.add_argument('--memory', action='store_true',
+                        help='measure peak memory, slows the run down')
+    parser.add_argument('--output', help='file to write the JSON results')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    modes = args.mode or list(MODES)
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        if 'async' in modes and args.mode is None:
+            modes.remove('async')
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'config': {'requests': args.requests,
+                          'concurrency': args.concurrency,
+                          'latency': args.latency,
+                          'error_rate': args.error_rate,
+                          'throttle_rate': args.throttle_rate},
+               'results': []}
+    with StandInServer(latency=args.latency, error_rate=args.error_rate,
+                       throttle_rate=args.throttle_rate,
+                       devices=args.devices) as server:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            for mode in modes:
+                result = benchmark(scenario, mode, server.url, args.requests,
+                                   args.concurrency, args.devices,
+                                   args.memory)
+                results['results'].append(result)
+                print('%(scenario)-26s %(mode)-9s %(requests_per_second)8.1f '
+                      'req/s  p50 %(p50).4fs  p99 %(p99).4fs' % result,
+                      file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
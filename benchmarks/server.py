@@ -0,0 +1,175 @@
+"""A local stand-in for the OneSignal API to benchmark the client.
+
+It answers the end-points used by the benchmarks with canned payloads.
+Latency, server errors and throttling can be injected::
+
+   python -m benchmarks.server --port 8000 --latency 0.02 --throttle-rate 0.1
+"""
+import argparse
+import gzip
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """OneSignal stand-in. `latency` seconds are added to every response,
+    `error_rate` and `throttle_rate` are the ratios of 500 and 429
+    responses. `devices` is the number of players of the app.
+    """
+
+    daemon_threads = True
+    # Concurrent clients open many connections at once
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+                 throttle_rate=0, retry_after=0, devices=1000):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.devices = devices
+        self.requests = 0
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients that gave up waiting, e.g. on a timeout, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        """URL to use as `Client.OS_URL`"""
+        return 'http://%s:%d/api/v1/' % self.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def device(index):
+    return {'id': 'device-%d' % index,
+            'identifier': 'token-%d' % index,
+            'session_count': index % 50,
+            'language': 'en',
+            'timezone': 0,
+            'device_os': '14.1',
+            'device_type': index % 2,
+            'tags': {'level': str(index % 10)},
+            'amount_spent': '%.2f' % (index % 7),
+            'created_at': 1600000000 + index,
+            'last_active': 1700000000 + index,
+            'invalid_identifier': False}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle's
+    # algorithm add a delayed ACK round trip to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        # Compress large responses, like the API does
+        if (len(body) >= 1024
+                and 'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        server = self.server
+        server.requests += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        body = json.loads(body or b'null')
+        if server.latency:
+            time.sleep(server.latency)
+        chance = random.random()
+        if chance < server.throttle_rate:
+            return self.respond(429, {'errors': ['Rate limit exceeded']},
+                                [('Retry-After', str(server.retry_after))])
+        if chance < server.throttle_rate + server.error_rate:
+            return self.respond(500, {'errors': ['Internal server error']})
+
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.split('/api/v1/', 1)[-1].strip('/').split('/')
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if path == ['notifications'] and self.command == 'POST':
+            recipients = len(body.get('include_player_ids') or ())
+            return self.respond(200, {'id': str(uuid.uuid4()),
+                                      'recipients': recipients})
+        if path == ['players'] and self.command == 'GET':
+            limit = int(query.get('limit', 300))
+            offset = int(query.get('offset', 0))
+            players = [device(index) for index in
+                       range(offset, min(offset + limit, server.devices))]
+            return self.respond(200, {'total_count': server.devices,
+                                      'offset': offset, 'limit': limit,
+                                      'players': players})
+        if len(path) == 2 and path[0] == 'players' and self.command == 'GET':
+            return self.respond(200, device(0))
+        if len(path) == 2 and path[0] == 'notifications':
+            if self.command == 'GET':
+                return self.respond(200, {'id': path[1], 'successful': 10,
+                                          'failed': 0, 'remaining': 0})
+            return self.respond(200, {'success': True})
+        if len(path) == 3 and path[0] == 'players':
+            return self.respond(200, {'success': True})
+        return self.respond(404, {'errors': ['Not found']})
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=float, default=0)
+    parser.add_argument('--devices', type=int, default=1000)
+    args = parser.parse_args(argv)
+    server = StandInServer((args.host, args.port), args.latency,
+                           args.error_rate, args.throttle_rate,
+                           args.retry_after, args.devices)
+    print('Serving on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
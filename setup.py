@@ -13,6 +13,8 @@ setup(
     py_modules=['yaosac', ],
     include_package_data=True,
     install_requires=['requests', ],
+    extras_require={'async': ['aiohttp', ]},
+    entry_points={'console_scripts': ['yaosac = yaosac:main', ]},
     license='GNU Library or Lesser General Public License (LGPL)',
     description="Yet another OneSignal API Client",
     long_description=README,
@@ -1,9 +1,22 @@
+import asyncio
+import email.utils
+import gzip
+import io
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import uuid
 from unittest import mock
 
 import requests
 import yaosac
+from benchmarks import run as benchmarks
+from benchmarks.server import StandInServer
 
 
 APP_AUTH_KEY = 'app-test-key'
@@ -97,7 +110,7 @@ class ClientInternalTestCase(unittest.TestCase):
         expected_url = yaosac.client.OS_URL + url
         method = 'put'
 
-        with mock.patch('requests.' + method) as mock_method:
+        with mock.patch.object(yaosac.client.session, method) as mock_method:
             with mock.patch('yaosac.Client._get_headers') as mock_get_headers:
                 mock_headers = {'mock': 'headers'}
                 mock_get_headers.return_value = mock_headers
@@ -125,17 +138,38 @@ class ClientInternalTestCase(unittest.TestCase):
                     expected_url, json=None, headers=mock_headers)
                 mock_get_headers.assert_called_once_with(auth)
 
+    def test_session_is_pooled_and_reused(self):
+        client = yaosac.Client(pool_connections=2, pool_maxsize=5,
+                               pool_block=True)
+        session = client.session
+
+        self.assertIs(client.session, session)
+        adapter = session.get_adapter(client.OS_URL)
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertTrue(adapter._pool_block)
+
+    def test_close__context_manager(self):
+        with yaosac.Client() as client:
+            session = client.session
+            session.close = mock.Mock()
+
+        session.close.assert_called_once_with()
+        self.assertIsNone(client.transport._session)
+        self.assertIsNot(client.session, session)
+
 
 class ClientAPIMEthodsTestCase(unittest.TestCase):
     def setUp(self):
-        requests.get = mock.Mock()
-        requests.post = mock.Mock()
-        requests.put = mock.Mock()
-        requests.delete = mock.Mock()
-        requests.get.return_value = not None
-        requests.post.return_value = not None
-        requests.put.return_value = not None
-        requests.delete.return_value = not None
+        self.session = mock.Mock()
+        self.session.get.return_value = not None
+        self.session.post.return_value = not None
+        self.session.put.return_value = not None
+        self.session.delete.return_value = not None
+        yaosac.client.transport._session = self.session
+
+    def tearDown(self):
+        yaosac.client.transport._session = None
 
     #
     # end-points tests
@@ -151,12 +185,12 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
 
         response = yaosac.client.create_notification(contents, **kwargs)
 
-        self.assertEqual(requests.post.call_count, 1)
-        self.assertIn('app_id', requests.post.call_args[1]['json'])
-        self.assertIn('contents', requests.post.call_args[1]['json'])
-        self.assertIn('what', requests.post.call_args[1]['json'])
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertIn('app_id', self.session.post.call_args[1]['json'])
+        self.assertIn('contents', self.session.post.call_args[1]['json'])
+        self.assertIn('what', self.session.post.call_args[1]['json'])
         self.assertIn(APP_AUTH_KEY,
-                      requests.post.call_args[1]['headers']['Authorization'])
+                      self.session.post.call_args[1]['headers']['Authorization'])
         self.assertIsNotNone(response)
 
     def test_create_notification__with__template_id(self):
@@ -165,8 +199,8 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
         response = yaosac.client.create_notification(template_id='an-id',
                                                      **kwargs)
 
-        self.assertNotIn('contents', requests.post.call_args[1]['json'])
-        self.assertIn('template_id', requests.post.call_args[1]['json'])
+        self.assertNotIn('contents', self.session.post.call_args[1]['json'])
+        self.assertIn('template_id', self.session.post.call_args[1]['json'])
 
     def test_create_notification__with__template_id__is__empty_string(self):
         kwargs = {'what': 'ever'}
@@ -174,8 +208,8 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
         response = yaosac.client.create_notification(
             contents='text', template_id='', **kwargs)
 
-        self.assertIn('contents', requests.post.call_args[1]['json'])
-        self.assertNotIn('template_id', requests.post.call_args[1]['json'])
+        self.assertIn('contents', self.session.post.call_args[1]['json'])
+        self.assertNotIn('template_id', self.session.post.call_args[1]['json'])
 
     def test_create_notification__without__contents_or_template_id(self):
         kwargs = {'what': 'ever'}
@@ -191,9 +225,9 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
 
         response = yaosac.client.create_notification(contents, **kwargs)
 
-        self.assertIn('en', requests.post.call_args[1]['json']['contents'])
+        self.assertIn('en', self.session.post.call_args[1]['json']['contents'])
         self.assertIn(contents,
-                      requests.post.call_args[1]['json']['contents']['en'])
+                      self.session.post.call_args[1]['json']['contents']['en'])
 
 
     def test_cancel_notification(self):
@@ -201,135 +235,135 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
 
         response = yaosac.client.cancel_notification(notification_id)
 
-        self.assertEqual(requests.delete.call_count, 1)
-        self.assertIn(notification_id, requests.delete.call_args[0][0])
-        self.assertIn(APP_ID, requests.delete.call_args[0][0])
-        self.assertIn('headers', requests.delete.call_args[1])
+        self.assertEqual(self.session.delete.call_count, 1)
+        self.assertIn(notification_id, self.session.delete.call_args[0][0])
+        self.assertIn(APP_ID, self.session.delete.call_args[0][0])
+        self.assertIn('headers', self.session.delete.call_args[1])
         self.assertIn(APP_AUTH_KEY,
-                      requests.delete.call_args[1]['headers']['Authorization'])
+                      self.session.delete.call_args[1]['headers']['Authorization'])
         self.assertIsNotNone(response)
 
     def test_view_apps(self):
         response = yaosac.client.view_apps()
 
-        self.assertIn('apps', requests.get.call_args[0][0])
+        self.assertIn('apps', self.session.get.call_args[0][0])
         self.assertIn(USER_AUTH_KEY,
-                      requests.get.call_args[1]['headers']['Authorization'])
+                      self.session.get.call_args[1]['headers']['Authorization'])
         self.assertIsNotNone(response)
 
     def test_view_an_app(self):
         app_id = 'an-id'
         response = yaosac.client.view_an_app(app_id)
 
-        self.assertIn('apps', requests.get.call_args[0][0])
-        self.assertIn(app_id, requests.get.call_args[0][0])
+        self.assertIn('apps', self.session.get.call_args[0][0])
+        self.assertIn(app_id, self.session.get.call_args[0][0])
         self.assertIn(USER_AUTH_KEY,
-                      requests.get.call_args[1]['headers']['Authorization'])
+                      self.session.get.call_args[1]['headers']['Authorization'])
         self.assertIsNotNone(response)
 
     def test_create_an_app(self):
         payload = {'what': 'ever'}
         response = yaosac.client.create_an_app(**payload)
 
-        self.assertIn('apps', requests.post.call_args[0][0])
-        self.assertEqual(payload, requests.post.call_args[1]['json'])
+        self.assertIn('apps', self.session.post.call_args[0][0])
+        self.assertEqual(payload, self.session.post.call_args[1]['json'])
         self.assertIn(USER_AUTH_KEY,
-                      requests.post.call_args[1]['headers']['Authorization'])
+                      self.session.post.call_args[1]['headers']['Authorization'])
 
     def test_update_an_app(self):
         payload = {'what': 'ever'}
         response = yaosac.client.update_an_app(**payload)
 
-        self.assertIn(APP_ID, requests.put.call_args[0][0])
-        self.assertIn('apps', requests.put.call_args[0][0])
-        self.assertEqual(payload, requests.put.call_args[1]['json'])
+        self.assertIn(APP_ID, self.session.put.call_args[0][0])
+        self.assertIn('apps', self.session.put.call_args[0][0])
+        self.assertEqual(payload, self.session.put.call_args[1]['json'])
         self.assertIn(USER_AUTH_KEY,
-                      requests.put.call_args[1]['headers']['Authorization'])
+                      self.session.put.call_args[1]['headers']['Authorization'])
 
     def test_view_devices(self):
         response = yaosac.client.view_devices()
 
-        self.assertIn('players', requests.get.call_args[0][0])
-        self.assertIn('app_id=', requests.get.call_args[0][0])
-        self.assertIn(APP_ID, requests.get.call_args[0][0])
+        self.assertIn('players', self.session.get.call_args[0][0])
+        self.assertIn('app_id=', self.session.get.call_args[0][0])
+        self.assertIn(APP_ID, self.session.get.call_args[0][0])
         self.assertIn(APP_AUTH_KEY,
-                      requests.get.call_args[1]['headers']['Authorization'])
+                      self.session.get.call_args[1]['headers']['Authorization'])
 
         # with limit
-        requests.get.reset_mock()
+        self.session.get.reset_mock()
         limit = 69
         response = yaosac.client.view_devices(limit=limit)
 
-        self.assertIn('limit=', requests.get.call_args[0][0])
-        self.assertIn(str(limit), requests.get.call_args[0][0])
+        self.assertIn('limit=', self.session.get.call_args[0][0])
+        self.assertIn(str(limit), self.session.get.call_args[0][0])
 
         # with offset
-        requests.get.reset_mock()
+        self.session.get.reset_mock()
         offset = 420
         response = yaosac.client.view_devices(offset=offset)
 
-        self.assertIn('offset=', requests.get.call_args[0][0])
-        self.assertIn(str(offset), requests.get.call_args[0][0])
+        self.assertIn('offset=', self.session.get.call_args[0][0])
+        self.assertIn(str(offset), self.session.get.call_args[0][0])
 
     def test_view_device(self):
         device_id = 'my-phone'
         response = yaosac.client.view_device(device_id)
 
-        self.assertIn('players', requests.get.call_args[0][0])
-        self.assertIn(device_id, requests.get.call_args[0][0])
-        self.assertIn('app_id=', requests.get.call_args[0][0])
-        self.assertIn(APP_ID, requests.get.call_args[0][0])
-        self.assertNotIn('Authorization', requests.get.call_args[1]['headers'])
+        self.assertIn('players', self.session.get.call_args[0][0])
+        self.assertIn(device_id, self.session.get.call_args[0][0])
+        self.assertIn('app_id=', self.session.get.call_args[0][0])
+        self.assertIn(APP_ID, self.session.get.call_args[0][0])
+        self.assertNotIn('Authorization', self.session.get.call_args[1]['headers'])
 
     def test_add_a_device(self):
         payload = {'read': 'the', 'docs': 1}
         response = yaosac.client.add_a_device(**payload)
 
-        self.assertIn('players', requests.post.call_args[0][0])
-        self.assertIn('app_id', requests.post.call_args[1]['json'])
+        self.assertIn('players', self.session.post.call_args[0][0])
+        self.assertIn('app_id', self.session.post.call_args[1]['json'])
         self.assertEqual(APP_ID,
-                         requests.post.call_args[1]['json']['app_id'])
+                         self.session.post.call_args[1]['json']['app_id'])
         for key, value in payload.items():
-            self.assertIn(key, requests.post.call_args[1]['json'])
-            self.assertEqual(value, requests.post.call_args[1]['json'][key])
-        self.assertNotIn('Authorization', requests.post.call_args[1]['headers'])
+            self.assertIn(key, self.session.post.call_args[1]['json'])
+            self.assertEqual(value, self.session.post.call_args[1]['json'][key])
+        self.assertNotIn('Authorization', self.session.post.call_args[1]['headers'])
 
     def test_edit_device(self):
         device_id = 'my-phone'
         payload = {'read': 'the', 'docs': 1}
         response = yaosac.client.edit_device(device_id, **payload)
 
-        self.assertIn('players', requests.put.call_args[0][0])
-        self.assertIn(device_id, requests.put.call_args[0][0])
-        self.assertIn('app_id', requests.put.call_args[1]['json'])
+        self.assertIn('players', self.session.put.call_args[0][0])
+        self.assertIn(device_id, self.session.put.call_args[0][0])
+        self.assertIn('app_id', self.session.put.call_args[1]['json'])
         self.assertEqual(APP_ID,
-                         requests.put.call_args[1]['json']['app_id'])
+                         self.session.put.call_args[1]['json']['app_id'])
         for key, value in payload.items():
-            self.assertIn(key, requests.put.call_args[1]['json'])
-            self.assertEqual(value, requests.put.call_args[1]['json'][key])
-        self.assertNotIn('Authorization', requests.put.call_args[1]['headers'])
+            self.assertIn(key, self.session.put.call_args[1]['json'])
+            self.assertEqual(value, self.session.put.call_args[1]['json'][key])
+        self.assertNotIn('Authorization', self.session.put.call_args[1]['headers'])
 
     def test_edit_device(self):
         device_id = 'my-phone'
         payload = {'read': 'the', 'docs': 1}
         response = yaosac.client.new_session(device_id, **payload)
 
-        self.assertIn('players', requests.post.call_args[0][0])
-        self.assertIn('on_session', requests.post.call_args[0][0])
-        self.assertIn(device_id, requests.post.call_args[0][0])
-        self.assertEqual(payload, requests.post.call_args[1]['json'])
-        self.assertNotIn('Authorization', requests.post.call_args[1]['headers'])
+        self.assertIn('players', self.session.post.call_args[0][0])
+        self.assertIn('on_session', self.session.post.call_args[0][0])
+        self.assertIn(device_id, self.session.post.call_args[0][0])
+        self.assertEqual(payload, self.session.post.call_args[1]['json'])
+        self.assertNotIn('Authorization', self.session.post.call_args[1]['headers'])
 
     def test_new_purchase(self):
         device_id = 'my-phone'
         payload = {'read': 'the', 'docs': 1}
         response = yaosac.client.new_purchase(device_id, **payload)
 
-        self.assertIn('players', requests.post.call_args[0][0])
-        self.assertIn('on_purchase', requests.post.call_args[0][0])
-        self.assertIn(device_id, requests.post.call_args[0][0])
-        self.assertEqual(payload, requests.post.call_args[1]['json'])
-        self.assertNotIn('Authorization', requests.post.call_args[1]['headers'])
+        self.assertIn('players', self.session.post.call_args[0][0])
+        self.assertIn('on_purchase', self.session.post.call_args[0][0])
+        self.assertIn(device_id, self.session.post.call_args[0][0])
+        self.assertEqual(payload, self.session.post.call_args[1]['json'])
+        self.assertNotIn('Authorization', self.session.post.call_args[1]['headers'])
 
     def test_increment_session_length(self):
         device_id = 'my-phone'
@@ -338,54 +372,64 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
 
         response = yaosac.client.increment_session_length(device_id, active_time)
 
-        self.assertIn('players', requests.post.call_args[0][0])
-        self.assertIn('on_focus', requests.post.call_args[0][0])
-        self.assertIn(device_id, requests.post.call_args[0][0])
-        self.assertEqual(expected_payload, requests.post.call_args[1]['json'])
-        self.assertNotIn('Authorization', requests.post.call_args[1]['headers'])
+        self.assertIn('players', self.session.post.call_args[0][0])
+        self.assertIn('on_focus', self.session.post.call_args[0][0])
+        self.assertIn(device_id, self.session.post.call_args[0][0])
+        self.assertEqual(expected_payload, self.session.post.call_args[1]['json'])
+        self.assertNotIn('Authorization', self.session.post.call_args[1]['headers'])
 
     def test_csv_export(self):
         response = yaosac.client.csv_export()
 
-        self.assertIn('players', requests.post.call_args[0][0])
-        self.assertIn('csv_export', requests.post.call_args[0][0])
-        self.assertIn('app_id=', requests.post.call_args[0][0])
-        self.assertIn(APP_ID, requests.post.call_args[0][0])
+        self.assertIn('players', self.session.post.call_args[0][0])
+        self.assertIn('csv_export', self.session.post.call_args[0][0])
+        self.assertIn('app_id=', self.session.post.call_args[0][0])
+        self.assertIn(APP_ID, self.session.post.call_args[0][0])
         self.assertIn(APP_AUTH_KEY,
-                      requests.post.call_args[1]['headers']['Authorization'])
+                      self.session.post.call_args[1]['headers']['Authorization'])
 
 
         # Extra fields
         # location
-        requests.post.reset_mock()
+        self.session.post.reset_mock()
         response = yaosac.client.csv_export(location=True)
 
         self.assertIn('location',
-                      requests.post.call_args[1]['json']['extra_fields'])
+                      self.session.post.call_args[1]['json']['extra_fields'])
         # country
-        requests.post.reset_mock()
+        self.session.post.reset_mock()
         response = yaosac.client.csv_export(country=True)
 
         self.assertIn('country',
-                      requests.post.call_args[1]['json']['extra_fields'])
+                      self.session.post.call_args[1]['json']['extra_fields'])
 
         # rooted
-        requests.post.reset_mock()
+        self.session.post.reset_mock()
         response = yaosac.client.csv_export(rooted=True)
 
         self.assertIn('rooted',
-                      requests.post.call_args[1]['json']['extra_fields'])
+                      self.session.post.call_args[1]['json']['extra_fields'])
+
+        # Filters
+        self.session.post.reset_mock()
+        response = yaosac.client.csv_export(last_active_since=1469392779.5,
+                                            segment_name='Active Users')
+
+        self.assertEqual(self.session.post.call_args[1]['json'],
+                         {'extra_fields': [],
+                          'last_active_since': '1469392779',
+                          'segment_name': 'Active Users'})
 
     def test_view_notification(self):
         notification_id = 'an-push'
         response = yaosac.client.view_notification(notification_id)
 
-        self.assertIn('notifications', requests.get.call_args[0][0])
-        self.assertIn(notification_id, requests.get.call_args[0][0])
-        self.assertIn('app_id=', requests.get.call_args[0][0])
-        self.assertIn(APP_ID, requests.get.call_args[0][0])
+        self.assertIn('notifications', self.session.get.call_args[0][0])
+        self.assertIn(notification_id, self.session.get.call_args[0][0])
+        self.assertIn('app_id=', self.session.get.call_args[0][0])
+        self.assertIn(APP_ID, self.session.get.call_args[0][0])
         self.assertIn(APP_AUTH_KEY,
-                      requests.get.call_args[1]['headers']['Authorization'])
+                      self.session.get.call_args[1]['headers']['Authorization'])
 
         # Raise exception when notification_id is False
         notification_id = ''
@@ -395,36 +439,2157 @@ class ClientAPIMEthodsTestCase(unittest.TestCase):
     def test_view_notifications(self):
         response = yaosac.client.view_notifications()
 
-        self.assertIn('notifications', requests.get.call_args[0][0])
-        self.assertIn('app_id=', requests.get.call_args[0][0])
-        self.assertIn(APP_ID, requests.get.call_args[0][0])
+        self.assertIn('notifications', self.session.get.call_args[0][0])
+        self.assertIn('app_id=', self.session.get.call_args[0][0])
+        self.assertIn(APP_ID, self.session.get.call_args[0][0])
         self.assertIn(APP_AUTH_KEY,
-                      requests.get.call_args[1]['headers']['Authorization'])
+                      self.session.get.call_args[1]['headers']['Authorization'])
 
         # with limit
-        requests.get.reset_mock()
+        self.session.get.reset_mock()
         limit = 69
         response = yaosac.client.view_notifications(limit=limit)
 
-        self.assertIn('limit=', requests.get.call_args[0][0])
-        self.assertIn(str(limit), requests.get.call_args[0][0])
+        self.assertIn('limit=', self.session.get.call_args[0][0])
+        self.assertIn(str(limit), self.session.get.call_args[0][0])
 
         # with offset
-        requests.get.reset_mock()
+        self.session.get.reset_mock()
         offset = 420
         response = yaosac.client.view_notifications(offset=offset)
 
-        self.assertIn('offset=', requests.get.call_args[0][0])
-        self.assertIn(str(offset), requests.get.call_args[0][0])
+        self.assertIn('offset=', self.session.get.call_args[0][0])
+        self.assertIn(str(offset), self.session.get.call_args[0][0])
 
     def test_track_open(self):
         notification_id = 'a-push'
         response = yaosac.client.track_open(notification_id)
 
-        self.assertIn('notifications', requests.put.call_args[0][0])
-        self.assertIn(notification_id, requests.put.call_args[0][0])
-        self.assertIn('app_id', requests.put.call_args[1]['json'])
-        self.assertIn(APP_ID, requests.put.call_args[1]['json']['app_id'])
-        self.assertIn('opened', requests.put.call_args[1]['json'])
-        self.assertTrue(requests.put.call_args[1]['json']['opened'])
-        self.assertNotIn('Authorization', requests.put.call_args[1]['headers'])
+        self.assertIn('notifications', self.session.put.call_args[0][0])
+        self.assertIn(notification_id, self.session.put.call_args[0][0])
+        self.assertIn('app_id', self.session.put.call_args[1]['json'])
+        self.assertIn(APP_ID, self.session.put.call_args[1]['json']['app_id'])
+        self.assertIn('opened', self.session.put.call_args[1]['json'])
+        self.assertTrue(self.session.put.call_args[1]['json']['opened'])
+        self.assertNotIn('Authorization', self.session.put.call_args[1]['headers'])
+
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = yaosac.Client()
+        self.client.transport._session = self.session = mock.Mock()
+
+    def test_create_notifications_bulk(self):
+        ids = ('id-%d' % i for i in range(5))
+
+        result = self.client.create_notifications_bulk(
+            ids, 'Bla', batch_size=2, max_workers=2, what='ever')
+
+        self.assertEqual(self.session.post.call_count, 3)
+        sent = sorted(json.loads(call[1]['data'])['include_player_ids']
+                      for call in self.session.post.call_args_list)
+        self.assertEqual(sent, [['id-0', 'id-1'], ['id-2', 'id-3'],
+                                ['id-4']])
+        payload = json.loads(self.session.post.call_args[1]['data'])
+        self.assertEqual(payload['contents'], {'en': 'Bla'})
+        self.assertEqual(payload['what'], 'ever')
+        self.assertEqual([batch for batch, _ in result.responses],
+                         [['id-0', 'id-1'], ['id-2', 'id-3'], ['id-4']])
+        self.assertEqual(result.failures, [])
+
+    def test_create_notifications_bulk__failures(self):
+        error = ConnectionError('boom')
+
+        def post(url, data, headers):
+            if 'b' in json.loads(data)['include_external_user_ids']:
+                raise error
+            return 'ok'
+        self.session.post.side_effect = post
+
+        result = self.client.create_notifications_bulk(
+            'abc', template_id='an-id', batch_size=1,
+            recipient_field='include_external_user_ids')
+
+        self.assertEqual(result.responses, [(['a'], 'ok'), (['c'], 'ok')])
+        self.assertEqual(result.failures, [(['b'], error)])
+
+    def test_create_notifications_bulk__call_options(self):
+        with yaosac.call_options(timeout=3):
+            self.client.create_notifications_bulk(range(4), 'Bla',
+                                                  batch_size=1)
+        with yaosac.call_options(deadline=0):
+            result = self.client.create_notifications_bulk(range(2), 'Bla',
+                                                           batch_size=1)
+
+        self.assertEqual([call[1]['timeout'] for call
+                          in self.session.post.call_args_list], [3] * 4)
+        self.assertEqual([type(error) for _, error in result.failures],
+                         [TimeoutError] * 2)
+
+    def test_create_notifications_bulk__external_id(self):
+        self.client.create_notifications_bulk(
+            range(3), 'Bla', batch_size=1, external_id='a-job')
+        self.client.create_notifications_bulk(
+            range(3), 'Bla', batch_size=1, external_id='a-job')
+
+        keys = [json.loads(call[1]['data'])['external_id']
+                for call in self.session.post.call_args_list]
+        self.assertEqual(len(set(keys)), 3)
+        self.assertNotIn('a-job', keys)
+
+    def test_create_notifications_bulk__validates_once(self):
+        with self.assertRaises(AssertionError):
+            self.client.create_notifications_bulk(['an-id'])
+        self.assertFalse(self.session.post.called)
+
+
+class NotificationTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = yaosac.Client()
+        self.client.transport._session = self.session = mock.Mock()
+
+    def test_render(self):
+        template = yaosac.NotificationTemplate({'app_id': 'an-app',
+                                                'contents': {'en': 'Ñu'}})
+
+        self.assertEqual(json.loads(template.render()),
+                         {'app_id': 'an-app', 'contents': {'en': 'Ñu'}})
+        self.assertEqual(json.loads(template.render(include_player_ids=['a'],
+                                                    data={'b': 1})),
+                         {'app_id': 'an-app', 'contents': {'en': 'Ñu'},
+                          'include_player_ids': ['a'], 'data': {'b': 1}})
+        # Replaced fields
+        self.assertEqual(json.loads(template.render(app_id='other')),
+                         {'app_id': 'other', 'contents': {'en': 'Ñu'}})
+        self.assertEqual(json.loads(yaosac.NotificationTemplate({}).render(
+            a=1)), {'a': 1})
+
+    def test_stdlib_json_dumps(self):
+        template = yaosac.NotificationTemplate(
+            {'contents': {'en': 'Ñu'}}, yaosac._stdlib_json_dumps)
+
+        self.assertEqual(template.render(a=[1, 2]),
+                         '{"contents":{"en":"Ñu"},"a":[1,2]}'.encode())
+
+    def test_send_notification_template(self):
+        template = self.client.compile_notification('Bla', what='ever')
+
+        self.client.send_notification_template(template,
+                                               include_player_ids=['a'])
+
+        url, = self.session.post.call_args[0]
+        kwargs = self.session.post.call_args[1]
+        self.assertTrue(url.endswith('/notifications'))
+        self.assertEqual(json.loads(kwargs['data']), {
+            'app_id': APP_ID, 'contents': {'en': 'Bla'}, 'what': 'ever',
+            'include_player_ids': ['a']})
+        self.assertIn(APP_AUTH_KEY, kwargs['headers']['Authorization'])
+        self.assertEqual(kwargs['headers']['Content-Type'],
+                         'application/json')
+
+    def test_pluggable_encoder(self):
+        dumps = mock.Mock(return_value=b'{}')
+        client = yaosac.Client(json_dumps=dumps)
+
+        template = client.compile_notification('Bla')
+
+        self.assertIs(template.dumps, dumps)
+        dumps.assert_called_once_with({'app_id': APP_ID,
+                                       'contents': {'en': 'Bla'}})
+
+    def test_idempotency_key_per_send(self):
+        self.client.retry_policy = yaosac.RetryPolicy()
+        template = self.client.compile_notification('Bla')
+
+        self.client.send_notification_template(template)
+        self.client.send_notification_template(template)
+
+        keys = {json.loads(call[1]['data'])['external_id']
+                for call in self.session.post.call_args_list}
+        self.assertEqual(len(keys), 2)
+
+        template = self.client.compile_notification('Bla', external_id='k')
+        self.client.send_notification_template(template)
+        self.assertEqual(
+            json.loads(self.session.post.call_args[1]['data'])['external_id'],
+            'k')
+
+
+class PaginationTestCase(unittest.TestCase):
+    total = 7
+
+    def setUp(self):
+        self.client = yaosac.Client()
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.get.side_effect = self.get
+
+    def get(self, url, json, headers, timeout=None):
+        query = url.split('?')[1].split('&')
+        query = dict(param.split('=') for param in query)
+        limit, offset = int(query['limit']), int(query['offset'])
+        key = 'players' if 'players' in url else 'notifications'
+        response = mock.Mock()
+        response.json.return_value = {
+            'total_count': self.total, 'offset': offset, 'limit': limit,
+            key: list(range(offset, min(offset + limit, self.total)))}
+        return response
+
+    def test_iter_devices(self):
+        result = list(self.client.iter_devices(page_size=3))
+
+        self.assertEqual(result, list(range(self.total)))
+        self.assertEqual(self.session.get.call_count, 3)
+
+    def test_iter_devices__without_prefetch_is_lazy(self):
+        devices = self.client.iter_devices(page_size=3, prefetch=False)
+
+        self.assertEqual([next(devices) for _ in range(3)], [0, 1, 2])
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(list(devices), [3, 4, 5, 6])
+
+    def test_iter_notifications__concurrently(self):
+        result = list(self.client.iter_notifications(page_size=2,
+                                                     max_workers=3))
+
+        self.assertEqual(result, list(range(self.total)))
+        self.assertEqual(self.session.get.call_count, 4)
+        self.assertIn('notifications', self.session.get.call_args[0][0])
+
+    def test_prefetched_pages_keep_the_call_options(self):
+        with yaosac.call_options(timeout=3):
+            result = list(self.client.iter_devices(page_size=2,
+                                                   max_workers=3))
+
+        self.assertEqual(result, list(range(self.total)))
+        self.assertEqual([call[1]['timeout'] for call
+                          in self.session.get.call_args_list], [3] * 4)
+
+    def test_iter_pages__without_total_count(self):
+        def get(url, json, headers):
+            response = self.get(url, json, headers)
+            del response.json.return_value['total_count']
+            return response
+        self.session.get.side_effect = get
+
+        result = list(self.client.iter_devices(page_size=3, max_workers=2))
+
+        self.assertEqual(result, list(range(self.total)))
+
+    def test_iter_pages__raises_http_errors(self):
+        self.session.get.side_effect = None
+        response = self.session.get.return_value
+        response.raise_for_status.side_effect = requests.HTTPError()
+
+        with self.assertRaises(requests.HTTPError):
+            list(self.client.iter_devices())
+
+
+class DeviceTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.devices = [
+            {'id': 'device-%s' % index, 'session_count': index,
+             'last_active': 1000 + index, 'created_at': 900,
+             'playtime': index * 10, 'device_type': index % 2,
+             'invalid_identifier': False, 'amount_spent': '%s.5' % index,
+             'tags': {'plan': 'pro' if index % 3 == 0 else 'free'},
+             'language': 'es' if index < 5 else 'en',
+             'identifier': 'token-%s' % index}
+            for index in range(10)]
+        self.devices[9]['tags'] = {}
+        self.devices[8]['language'] = None
+        self.table = yaosac.DeviceTable(self.devices)
+
+    def test_rows(self):
+        self.assertEqual(len(self.table), 10)
+        device = dict(self.devices[3], amount_spent=3.5,
+                      invalid_identifier=0)
+        del device['identifier']
+        self.assertEqual(self.table[3], device)
+        self.assertEqual(list(self.table)[-1]['tags'], {})
+        self.assertEqual(len(self.table._values['tags']), 3)
+
+        table = yaosac.DeviceTable(self.devices,
+                                   fields=('language', 'identifier'))
+        self.assertEqual(table[3]['identifier'], 'token-3')
+
+    def test_columns(self):
+        self.assertEqual(self.table.column('session_count').tolist(),
+                         list(range(10)))
+        self.assertEqual(self.table.column('language'),
+                         ['es'] * 5 + ['en'] * 3 + [None, 'en'])
+        with self.assertRaises(ValueError):
+            self.table.column('identifier')
+
+    def test_filter(self):
+        self.assertEqual(self.table.count(), 10)
+        self.assertEqual(self.table.count(last_active__gte=1005), 5)
+        self.assertEqual(self.table.count(amount_spent__lt=2), 2)
+        self.assertEqual(self.table.count(language='es'), 5)
+        self.assertEqual(self.table.count(language__gt='e'), 9)
+        self.assertEqual([device['id'] for device in self.table.filter(
+            tags={'plan': 'pro'}, session_count__gt=0)],
+            ['device-3', 'device-6'])
+        self.assertEqual(self.table.count(tags={'plan': None}), 9)
+        self.assertEqual(self.table.mask(device_type=1, language='en'),
+                         b'\x00' * 5 + b'\x01\x00\x01\x00\x01')
+        with self.assertRaises(ValueError):
+            self.table.count(identifier='token-1')
+
+    def test_device_table(self):
+        client = yaosac.Client()
+        client.iter_devices = mock.Mock(return_value=iter(self.devices))
+
+        table = client.device_table(page_size=100, max_workers=4)
+
+        client.iter_devices.assert_called_once_with(100, True, 4)
+        self.assertEqual(table.ids, self.table.ids)
+
+
+class DeviceMirrorTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'devices.db')
+        self.client = mock.Mock()
+        self.client.iter_csv_export.side_effect = lambda *args, **kwargs: (
+            iter(self.rows))
+        self.rows = [
+            {'id': 'a', 'last_active': '2020-01-01 00:00:00',
+             'tags': '{"plan": "pro", "level": 3}', 'language': 'es'},
+            {'id': 'b', 'last_active': '2020-01-08 00:00:00',
+             'tags': '{"plan": "free"}', 'language': 'en'},
+            {'id': 'c', 'last_active': '1578441600', 'tags': '',
+             'language': 'en'}]
+        self.mirror = yaosac.DeviceMirror(self.path, self.client)
+
+    def tearDown(self):
+        self.mirror.close()
+
+    def ids(self, devices):
+        return [device['id'] for device in devices]
+
+    def test_queries(self):
+        self.assertEqual(self.mirror.sync(batch_size=2), 3)
+
+        self.assertEqual(len(self.mirror), 3)
+        self.assertEqual(self.mirror.get('a'),
+                         {'id': 'a', 'last_active': 1577836800,
+                          'tags': {'plan': 'pro', 'level': 3},
+                          'language': 'es'})
+        self.assertIsNone(self.mirror.get('d'))
+        self.assertEqual(self.ids(self.mirror.devices(tags={'plan': None})),
+                         ['a', 'b'])
+        self.assertEqual(self.ids(self.mirror.devices(
+            tags={'plan': 'pro', 'level': 3})), ['a'])
+        self.assertEqual(self.ids(self.mirror.devices(
+            active_since=1578441600)), ['b', 'c'])
+        self.assertEqual(self.mirror.count(tags={'plan': 'free'},
+                                           active_since=1578441600), 1)
+        self.assertEqual(self.ids(self.mirror.devices(limit=1)), ['a'])
+
+    def test_delta_sync(self):
+        self.mirror.sync()
+        synced_at = self.mirror.synced_at
+        self.client.iter_csv_export.assert_called_once_with(5, 600)
+        self.rows = [{'id': 'a', 'last_active': '2020-02-01 00:00:00',
+                      'tags': '{"plan": "free"}'},
+                     {'id': 'd', 'last_active': '2020-02-01 00:00:00',
+                      'tags': '{}'}]
+        self.mirror.close()
+
+        self.mirror = yaosac.DeviceMirror(self.path, self.client)
+        self.assertEqual(self.mirror.sync(), 2)
+
+        self.client.iter_csv_export.assert_called_with(
+            5, 600, last_active_since=synced_at - 3600)
+        self.assertGreaterEqual(self.mirror.synced_at, synced_at)
+        self.assertEqual(len(self.mirror), 4)
+        self.assertEqual(self.mirror.count(tags={'plan': 'free'}), 2)
+        self.assertEqual(self.mirror.count(tags={'level': None}), 0)
+
+    def test_full_sync(self):
+        self.mirror.sync()
+        self.rows = self.rows[1:]
+
+        self.mirror.sync(full=True)
+
+        self.client.iter_csv_export.assert_called_with(5, 600)
+        self.assertEqual(len(self.mirror), 2)
+        self.assertEqual(self.mirror.count(tags={'plan': 'pro'}), 0)
+
+    def test_failed_full_sync_keeps_the_copy(self):
+        self.mirror.sync()
+        synced_at = self.mirror.synced_at
+
+        def rows(*args, **kwargs):
+            yield from self.rows[:2]
+            raise requests.ConnectionError()
+        self.client.iter_csv_export.side_effect = rows
+
+        with self.assertRaises(requests.ConnectionError):
+            self.mirror.sync(full=True, batch_size=1)
+
+        self.assertEqual(len(self.mirror), 3)
+        self.assertEqual(self.mirror.count(tags={'plan': None}), 2)
+        self.assertEqual(self.mirror.synced_at, synced_at)
+
+        self.client.iter_csv_export.side_effect = lambda *args, **kwargs: (
+            iter(self.rows[2:]))
+        self.assertEqual(self.mirror.sync(full=True), 1)
+        self.assertEqual(self.ids(self.mirror.devices()), ['c'])
+
+
+@mock.patch('time.sleep')
+class CSVExportTestCase(unittest.TestCase):
+    csv = (b'id,identifier,session_count,country\r\n'
+           b'a,token-a,2,ES\r\n'
+           b'b,token-b,5,CL\r\n')
+    url = 'https://example.com/export.csv.gz'
+
+    def setUp(self):
+        self.client = yaosac.Client()
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.post.return_value.json.return_value = {
+            'csv_file_url': self.url}
+        not_ready = mock.Mock(status_code=404)
+        ready = mock.MagicMock(status_code=200,
+                               raw=io.BytesIO(gzip.compress(self.csv)))
+        ready.__enter__.return_value = ready
+        ready.iter_content.side_effect = lambda size: iter(
+            lambda: ready.raw.read(size), b'')
+        self.session.get.side_effect = [not_ready, ready]
+
+    def test_iter_csv_export(self, mock_sleep):
+        rows = list(self.client.iter_csv_export(poll_interval=1,
+                                                country=True))
+
+        self.assertEqual(rows, [
+            {'id': 'a', 'identifier': 'token-a', 'session_count': '2',
+             'country': 'ES'},
+            {'id': 'b', 'identifier': 'token-b', 'session_count': '5',
+             'country': 'CL'}])
+        self.assertEqual(self.session.post.call_args[1]['json'],
+                         {'extra_fields': ['country']})
+        self.session.get.assert_called_with(self.url, stream=True)
+        mock_sleep.assert_called_once_with(1)
+
+    def test_download_csv_export(self, mock_sleep):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv.gz')
+
+            result = self.client.download_csv_export(path)
+
+            self.assertEqual(result, path)
+            with gzip.open(path) as export:
+                self.assertEqual(export.read(), self.csv)
+
+    def test_download_csv_export__decompress(self, mock_sleep):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+
+            self.client.download_csv_export(path, decompress=True)
+
+            with open(path, 'rb') as export:
+                self.assertEqual(export.read(), self.csv)
+
+    def test_failed_download_is_closed(self, mock_sleep):
+        failed = mock.Mock(status_code=500)
+        failed.raise_for_status.side_effect = requests.HTTPError()
+        self.session.get.side_effect = [failed]
+
+        with self.assertRaises(requests.HTTPError):
+            list(self.client.iter_csv_export())
+
+        failed.close.assert_called_once_with()
+
+    def test_timeout(self, mock_sleep):
+        self.session.get.side_effect = None
+        self.session.get.return_value.status_code = 404
+
+        with self.assertRaises(TimeoutError):
+            list(self.client.iter_csv_export(poll_interval=0, timeout=0))
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limiter = yaosac.RateLimiter(rate=10, max_concurrency=4)
+
+    def response(self, status_code, headers=None):
+        return mock.Mock(status_code=status_code, headers=headers or {})
+
+    def test_stats(self):
+        self.limiter.acquire('app')
+
+        self.assertEqual(self.limiter.stats(), {'app': {
+            'rate': 10, 'concurrency': 4, 'in_flight': 1,
+            'queue_depth': 0}})
+
+        self.limiter.release('app', self.response(200))
+
+        self.assertEqual(self.limiter.stats()['app']['in_flight'], 0)
+
+    def test_throttled__aimd(self):
+        self.limiter.acquire('user')
+        self.limiter.release('user',
+                             self.response(429, {'Retry-After': '3'}))
+
+        stats = self.limiter.stats()['user']
+        self.assertEqual(stats['rate'], 5)
+        self.assertEqual(stats['concurrency'], 2)
+        bucket = self.limiter._buckets['user']
+        self.assertAlmostEqual(bucket.blocked_until - time.monotonic(), 3,
+                               places=1)
+        self.assertGreater(self.limiter._reserve(bucket), 2)
+
+        # Grows back
+        bucket.in_flight = 10
+        for _ in range(10):
+            self.limiter.release('user', self.response(200))
+        stats = self.limiter.stats()['user']
+        self.assertAlmostEqual(stats['rate'], 6)
+        self.assertEqual(stats['concurrency'], 4)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_scopes_are_independent(self):
+        self.limiter.acquire('app')
+        self.limiter.release('app', self.response(429))
+
+        self.assertEqual(self.limiter._reserve(self.limiter._bucket(None)), 0)
+
+    def test_concurrency_limit(self):
+        limiter = yaosac.RateLimiter(rate=100, max_concurrency=1)
+        limiter.acquire('app')
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire('app')
+            acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+
+        self.assertFalse(acquired.wait(0.05))
+        self.assertEqual(limiter.stats()['app']['queue_depth'], 1)
+        limiter.release('app', self.response(200))
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_retry_after__http_date(self):
+        date = email.utils.formatdate(time.time() + 60, usegmt=True)
+
+        delay = yaosac._retry_after(self.response(429, {'Retry-After': date}))
+
+        self.assertAlmostEqual(delay, 60, delta=2)
+
+    def test_client_uses_the_limiter(self):
+        limiter = mock.Mock()
+        client = yaosac.Client(rate_limiter=limiter)
+        client.transport._session = mock.Mock()
+
+        response = client.view_notification('an-id')
+
+        limiter.acquire.assert_called_once_with('app', None)
+        limiter.release.assert_called_once_with('app', response)
+
+        client.transport._session.get.side_effect = ConnectionError()
+        with self.assertRaises(ConnectionError):
+            client.view_device('an-id')
+        limiter.release.assert_called_with(None, None)
+
+
+@mock.patch('time.sleep')
+class RetryPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.policy = yaosac.RetryPolicy(max_retries=2, jitter=False)
+        self.client = yaosac.Client(retry_policy=self.policy)
+        self.client.transport._session = self.session = mock.Mock()
+        self.failed = mock.Mock(status_code=503, headers={})
+        self.ok = mock.Mock(status_code=200, headers={})
+
+    def test_retries_transient_statuses(self, mock_sleep):
+        self.session.get.side_effect = [self.failed, self.ok]
+
+        response = self.client.view_device('an-id')
+
+        self.assertIs(response, self.ok)
+        self.assertEqual(self.session.get.call_count, 2)
+        mock_sleep.assert_called_once_with(0.5)
+
+    def test_gives_up(self, mock_sleep):
+        self.session.delete.return_value = self.failed
+
+        response = self.client.cancel_notification('an-id')
+
+        self.assertIs(response, self.failed)
+        self.assertEqual(self.session.delete.call_count, 3)
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(0.5), mock.call(1.0)])
+
+    def test_retries_connection_errors(self, mock_sleep):
+        self.session.get.side_effect = requests.ConnectionError()
+
+        with self.assertRaises(requests.ConnectionError):
+            self.client.view_apps()
+        self.assertEqual(self.session.get.call_count, 3)
+
+    def test_does_not_retry_unsafe_requests(self, mock_sleep):
+        self.session.post.return_value = self.failed
+        self.session.put.return_value = self.failed
+
+        self.client.add_a_device(identifier='a-token')
+        self.client.track_open('an-id')
+
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(self.session.put.call_count, 1)
+
+    def test_create_notification__idempotency_key(self, mock_sleep):
+        self.session.post.side_effect = [self.failed, self.ok]
+
+        self.client.create_notification('Bla')
+
+        first, second = self.session.post.call_args_list
+        key = first[1]['json']['external_id']
+        self.assertEqual(str(uuid.UUID(key)), key)
+        self.assertEqual(second[1]['json']['external_id'], key)
+
+    def test_create_notification__without_policy(self, mock_sleep):
+        self.client.retry_policy = None
+
+        self.client.create_notification('Bla')
+
+        self.assertNotIn('external_id',
+                         self.session.post.call_args[1]['json'])
+
+    def test_delay__retry_after_and_deadline(self, mock_sleep):
+        throttled = mock.Mock(status_code=429, headers={'Retry-After': '7'})
+
+        started = time.monotonic()
+
+        self.assertEqual(self.policy.delay(0, started, throttled), 7)
+        self.assertIsNone(self.policy.delay(0, started, self.ok))
+
+        self.policy.deadline = 5
+        self.assertIsNone(self.policy.delay(0, started, throttled))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = yaosac.ResponseCache()
+        self.client = yaosac.Client(cache=self.cache)
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.get.side_effect = lambda *args, **kwargs: mock.Mock()
+
+    def test_caches_reads(self):
+        first = self.client.view_an_app('an-app')
+        second = self.client.view_an_app('an-app')
+
+        self.assertIs(first, second)
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_only_configured_endpoints(self):
+        self.client.view_devices()
+        self.client.view_devices()
+
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_errors_are_not_cached(self):
+        self.session.get.side_effect = None
+        self.session.get.return_value.ok = False
+
+        self.client.view_device('a-device')
+        self.client.view_device('a-device')
+
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_ttl(self):
+        self.client.view_device('a-device')
+
+        later = time.monotonic() + 31
+        with mock.patch('time.monotonic', return_value=later):
+            self.client.view_device('a-device')
+
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_lru_eviction(self):
+        self.cache.maxsize = 2
+        self.client.view_device('a')
+        self.client.view_device('b')
+        self.client.view_device('a')
+        self.client.view_device('c')
+        self.session.get.reset_mock()
+
+        self.client.view_device('a')
+        self.assertEqual(self.session.get.call_count, 0)
+        self.client.view_device('b')
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_writes_invalidate(self):
+        self.client.view_apps()
+        self.client.view_an_app(APP_ID)
+        self.client.view_device('a-device')
+        self.client.view_notification('a-push')
+        self.assertEqual(len(self.cache), 4)
+
+        self.client.update_an_app(name='new')
+        self.assertEqual(len(self.cache), 2)
+
+        self.client.edit_device('another-device', tags={})
+        self.assertEqual(len(self.cache), 2)
+        self.client.edit_device('a-device', tags={})
+        self.assertEqual(len(self.cache), 1)
+
+        self.client.cancel_notification('a-push')
+        self.assertEqual(len(self.cache), 0)
+
+
+class CoalesceReadsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = yaosac.Client(coalesce_reads=True)
+        self.client.transport._session = self.session = mock.Mock()
+        self.release = threading.Event()
+
+    def get(self, url, json, headers):
+        self.release.wait(1)
+        if 'fail' in url:
+            raise ConnectionError()
+        return mock.Mock()
+
+    def call_concurrently(self, function, *args):
+        results = []
+
+        def call():
+            try:
+                results.append(function(*args))
+            except Exception as exc:
+                results.append(exc)
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_reads_share_a_request(self):
+        self.session.get.side_effect = self.get
+
+        results = self.call_concurrently(self.client.view_device, 'an-id')
+
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(map(id, results))), 1)
+        self.assertEqual(self.client._in_flight._calls, {})
+
+        self.client.view_device('an-id')
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_errors_are_shared(self):
+        self.session.get.side_effect = self.get
+
+        results = self.call_concurrently(self.client.view_device, 'fail')
+
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertTrue(all(isinstance(result, ConnectionError)
+                            for result in results))
+
+    def test_writes_are_not_coalesced(self):
+        self.session.put.side_effect = lambda *args, **kwargs: (
+            self.release.wait(1))
+
+        self.call_concurrently(self.client.edit_device, 'an-id')
+
+        self.assertEqual(self.session.put.call_count, 5)
+
+
+class NotificationPollerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.notifications = {
+            'sending': {'id': 'sending', 'remaining': 10, 'successful': 0},
+            'scheduled': {'id': 'scheduled', 'remaining': 0},
+            'done': {'id': 'done', 'remaining': 0,
+                     'completed_at': 1470000000}}
+        self.client = mock.Mock(MAX_NOTIFICATIONS_PAGE=2)
+        self.client.view_notification.side_effect = self.view_notification
+        self.client.view_notifications.side_effect = self.view_notifications
+        self.changes = []
+        self.poller = yaosac.NotificationPoller(
+            self.client, lambda *change: self.changes.append(change),
+            min_interval=1, max_interval=8, page_threshold=None)
+
+    def tearDown(self):
+        self.poller.close()
+
+    def response(self, data):
+        return mock.Mock(ok=True, **{'json.return_value': data})
+
+    def view_notification(self, notification_id):
+        if notification_id not in self.notifications:
+            return mock.Mock(ok=False)
+        return self.response(dict(self.notifications[notification_id]))
+
+    def view_notifications(self, limit, offset):
+        notifications = list(self.notifications.values())
+        return self.response(
+            {'notifications': notifications[offset:offset + limit]})
+
+    def poll(self):
+        for state in self.poller._tracked.values():
+            state[1] = 0
+        return self.poller.poll()
+
+    def intervals(self):
+        return {notification_id: state[0] for notification_id, state
+                in self.poller._tracked.items()}
+
+    def test_adaptive_intervals(self):
+        self.poller.track('sending', 'scheduled', 'done', 'unknown')
+
+        changes = self.poller.poll()
+
+        self.assertEqual(self.client.view_notification.call_count, 4)
+        self.assertEqual(changes, self.changes)
+        self.assertEqual(sorted(change[0] for change in changes),
+                         ['done', 'scheduled', 'sending'])
+        self.assertIsNone(changes[0][2])
+        self.assertEqual(self.intervals(), {'sending': 1, 'scheduled': 1,
+                                            'done': 8, 'unknown': 2})
+        self.assertEqual(self.poller.poll(), [])
+
+        self.notifications['sending'].update(remaining=0, successful=10,
+                                             completed_at=1470000001)
+        changes = self.poll()
+
+        self.assertEqual(changes, [('sending', self.notifications['sending'],
+                                    {'id': 'sending', 'remaining': 10,
+                                     'successful': 0})])
+        self.assertEqual(self.intervals(), {'sending': 8, 'scheduled': 2,
+                                            'done': 8, 'unknown': 4})
+        self.poll()
+        self.poll()
+        self.assertEqual(self.intervals()['scheduled'], 8)
+        self.assertEqual(self.poller.status('sending')['successful'], 10)
+
+    def test_page_fallback(self):
+        self.poller.page_threshold = 2
+        self.poller.track('sending', 'scheduled', 'done', 'old')
+
+        self.poller.poll()
+
+        self.assertEqual(self.client.view_notifications.call_count, 2)
+        self.client.view_notification.assert_called_once_with('old')
+        self.assertEqual(len(self.changes), 3)
+
+    def test_untrack(self):
+        self.poller.track('sending', 'done')
+        self.poller.untrack('done')
+
+        self.poller.poll()
+
+        self.assertNotIn('done', self.poller)
+        self.assertEqual(len(self.poller), 1)
+        self.client.view_notification.assert_called_once_with('sending')
+
+    def test_background_polling(self):
+        self.poller.start()
+        self.poller.track('sending')
+
+        for _ in range(100):
+            if self.changes:
+                break
+            time.sleep(0.01)
+        self.poller.close()
+        self.assertEqual(self.changes[0][0], 'sending')
+
+
+class NotificationAggregatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = yaosac.Client()
+        self.client.app_id = 'an-app'
+        self.client.app_auth_key = 'a-key'
+        self.client.transport._session = self.session = mock.Mock()
+        self.aggregator = yaosac.NotificationAggregator(
+            self.client, window=60, max_recipients=4)
+
+    def tearDown(self):
+        self.aggregator.close()
+
+    def sent(self):
+        return sorted((call[1]['json'] for call
+                       in self.session.post.call_args_list),
+                      key=lambda data: json.dumps(data, sort_keys=True))
+
+    def test_merges_identical_notifications(self):
+        send = self.aggregator.create_notification
+        futures = [send('Hi', include_player_ids=['a']),
+                   send('Hi', include_player_ids=['b', 'a']),
+                   send('Bye', include_player_ids=['a']),
+                   send('Hi', include_player_ids=['c'], data={'x': 1}),
+                   send('Hi', include_external_user_ids=['d']),
+                   send('Hi', include_player_ids=['e'])]
+        self.assertEqual(len(self.aggregator), 6)
+        self.assertEqual(self.session.post.call_count, 0)
+
+        self.aggregator.close()
+
+        self.assertEqual(self.sent(), [
+            {'app_id': 'an-app', 'contents': {'en': 'Bye'},
+             'include_player_ids': ['a']},
+            {'app_id': 'an-app', 'contents': {'en': 'Hi'},
+             'data': {'x': 1}, 'include_player_ids': ['c']},
+            {'app_id': 'an-app', 'contents': {'en': 'Hi'},
+             'include_external_user_ids': ['d']},
+            {'app_id': 'an-app', 'contents': {'en': 'Hi'},
+             'include_player_ids': ['a', 'b', 'e']}])
+        self.assertEqual(futures[0].result(), [self.session.post.return_value])
+        self.assertEqual(futures[1].result(), futures[0].result())
+        self.assertEqual(futures[5].result(), futures[0].result())
+        self.assertEqual((self.aggregator.calls, self.aggregator.requests),
+                         (6, 4))
+
+    def test_full_groups_are_sent_right_away(self):
+        send = self.aggregator.create_notification
+        futures = [send('Hi', include_player_ids=['a', 'b']),
+                   send('Hi', include_player_ids=['c'])]
+        self.assertEqual(len(self.aggregator), 2)
+
+        futures += [send('Hi', include_player_ids=['d', 'e']),
+                    send('Hi', include_player_ids=['f', 'g'])]
+
+        self.assertEqual(len(self.aggregator), 0)
+        for future in futures:
+            future.result(1)
+        self.assertEqual([data['include_player_ids'] for data in self.sent()],
+                         [['a', 'b', 'c'], ['d', 'e', 'f', 'g']])
+
+    def test_oversized_calls_are_split(self):
+        ids = ['id-%s' % index for index in range(10)]
+        send = self.aggregator.create_notification
+        other = send('Hi', include_player_ids=['a'])
+
+        future = send('Hi', include_player_ids=ids)
+        # Only the last part waits for the window
+        self.assertEqual(len(self.aggregator), 1)
+        self.aggregator.close()
+
+        self.assertEqual([data['include_player_ids'] for data in self.sent()],
+                         [['a'], ids[:4], ids[4:8], ids[8:]])
+        self.assertEqual(future.result(1),
+                         [self.session.post.return_value] * 3)
+        self.assertEqual(other.result(1), [self.session.post.return_value])
+
+    def test_oversized_calls_fail_when_a_part_fails(self):
+        error = requests.ConnectionError()
+        self.session.post.side_effect = [mock.Mock(), error]
+
+        future = self.aggregator.create_notification(
+            'Hi', include_player_ids=list('abcdef'))
+        self.aggregator.flush()
+
+        with self.assertRaises(requests.ConnectionError):
+            future.result(1)
+
+    def test_notifications_without_recipients_are_not_delayed(self):
+        future = self.aggregator.create_notification(
+            'Hi', included_segments=['All'])
+
+        self.assertEqual(future.result(1), [self.session.post.return_value])
+
+    def test_empty_recipients_are_not_merged(self):
+        future = self.aggregator.create_notification(
+            'Hi', include_player_ids=[])
+
+        self.assertEqual(future.result(1), [self.session.post.return_value])
+        self.assertEqual(len(self.aggregator), 0)
+        self.assertEqual(self.session.post.call_args[1]['json'][
+            'include_player_ids'], [])
+
+    def test_window(self):
+        self.aggregator.window = 0.05
+        future = self.aggregator.create_notification(
+            'Hi', include_player_ids=['a'])
+
+        self.assertEqual(future.result(1), [self.session.post.return_value])
+
+    def test_errors(self):
+        self.session.post.side_effect = requests.ConnectionError()
+        futures = [self.aggregator.create_notification(
+            'Hi', include_player_ids=[player_id]) for player_id in 'ab']
+        self.aggregator.flush()
+
+        for future in futures:
+            with self.assertRaises(requests.ConnectionError):
+                future.result(1)
+        with self.assertRaises(AssertionError):
+            self.aggregator.create_notification(include_player_ids=['a'])
+
+
+class TelemetryBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.batcher = yaosac.TelemetryBatcher(self.client,
+                                               flush_interval=60)
+
+    def tearDown(self):
+        self.batcher.close()
+
+    def test_coalesces_redundant_calls(self):
+        pings = [self.batcher.increment_session_length('a', 10),
+                 self.batcher.increment_session_length('b', 5),
+                 self.batcher.increment_session_length('a', 20)]
+        opens = [self.batcher.track_open('a-push'),
+                 self.batcher.track_open('a-push')]
+        self.batcher.new_session('a', language='es')
+        self.batcher.new_session('a', language='es')
+        self.assertEqual(len(self.batcher), 5)
+
+        self.batcher.flush()
+
+        self.assertEqual(
+            sorted(self.client.increment_session_length.call_args_list),
+            [mock.call('a', 30), mock.call('b', 5)])
+        self.client.track_open.assert_called_once_with('a-push')
+        self.assertEqual(self.client.new_session.call_count, 2)
+        self.assertIs(pings[0], pings[2])
+        self.assertIs(opens[0], opens[1])
+        self.assertIs(opens[0].result(0),
+                      self.client.track_open.return_value)
+
+    def test_flushes_when_full(self):
+        self.batcher.max_batch = 2
+        self.batcher.new_purchase('a', purchases=[])
+
+        future = self.batcher.new_purchase('b', purchases=[])
+
+        self.assertIs(future.result(1), self.client.new_purchase.return_value)
+        self.assertEqual(len(self.batcher), 0)
+
+    def test_flushes_periodically(self):
+        self.batcher.flush_interval = 0.01
+
+        future = self.batcher.track_open('a-push')
+
+        self.assertIs(future.result(1), self.client.track_open.return_value)
+
+    def test_close__drains(self):
+        self.client.new_session.side_effect = ConnectionError()
+        future = self.batcher.new_session('a')
+
+        self.batcher.close()
+
+        self.assertIsInstance(future.exception(0), ConnectionError)
+        with self.assertRaises(RuntimeError):
+            self.batcher.new_session('a')
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = yaosac.Instrumentation()
+        self.client = yaosac.Client(instrumentation=self.instrumentation)
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.get.return_value = mock.Mock(
+            status_code=200, content=b'{"id": "x"}',
+            request=mock.Mock(body=None))
+        self.session.post.return_value = mock.Mock(
+            status_code=400, content=b'{}', request=mock.Mock(body=b'{}'))
+
+    def test_hooks(self):
+        requested = []
+        responded = []
+        self.instrumentation.request_hooks.append(requested.append)
+        self.instrumentation.response_hooks.append(responded.append)
+
+        self.client.view_device('an-id')
+
+        request, = requested
+        self.assertIs(responded[0], request)
+        self.assertEqual(request.endpoint, 'view_device')
+        self.assertEqual(request.method, 'get')
+        self.assertEqual(request.status, 200)
+        self.assertEqual(request.response_bytes, 11)
+        self.assertIsNone(request.request_bytes)
+        self.assertEqual(request.retries, 0)
+        self.assertGreaterEqual(request.latency, 0)
+
+    def test_errors(self):
+        responded = []
+        self.instrumentation.response_hooks.append(responded.append)
+        error = ConnectionError()
+        self.session.get.side_effect = error
+
+        with self.assertRaises(ConnectionError):
+            self.client.view_device('an-id')
+
+        self.assertIs(responded[0].error, error)
+        self.assertIsNone(responded[0].status)
+
+    def test_metrics_snapshot(self):
+        for _ in range(3):
+            self.client.view_device('an-id')
+        self.client.create_notification('Bla')
+        self.session.get.side_effect = ConnectionError()
+        with self.assertRaises(ConnectionError):
+            self.client.view_device('an-id')
+
+        snapshot = self.instrumentation.metrics.snapshot()
+
+        view_device = snapshot['view_device']
+        self.assertEqual(view_device['count'], 4)
+        self.assertEqual(view_device['errors'], 1)
+        self.assertEqual(view_device['error_rate'], 0.25)
+        self.assertEqual(view_device['statuses'], {200: 3, 'error': 1})
+        self.assertEqual(view_device['response_bytes'], 33)
+        self.assertEqual(set(view_device['latency']),
+                         {'mean', 'p50', 'p95', 'p99'})
+        create = snapshot['create_notification']
+        self.assertEqual(create['errors'], 1)
+        self.assertEqual(create['request_bytes'], 2)
+
+    def test_percentiles(self):
+        metrics = yaosac.Metrics()
+        for latency in range(1, 101):
+            request = yaosac.RequestInfo('url', 'get', endpoint='x')
+            request.latency, request.status = latency / 1000, 200
+            metrics.record(request)
+
+        latency = metrics.snapshot()['x']['latency']
+
+        self.assertEqual(latency['p50'], 0.05)
+        self.assertEqual(latency['p95'], 0.095)
+        self.assertEqual(latency['p99'], 0.099)
+
+    def test_prometheus(self):
+        self.client.view_device('an-id')
+        self.client.create_notification('Bla')
+
+        text = self.instrumentation.metrics.prometheus()
+
+        self.assertIn('# TYPE yaosac_requests_total counter\n', text)
+        self.assertIn('yaosac_requests_total{endpoint="view_device",'
+                      'status="200"} 1\n', text)
+        self.assertIn('yaosac_request_errors_total'
+                      '{endpoint="create_notification"} 1\n', text)
+        self.assertIn('yaosac_request_duration_seconds_bucket'
+                      '{endpoint="view_device",le="+Inf"} 1\n', text)
+        self.assertIn('yaosac_request_duration_seconds_count'
+                      '{endpoint="view_device"} 1\n', text)
+
+    def test_retries_are_counted(self):
+        responded = []
+        self.instrumentation.response_hooks.append(responded.append)
+        self.client.retry_policy = yaosac.RetryPolicy(backoff_factor=0)
+        self.session.get.side_effect = [
+            mock.Mock(status_code=503, headers={}),
+            self.session.get.return_value]
+
+        self.client.view_device('an-id')
+
+        self.assertEqual(responded[0].retries, 1)
+
+
+class TimeoutsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = yaosac.Client(timeout=(1, 5))
+        self.client.transport._session = self.session = mock.Mock()
+
+    def test_timeouts(self):
+        self.client.view_device('an-id')
+        self.assertEqual(self.session.get.call_args[1]['timeout'], (1, 5))
+
+        with yaosac.call_options(timeout=2):
+            self.client.edit_device('an-id')
+            with yaosac.call_options(deadline=1.5):
+                self.client.view_device('an-id')
+        self.assertEqual(self.session.put.call_args[1]['timeout'], 2)
+        (connect, read) = self.session.get.call_args[1]['timeout']
+        self.assertEqual(connect, read)
+        self.assertLessEqual(read, 1.5)
+
+        self.client.timeout = None
+        self.client.view_device('an-id')
+        self.assertNotIn('timeout', self.session.get.call_args[1])
+
+    def test_deadline(self):
+        with yaosac.call_options(deadline=0):
+            with self.assertRaises(TimeoutError):
+                self.client.view_device('an-id')
+        self.assertEqual(self.session.get.call_count, 0)
+
+    @mock.patch('time.sleep')
+    def test_deadline_bounds_retries(self, mock_sleep):
+        self.client.retry_policy = yaosac.RetryPolicy(
+            max_retries=10, backoff_factor=0.1, jitter=False)
+        self.client.deadline = 0.15
+        self.session.get.return_value = mock.Mock(status_code=503,
+                                                  headers={})
+
+        response = self.client.view_device('an-id')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.session.get.call_count, 2)
+        mock_sleep.assert_called_once_with(0.1)
+
+    def test_rate_limiter_wait_is_bounded_by_the_deadline(self):
+        self.client.rate_limiter = yaosac.RateLimiter(rate=1)
+        self.client.view_device('an-id')
+
+        started = time.monotonic()
+        with yaosac.call_options(deadline=0.1):
+            with self.assertRaises(TimeoutError):
+                self.client.view_device('an-id')
+
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(self.client.rate_limiter.stats()[None]['in_flight'],
+                         0)
+
+    def test_export_download_timeout(self):
+        self.session.post.return_value.json.return_value = {
+            'csv_file_url': 'https://example.com/export.gz'}
+        self.session.get.side_effect = requests.Timeout()
+
+        with self.assertRaises(requests.Timeout):
+            list(self.client.iter_csv_export())
+
+        self.assertEqual(self.session.get.call_args[1]['timeout'], (1, 5))
+
+    def test_deadline_exceeded_in_the_transport(self):
+        for transport in (yaosac.RequestsTransport(),
+                          yaosac.HTTPClientTransport()):
+            client = yaosac.Client(deadline=0.05, transport=transport)
+            client.app_id = 'an-app'
+            with StandInServer(latency=0.5) as server:
+                client.OS_URL = server.url
+                with self.assertRaises(TimeoutError) as context:
+                    client.view_device('an-id')
+            client.close()
+            self.assertIsNotNone(context.exception.__cause__)
+
+    def test_http_client_transport_timeout(self):
+        transport = yaosac.HTTPClientTransport()
+        with StandInServer(latency=0.5) as server:
+            with self.assertRaises(TimeoutError):
+                transport.request('get', server.url + 'apps', {},
+                                  timeout=0.05)
+        transport.close()
+
+
+class HedgePolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.policy = yaosac.HedgePolicy(default_delay=0.05, min_samples=5)
+        self.client = yaosac.Client(hedge_policy=self.policy)
+        self.client.transport._session = self.session = mock.Mock()
+        self.slow = mock.Mock()
+        self.fast = mock.Mock()
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_slow_reads_are_hedged(self):
+        def get(*args, **kwargs):
+            if self.session.get.call_count == 1:
+                time.sleep(0.5)
+                return self.slow
+            return self.fast
+        self.session.get.side_effect = get
+
+        started = time.monotonic()
+        response = self.client.view_device('an-id')
+
+        self.assertIs(response, self.fast)
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertEqual(self.policy.hedges, 1)
+
+    def test_concurrent_reads_do_not_queue(self):
+        client = yaosac.Client(pool_maxsize=2, hedge_policy=self.policy)
+        self.addCleanup(client.close)
+        client.transport._session = session = mock.Mock()
+        session.get.side_effect = lambda *args, **kwargs: (
+            time.sleep(0.1) or self.fast)
+        self.policy.default_delay = 0.15
+        threads = [threading.Thread(target=client.view_device,
+                                    args=('an-id', )) for _ in range(16)]
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual(self.policy.hedges, 0)
+        self.assertEqual(session.get.call_count, 16)
+
+    def test_errors_wait_for_the_other_attempt(self):
+        def get(*args, **kwargs):
+            if self.session.get.call_count == 1:
+                time.sleep(0.1)
+                return self.slow
+            raise requests.ConnectionError()
+        self.session.get.side_effect = get
+
+        self.assertIs(self.client.view_device('an-id'), self.slow)
+
+        self.session.get.side_effect = requests.ConnectionError()
+        with self.assertRaises(requests.ConnectionError):
+            self.client.view_device('an-id')
+
+    def test_fast_reads_and_writes_are_not_hedged(self):
+        self.client.view_device('an-id')
+        self.session.put.side_effect = lambda *args, **kwargs: time.sleep(0.1)
+        self.client.edit_device('an-id')
+
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(self.session.put.call_count, 1)
+        self.assertEqual(self.policy.hedges, 0)
+
+    def test_delay(self):
+        self.assertEqual(self.policy.delay('view_device'), 0.05)
+        for latency in range(1, 21):
+            self.policy.record('view_device', latency / 100)
+
+        self.assertEqual(self.policy.delay('view_device'), 0.19)
+        self.assertEqual(self.policy.delay('view_notification'), 0.05)
+        self.policy.endpoints = {'view_notification'}
+        self.assertFalse(self.policy.allows(yaosac.RequestInfo(
+            'players/an-id', 'get', endpoint='view_device')))
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = yaosac.Instrumentation()
+        self.client = yaosac.Client(compress_threshold=512,
+                                    instrumentation=self.instrumentation)
+        self.client.app_id = 'an-app'
+        self.client.app_auth_key = 'a-key'
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.post.return_value = self.session.get.return_value = (
+            mock.Mock(status_code=200, content=b'{}'))
+        self.player_ids = ['player-%s' % index for index in range(100)]
+
+    def test_large_payloads_are_gzipped(self):
+        requested = []
+        self.instrumentation.response_hooks.append(requested.append)
+
+        self.client.create_notification('Hi',
+                                        include_player_ids=self.player_ids)
+
+        kwargs = self.session.post.call_args[1]
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(kwargs['data'])),
+                         {'app_id': 'an-app', 'contents': {'en': 'Hi'},
+                          'include_player_ids': self.player_ids})
+        self.assertTrue(requested[0].compressed)
+        self.assertEqual(requested[0].request_bytes, len(kwargs['data']))
+        self.assertEqual(self.instrumentation.metrics.snapshot()
+                         ['create_notification']['compressed'], 1)
+
+        template = self.client.compile_notification('Hi')
+        self.client.send_notification_template(
+            template, include_player_ids=self.player_ids)
+        self.assertEqual(json.loads(gzip.decompress(
+            self.session.post.call_args[1]['data']))['include_player_ids'],
+            self.player_ids)
+
+    def test_small_payloads_are_not(self):
+        self.client.create_notification('Hi', include_player_ids=['a'])
+        self.client.view_device('an-id')
+
+        kwargs = self.session.post.call_args[1]
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+        self.assertEqual(kwargs['json']['include_player_ids'], ['a'])
+        self.assertEqual(self.instrumentation.metrics.snapshot()
+                         ['create_notification']['compressed'], 0)
+
+    def test_transports(self):
+        for transport in (yaosac.RequestsTransport(),
+                          yaosac.HTTPClientTransport()):
+            with StandInServer() as server:
+                client = yaosac.Client(transport=transport,
+                                       compress_threshold=512)
+                client.OS_URL = server.url
+                client.app_id = 'an-app'
+                client.app_auth_key = 'a-key'
+                response = client.create_notification(
+                    'Hi', include_player_ids=self.player_ids)
+                devices = client.view_devices(limit=100)
+                client.close()
+
+            self.assertEqual(response.json()['recipients'], 100)
+            self.assertEqual(devices.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(len(devices.json()['players']), 100)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = yaosac.CircuitBreaker(window=4, min_calls=4,
+                                             reset_timeout=60)
+        self.client = yaosac.Client(circuit_breaker=self.breaker)
+        self.client.app_id = 'an-app'
+        self.client.app_auth_key = 'a-key'
+        self.client.transport._session = self.session = mock.Mock()
+        self.ok = mock.Mock(status_code=200)
+        self.error = mock.Mock(status_code=500)
+        self.session.get.return_value = self.ok
+        self.session.post.return_value = self.ok
+        self.release = threading.Event()
+
+    def blocked(self, function, *args):
+        # Keep a call in flight until `release` is set
+        self.session.get.side_effect = lambda *args, **kwargs: (
+            self.release.wait(1) and self.ok)
+        thread = threading.Thread(target=function, args=args)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.release.set)
+        for _ in range(100):
+            if self.breaker.in_flight:
+                break
+            time.sleep(0.01)
+
+    def test_opens_on_failures(self):
+        self.session.get.side_effect = [self.ok, self.error, self.ok]
+        for _ in range(3):
+            self.client.view_device('an-id')
+        self.assertEqual(self.breaker.state('view_device'), 'closed')
+        self.session.get.side_effect = requests.ConnectionError()
+        with self.assertRaises(requests.ConnectionError):
+            self.client.view_device('an-id')
+        self.assertEqual(self.breaker.state('view_device'), 'open')
+
+        with self.assertRaises(yaosac.CircuitOpenError):
+            self.client.view_device('an-id')
+        self.assertEqual(self.session.get.call_count, 4)
+        self.session.get.side_effect = None
+        self.client.view_notification('a-notification')
+
+        self.assertEqual(self.breaker.stats(), {
+            'in_flight': 0, 'shed': 0, 'endpoints': {
+                'view_device': {'state': 'open', 'failure_rate': 0,
+                                'rejected': 1},
+                'view_notification': {'state': 'closed',
+                                      'failure_rate': 0, 'rejected': 0}}})
+
+    def test_half_open_probes(self):
+        self.breaker.reset_timeout = 0
+        self.breaker.slow_call_duration = 0
+        for _ in range(4):
+            self.client.view_device('an-id')
+        self.assertEqual(self.breaker._circuits['view_device'].state,
+                         'open')
+
+        # A failed probe opens it again
+        self.client.view_device('an-id')
+        self.assertEqual(self.breaker._circuits['view_device'].state,
+                         'open')
+        self.breaker.slow_call_duration = None
+
+        self.blocked(self.client.view_device, 'an-id')
+        self.assertEqual(self.breaker.state('view_device'), 'half_open')
+        with self.assertRaises(yaosac.CircuitOpenError):
+            self.client.view_device('an-id')
+        self.release.set()
+        for _ in range(100):
+            if not self.breaker.in_flight:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.breaker.state('view_device'), 'closed')
+
+    def test_load_shedding(self):
+        self.breaker.max_in_flight = 2
+        self.blocked(self.client.view_device, 'an-id')
+
+        with self.assertRaises(yaosac.LoadShedError):
+            self.client.track_open('a-notification')
+        self.client.create_notification('Hi', include_player_ids=['a'])
+
+        self.assertEqual(self.session.put.call_count, 0)
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(self.breaker.stats()['shed'], 1)
+        self.assertEqual(self.breaker.stats()['in_flight'], 1)
+
+
+class ValidationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = yaosac.Client(validate=True)
+        self.client.app_id = 'an-app'
+        self.client.app_auth_key = 'a-key'
+        self.client.transport._session = self.session = mock.Mock()
+
+    def test_invalid_calls_are_not_sent(self):
+        calls = [
+            (self.client.view_device, ('a/b', ), {}),
+            (self.client.edit_device, ('an-id', ), {'tags': ['a']}),
+            (self.client.increment_session_length, ('an-id', -1), {}),
+            (self.client.view_devices, (301, ), {}),
+            (self.client.view_notifications, (None, -1), {}),
+            (self.client.add_a_device, (), {'language': 'en'}),
+            (self.client.new_purchase, ('an-id', ),
+             {'purchases': [{'sku': 'a', 'amount': 1}]}),
+            (self.client.create_notification, ('Hi', ),
+             {'include_player_ids': ['id'] * 2001}),
+            (self.client.create_notification, ({'en': 1}, ), {}),
+        ]
+        for method, args, kwargs in calls:
+            with self.assertRaises(yaosac.ValidationError):
+                method(*args, **kwargs)
+
+        self.assertEqual(self.session.method_calls, [])
+
+    def test_valid_calls_are_sent(self):
+        self.client.edit_device('an-id', tags={'a': 1, 'b': 'c'},
+                                language='en', unknown=[])
+        self.client.increment_session_length('an-id', 60)
+        self.client.create_notification(
+            'Hi', include_player_ids=['a-b-c'], ttl=60)
+
+        self.assertEqual(self.session.put.call_count, 1)
+        self.assertEqual(self.session.post.call_count, 2)
+
+    def test_disabled_by_default(self):
+        self.client.validate = False
+        self.client.view_devices(301)
+
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_required_checks_are_not_asserts(self):
+        self.client.validate = False
+        with self.assertRaises(yaosac.ValidationError):
+            self.client.view_notification('')
+        with self.assertRaises(ValueError):
+            self.client.create_notification(include_player_ids=['a'])
+
+    def test_validate(self):
+        yaosac.validate('edit_device', 'an-id', tags={'a': 1})
+
+        with self.assertRaisesRegex(yaosac.ValidationError, 'device_id'):
+            yaosac.validate('edit_device', tags={'a': 1})
+        with self.assertRaisesRegex(yaosac.ValidationError, 'must be int'):
+            yaosac.validate('increment_session_length', 'an-id', True)
+        with self.assertRaises(ValueError):
+            yaosac.validate('unknown', 'an-id')
+
+    def test_validate_calls(self):
+        calls = [{'contents': 'Hi'}, {'template_id': ''},
+                 {'contents': 'Hi', 'included_segments': 'All'}]
+
+        errors = yaosac.validate_calls('create_notification', calls)
+
+        self.assertEqual([index for index, _ in errors], [1, 2])
+        self.assertIsInstance(errors[0][1], yaosac.ValidationError)
+
+
+class TransportTestCase(unittest.TestCase):
+    def test_import_is_lazy(self):
+        code = ('import sys, yaosac; '
+                'print(sorted({"requests", "asyncio", "aiohttp", "orjson", '
+                '"concurrent.futures", "random", "urllib.parse"} '
+                '& set(sys.modules)))')
+
+        # Without `site`, which can import some of them itself
+        output = subprocess.check_output([sys.executable, '-S', '-c', code],
+                                         cwd=os.path.dirname(yaosac.__file__))
+
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_default_transport(self):
+        self.assertIsInstance(yaosac.Client().transport,
+                              yaosac.RequestsTransport)
+        self.assertIsInstance(yaosac.AsyncClient().transport,
+                              yaosac.AiohttpTransport)
+
+        with mock.patch('importlib.util.find_spec', return_value=None):
+            transport = yaosac.Client(pool_maxsize=3).transport
+
+        self.assertIsInstance(transport, yaosac.HTTPClientTransport)
+        self.assertEqual(transport.pool_maxsize, 3)
+
+    def test_http_client_transport(self):
+        transport = yaosac.HTTPClientTransport(pool_maxsize=1)
+        client = yaosac.Client(transport=transport)
+        with StandInServer(devices=3) as server:
+            client.OS_URL = server.url
+
+            response = client.create_notification('Bla',
+                                                  include_player_ids=['a'])
+            devices = list(client.iter_devices(page_size=2))
+            missing = client._make_request('nowhere', 'get')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.ok)
+        self.assertEqual(response.json()['recipients'], 1)
+        self.assertEqual(response.headers['content-type'],
+                         'application/json')
+        self.assertEqual(len(devices), 3)
+        self.assertEqual(missing.status_code, 404)
+        with self.assertRaises(yaosac.HTTPError) as context:
+            missing.raise_for_status()
+        self.assertIs(context.exception.response, missing)
+        # Kept alive
+        idle, = transport._idle.values()
+        self.assertEqual(len(idle), 1)
+        client.close()
+        self.assertEqual(dict(transport._idle), {})
+
+    def test_http_client_transport__stale_connection(self):
+        transport = yaosac.HTTPClientTransport()
+        with StandInServer() as server:
+            url = server.url + 'players/a-device'
+            transport.request('get', url, {})
+            connection, = transport._idle[('http', server.url[7:-8])]
+            # The server closes it while idle
+            connection.sock.shutdown(2)
+
+            response = transport.request('get', url, {})
+            transport.close()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_http_client_transport__stream(self):
+        transport = yaosac.HTTPClientTransport()
+        with StandInServer() as server:
+            with transport.stream(server.url + 'players/a') as response:
+                chunks = list(response.iter_content(10))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(b''.join(chunks))['id'], 'device-0')
+        self.assertTrue(all(len(chunk) <= 10 for chunk in chunks))
+
+
+class MultiAppClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limiter = yaosac.RateLimiter(rate=1000)
+        self.apps = yaosac.MultiAppClient(
+            {'app-1': 'key-1', 'app-2': 'key-2'}, user_auth_key='user-key',
+            rate_limiter=self.limiter, cache=yaosac.ResponseCache())
+        self.apps.transport._session = self.session = mock.Mock()
+
+    def test_routes_to_the_app_credentials(self):
+        self.apps.app('app-1').create_notification(contents={'en': 'a'})
+        self.apps.app('app-2').create_notification(contents={'en': 'b'})
+        self.apps.app('app-2').view_apps()
+
+        (first, second) = self.session.post.call_args_list
+        self.assertEqual(first[1]['json']['app_id'], 'app-1')
+        self.assertEqual(first[1]['headers']['Authorization'], 'Basic key-1')
+        self.assertEqual(second[1]['json']['app_id'], 'app-2')
+        self.assertEqual(second[1]['headers']['Authorization'],
+                         'Basic key-2')
+        self.assertEqual(self.session.get.call_args[1]['headers'],
+                         {'Content-Type': 'application/json',
+                          'Authorization': 'Basic user-key'})
+
+    def test_apps_share_the_transport(self):
+        app_1 = self.apps.app('app-1')
+        app_2 = self.apps.app('app-2')
+
+        self.assertIs(self.apps.app('app-1'), app_1)
+        self.assertIs(app_1.transport, app_2.transport)
+        self.assertIs(app_1.rate_limiter, app_2.rate_limiter)
+        self.assertIs(app_1.cache, app_2.cache)
+
+    def test_apps_share_the_hedge_threads(self):
+        apps = yaosac.MultiAppClient(
+            {'app-1': 'key-1', 'app-2': 'key-2'},
+            hedge_policy=yaosac.HedgePolicy(default_delay=0))
+        apps.transport._session = mock.Mock()
+        executor = apps.app('app-1')._hedge_executor
+
+        apps.app('app-1').view_devices()
+        apps.app('app-2').view_devices()
+
+        self.assertIs(apps.app('app-2')._hedge_executor, executor)
+        self.assertIsNotNone(executor._executor)
+        apps.close()
+        self.assertIsNone(executor._executor)
+
+    def test_apps_are_limited_and_cached_apart(self):
+        self.apps.app('app-1').view_devices()
+        self.apps.app('app-2').view_devices()
+        self.apps.app('app-1').view_devices()
+        self.apps.app('app-1').view_apps()
+
+        self.assertEqual(set(self.limiter.stats()),
+                         {('app-1', 'app'), ('app-2', 'app'), 'user'})
+        self.assertEqual(self.session.get.call_count, 4)
+
+    def test_registry(self):
+        with self.assertRaises(yaosac.ImproperlyConfigured):
+            self.apps.app('app-3')
+
+        self.apps.register('app-3', 'key-3')
+        self.assertIn('app-3', self.apps)
+        self.assertEqual(self.apps.app('app-3').app_auth_key, 'key-3')
+        self.apps.register('app-3', 'new-key')
+        self.assertEqual(self.apps.app('app-3').app_auth_key, 'new-key')
+
+        self.apps.unregister('app-3')
+        self.assertEqual(len(self.apps), 2)
+        with self.assertRaises(yaosac.ImproperlyConfigured):
+            self.apps.app('app-3')
+
+    def test_loads_keys_on_demand(self):
+        keys = {'app-1': 'key-1'}
+        apps = yaosac.MultiAppClient(keys.get)
+
+        self.assertEqual(apps.app('app-1').app_auth_key, 'key-1')
+        self.assertIn('app-1', apps)
+        with self.assertRaises(yaosac.ImproperlyConfigured):
+            apps.app('app-2')
+
+    def test_concurrent_use(self):
+        app_ids = ['app-%s' % index for index in range(20)]
+        for app_id in app_ids:
+            self.apps.register(app_id, app_id.replace('app', 'key'))
+
+        def send(app_id):
+            for _ in range(5):
+                self.apps.app(app_id).create_notification(
+                    contents={'en': 'a'})
+        threads = [threading.Thread(target=send, args=(app_id, ))
+                   for app_id in app_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.session.post.call_count, 100)
+        for call in self.session.post.call_args_list:
+            self.assertEqual(call[1]['json']['app_id'].replace('app', 'key'),
+                             call[1]['headers']['Authorization'][6:])
+
+
+class NotificationSpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'spool.db')
+        self.client = yaosac.Client()
+        self.client.app_id = 'an-app'
+        self.client.app_auth_key = 'a-key'
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.post.return_value = mock.Mock(ok=True)
+        self.spool = self.spool_class()
+
+    def tearDown(self):
+        self.spool.close()
+
+    def spool_class(self, **kwargs):
+        kwargs.setdefault('retry_policy', yaosac.RetryPolicy(
+            max_retries=2, backoff_factor=0, jitter=False))
+        return yaosac.NotificationSpool(self.path, self.client, **kwargs)
+
+    def sent(self):
+        return [call[1]['json'] for call in self.session.post.call_args_list]
+
+    def test_queued_notifications_survive_a_restart(self):
+        external_id = self.spool.enqueue(contents={'en': 'Hi'},
+                                         include_player_ids=['a'])
+        self.spool.close()
+
+        self.spool = self.spool_class()
+        self.assertEqual(len(self.spool), 1)
+        self.assertEqual(self.spool.drain(), 1)
+
+        self.assertEqual(self.sent(), [{'app_id': 'an-app',
+                                        'contents': {'en': 'Hi'},
+                                        'include_player_ids': ['a'],
+                                        'external_id': external_id}])
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.spool.drain(), 0)
+
+    def test_transient_failures_are_retried(self):
+        self.session.post.side_effect = [
+            mock.Mock(ok=False, status_code=503, headers={}),
+            requests.ConnectionError(), mock.Mock(ok=True)]
+        self.spool.enqueue(contents='Hi')
+
+        self.assertEqual(self.spool.drain(), 1)
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(len(set(notification['external_id']
+                                 for notification in self.sent())), 1)
+
+    def test_failures_are_kept(self):
+        self.spool.close()
+        self.spool = self.spool_class(max_workers=1)
+        self.session.post.side_effect = [
+            mock.Mock(ok=False, status_code=400, headers={})] + [
+            requests.ConnectionError()] * 3
+        self.spool.enqueue(contents='Bad')
+        self.spool.enqueue(contents='Down')
+
+        self.assertEqual(self.spool.drain(), 0)
+
+        self.assertEqual(len(self.spool), 0)
+        ((bad, bad_status, bad_error),
+         (down, down_status, down_error)) = self.spool.failures()
+        self.assertEqual((bad['contents'], bad_status, bad_error),
+                         ({'en': 'Bad'}, 400, None))
+        self.assertEqual((down['contents'], down_status, down_error),
+                         ({'en': 'Down'}, None, 'ConnectionError()'))
+
+    def test_crashed_sends_are_recovered_after_the_lease(self):
+        self.spool.close()
+        self.spool = self.spool_class(lease=0)
+        self.spool.enqueue(contents='Hi')
+        self.spool._claim(10)
+        # The process dies while sending
+        self.spool.close()
+
+        self.spool = self.spool_class()
+        self.assertEqual(self.spool.drain(), 1)
+        self.spool.enqueue(contents='Hello')
+        self.spool._claim(10)
+        self.spool.close()
+
+        self.spool = self.spool_class()
+        self.assertEqual(self.spool.drain(), 0)
+        self.assertEqual(len(self.spool), 1)
+
+    def test_background_worker(self):
+        self.spool.start()
+        for _ in range(10):
+            self.spool.enqueue(contents='Hi')
+
+        for _ in range(100):
+            if self.session.post.call_count == 10:
+                break
+            time.sleep(0.01)
+        self.spool.close()
+        self.assertEqual(self.session.post.call_count, 10)
+
+
+class CommandLineTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.client = yaosac.Client()
+        self.client.app_id = 'an-app'
+        self.client.app_auth_key = 'a-key'
+        self.client.transport._session = self.session = mock.Mock()
+        self.session.post.side_effect = self.post
+        self.session.put.return_value = mock.Mock(
+            ok=True, status_code=200, **{'json.return_value': {}})
+        self.stderr = io.StringIO()
+        patcher = mock.patch('sys.stderr', self.stderr)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, url, json, headers):
+        if json['contents']['en'] == 'fail':
+            return mock.Mock(ok=False, status_code=400,
+                             **{'json.return_value': {'errors': ['bad']}})
+        return mock.Mock(ok=True, status_code=200,
+                         **{'json.return_value': {'id': 'a-notification'}})
+
+    def path(self, name, lines=None):
+        path = os.path.join(self.directory, name)
+        if lines is not None:
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        return path
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read().splitlines()
+
+    def test_sends_notifications(self):
+        records = [json.dumps({'contents': {'en': text}})
+                   for text in ('a', 'fail', 'b')] + ['', 'not json']
+
+        status = yaosac.main(['notifications', self.path('in', records),
+                              '--workers', '2',
+                              '--results', self.path('results'),
+                              '--failures', self.path('failures')],
+                             client=self.client)
+
+        self.assertEqual(status, 1)
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(sorted(self.read('failures')),
+                         sorted([records[1], records[4]]))
+        results = sorted(map(json.loads, self.read('results')),
+                         key=lambda result: result['record'])
+        self.assertEqual([(result['record'], result['ok'])
+                          for result in results],
+                         [(0, True), (1, False), (2, True), (4, False)])
+        self.assertEqual(results[0]['body'], {'id': 'a-notification'})
+        self.assertEqual(results[1]['status'], 400)
+        self.assertIn('2 sent, 2 failed', self.stderr.getvalue())
+        self.assertIn('resume offset 5', self.stderr.getvalue())
+
+    def test_edits_devices(self):
+        records = [json.dumps({'id': 'device-%s' % index, 'tags': {'a': 1}})
+                   for index in range(3)]
+
+        status = yaosac.main(['devices', self.path('in', records)],
+                             client=self.client)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(call[0][0] for call
+                                in self.session.put.call_args_list),
+                         ['%splayers/device-%s' % (yaosac.Client.OS_URL, i)
+                          for i in range(3)])
+        self.assertEqual(self.session.put.call_args[1]['json'],
+                         {'app_id': 'an-app', 'tags': {'a': 1}})
+
+    def test_resumes_from_the_checkpoint(self):
+        records = [json.dumps({'id': 'device-%s' % index})
+                   for index in range(5)]
+        with open(self.path('checkpoint'), 'w') as f:
+            f.write('3')
+
+        yaosac.main(['devices', self.path('in', records),
+                     '--checkpoint', self.path('checkpoint')],
+                    client=self.client)
+
+        self.assertEqual(self.session.put.call_count, 2)
+        self.assertEqual(self.read('checkpoint'), ['5'])
+
+        yaosac.main(['devices', self.path('in', records), '--offset', '4'],
+                    client=self.client)
+        self.assertEqual(self.session.put.call_count, 3)
+
+    def test_check_records(self):
+        records = [json.dumps({'id': 'device-1', 'tags': {'a': 1}}),
+                   json.dumps({'id': 'device/2'}), 'not json',
+                   json.dumps({'tags': {}})]
+
+        status = yaosac.main(['devices', self.path('in', records),
+                              '--check'], client=self.client)
+
+        self.assertEqual(status, 2)
+        self.assertEqual(self.session.put.call_count, 0)
+        self.assertIn('record 1: `device_id`', self.stderr.getvalue())
+        self.assertIn('3 invalid records', self.stderr.getvalue())
+
+        yaosac.main(['devices', self.path('in', records[:1]), '--check'],
+                    client=self.client)
+        self.assertEqual(self.session.put.call_count, 1)
+
+    def test_module_entry_point(self):
+        output = subprocess.run(
+            [sys.executable, '-m', 'yaosac', '--help'],
+            stdout=subprocess.PIPE, check=True,
+            cwd=os.path.dirname(os.path.dirname(__file__))).stdout
+
+        self.assertIn(b'notifications', output)
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def test_stand_in_server(self):
+        with StandInServer(devices=5) as server:
+            with yaosac.Client() as client:
+                client.OS_URL = server.url
+
+                devices = list(client.iter_devices(page_size=2))
+                response = client.create_notification(
+                    'Bla', include_player_ids=['a', 'b'])
+
+        self.assertEqual([device['id'] for device in devices],
+                         ['device-%d' % index for index in range(5)])
+        self.assertEqual(response.json()['recipients'], 2)
+
+    def test_stand_in_server__injects_errors(self):
+        with StandInServer(throttle_rate=1, retry_after=3) as server:
+            client = yaosac.Client()
+            client.OS_URL = server.url
+
+            response = client.view_device('a-device')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '3')
+
+    def test_benchmark(self):
+        with StandInServer() as server:
+            result = benchmarks.benchmark('view_devices', 'threaded',
+                                          server.url, 10, 2, 1000,
+                                          memory=True)
+
+        self.assertEqual(result['requests'], 10)
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['requests_per_second'], 0)
+        self.assertGreater(result['peak_memory'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
+
+    def test_compare(self):
+        baseline = {'results': [{'scenario': 'a', 'mode': 'sync',
+                                 'requests_per_second': 100, 'p99': 0.1}]}
+        current = {'results': [{'scenario': 'a', 'mode': 'sync',
+                                'requests_per_second': 80, 'p99': 0.105}]}
+
+        regressions = benchmarks.compare(current, baseline, 0.1)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('requests per second', regressions[0])
+        self.assertEqual(benchmarks.compare(current, baseline, 0.25), [])
+
+
+class AsyncClientTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.client = yaosac.AsyncClient()
+        self.response = mock.Mock()
+        self.response.read = mock.AsyncMock()
+        request = mock.MagicMock()
+        request.__aenter__.return_value = self.response
+        self.session = mock.Mock()
+        self.session.request.return_value = request
+        self.session.close = mock.AsyncMock()
+        self.client.transport._session = self.session
+
+    def test_sync_with_is_refused(self):
+        with self.assertRaises(TypeError):
+            with self.client:
+                pass
+        with self.assertRaises(TypeError):
+            with yaosac.MultiAppClient(client_class=yaosac.AsyncClient):
+                pass
+
+    async def test_api_methods_are_coroutines(self):
+        response = await self.client.view_device('my-phone')
+
+        self.assertIs(response, self.response)
+        self.response.read.assert_awaited_once_with()
+        method, url = self.session.request.call_args[0]
+        self.assertEqual(method, 'GET')
+        self.assertIn('players/my-phone', url)
+        self.assertIn(APP_ID, url)
+
+    async def test_create_notification(self):
+        await self.client.create_notification('Bla', what='ever')
+
+        kwargs = self.session.request.call_args[1]
+        self.assertEqual(self.session.request.call_args[0][0], 'POST')
+        self.assertEqual(kwargs['json']['contents'], {'en': 'Bla'})
+        self.assertEqual(kwargs['json']['what'], 'ever')
+        self.assertIn(APP_AUTH_KEY, kwargs['headers']['Authorization'])
+
+    async def test_hedged_reads(self):
+        fast = mock.Mock()
+
+        class Transport:
+            calls = 0
+
+            async def request(self, *args):
+                self.calls += 1
+                if self.calls == 1:
+                    await asyncio.sleep(1)
+                return fast
+
+            def transient_errors(self):
+                return ConnectionError
+
+        self.client.transport = transport = Transport()
+        self.client.hedge_policy = yaosac.HedgePolicy(default_delay=0.05)
+
+        self.assertIs(await self.client.view_device('an-id'), fast)
+        self.assertEqual(transport.calls, 2)
+        self.assertEqual(self.client.hedge_policy.hedges, 1)
+
+    async def test_close__context_manager(self):
+        async with self.client:
+            pass
+
+        self.session.close.assert_awaited_once_with()
+        self.assertIsNone(self.client.transport._session)
+
+    async def test_create_notifications_bulk(self):
+        result = await self.client.create_notifications_bulk(
+            range(5), 'Bla', batch_size=2, max_workers=2)
+
+        self.assertEqual(self.session.request.call_count, 3)
+        self.assertEqual([batch for batch, _ in result.responses],
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(result.failures, [])
+
+    async def test_create_notifications_bulk__external_id(self):
+        await self.client.create_notifications_bulk(
+            range(3), 'Bla', batch_size=1, external_id='a-job')
+
+        keys = {json.loads(call[1]['data'])['external_id']
+                for call in self.session.request.call_args_list}
+        self.assertEqual(len(keys), 3)
+
+    def export(self, csv):
+        # The export is not ready on the first poll
+        self.response.json = mock.AsyncMock(
+            return_value={'csv_file_url': 'https://example.com/export.gz'})
+        data = gzip.compress(csv)
+
+        async def chunks(size):
+            for start in range(0, len(data), 10):
+                yield data[start:start + 10]
+        downloads = [mock.Mock(status=404), mock.Mock(status=200)]
+        downloads[1].content.iter_chunked = chunks
+        self.client.transport.stream = mock.AsyncMock(side_effect=downloads)
+        return downloads
+
+    @mock.patch('asyncio.sleep')
+    async def test_iter_csv_export(self, mock_sleep):
+        downloads = self.export(b'id,country\r\na,ES\r\nb,CL\r\n')
+
+        rows = [row async for row in self.client.iter_csv_export(
+            poll_interval=1, country=True)]
+
+        self.assertEqual(rows, [{'id': 'a', 'country': 'ES'},
+                                {'id': 'b', 'country': 'CL'}])
+        self.client.transport.stream.assert_awaited_with(
+            'https://example.com/export.gz', None)
+        mock_sleep.assert_awaited_once_with(1)
+        for download in downloads:
+            download.release.assert_called_once_with()
+
+    async def test_failed_export_download_is_released(self):
+        downloads = self.export(b'')
+        downloads[0].status = 500
+        downloads[0].raise_for_status.side_effect = RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            await self.client.download_csv_export(os.devnull)
+
+        downloads[0].release.assert_called_once_with()
+
+    @mock.patch('asyncio.sleep')
+    async def test_download_csv_export(self, mock_sleep):
+        csv = b'id,country\r\n' + b'a,ES\r\n' * 100
+        self.export(csv)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+
+            result = await self.client.download_csv_export(
+                path, decompress=True)
+
+            self.assertEqual(result, path)
+            with open(path, 'rb') as export:
+                self.assertEqual(export.read(), csv)
+
+    async def test_iter_devices(self):
+        async def json():
+            offset = int(self.session.request.call_args[0][1][-1])
+            return {'total_count': 5,
+                    'players': list(range(offset, min(offset + 2, 5)))}
+        self.response.json = json
+
+        result = [item async for item in self.client.iter_devices(
+            page_size=2, prefetch=False)]
+
+        self.assertEqual(result, [0, 1, 2, 3, 4])
+
+    async def test_coalesce_reads(self):
+        self.client._in_flight = self.client._single_flight()
+
+        results = await asyncio.gather(
+            *[self.client.view_notification('a-push') for _ in range(3)])
+
+        self.assertEqual(self.session.request.call_count, 1)
+        self.assertEqual(results, [self.response] * 3)
+        self.assertEqual(self.client._in_flight._calls, {})
+
+    def test_missing_aiohttp(self):
+        client = yaosac.AsyncClient()
+        with mock.patch.dict('sys.modules', {'aiohttp': None}):
+            with self.assertRaises(yaosac.ImproperlyConfigured):
+                client.session
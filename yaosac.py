@@ -1,16 +1,1527 @@
+import collections
+import contextlib
+import contextvars
+import copy
+import importlib.util
+import io
+import itertools
+import json
+import math
+import operator
 import os
+import threading
+import time
 
-import requests
+# `requests`, `aiohttp`, `asyncio` and the modules only some features
+# need are imported when first used, so importing yaosac is cheap.
 
 
 class ImproperlyConfigured(Exception):
     pass
 
 
+class ValidationError(ValueError, AssertionError):
+    """The arguments of an API call are invalid, raised before sending
+    it. An `AssertionError` too, what the first checks raised."""
+
+
+class BulkResult:
+    """Outcome of a bulk call. `responses` holds a `(batch, response)`
+    pair for every batch sent and `failures` a `(batch, exception)` pair
+    for every batch that raised, both in batch order."""
+
+    def __init__(self):
+        self.responses = []
+        self.failures = []
+
+    def __repr__(self):
+        return '<BulkResult responses=%d failures=%d>' % (
+            len(self.responses), len(self.failures))
+
+    def _add(self, index, batch, future):
+        try:
+            result = future.result()
+        except Exception as exc:
+            self.failures.append((index, batch, exc))
+        else:
+            self.responses.append((index, batch, result))
+
+    def _sort(self):
+        by_index = operator.itemgetter(0)
+        self.responses = [item[1:] for item in sorted(self.responses,
+                                                      key=by_index)]
+        self.failures = [item[1:] for item in sorted(self.failures,
+                                                     key=by_index)]
+        return self
+
+
+def _retry_after(response):
+    """Seconds to wait according to the `Retry-After` header, or None"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+class _Bucket:
+    def __init__(self, rate, burst, concurrency):
+        self.rate = rate
+        self.tokens = burst
+        self.concurrency = concurrency
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.in_flight = 0
+        self.waiting = 0
+
+
+class RateLimiter:
+    """Token bucket and concurrency limit for every auth scope ('app',
+    'user' or None, as used by `Client._get_headers`).
+
+    Requests are let through at `rate` per second, with bursts of up to
+    `burst`, and at most `max_concurrency` at a time. Both limits are
+    adapted with AIMD: a throttled (429) response halves them and blocks
+    the scope for the `Retry-After` time, every other response grows
+    them back additively.
+    """
+
+    def __init__(self, rate=10, burst=None, max_concurrency=16,
+                 min_rate=0.5, min_concurrency=1):
+        self.max_rate = rate
+        self.burst = burst or rate
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.min_concurrency = min_concurrency
+        self._buckets = {}
+        self._condition = threading.Condition()
+
+    def _bucket(self, scope):
+        bucket = self._buckets.get(scope)
+        if bucket is None:
+            bucket = self._buckets[scope] = _Bucket(
+                self.max_rate, self.burst, self.max_concurrency)
+        return bucket
+
+    def _reserve(self, bucket):
+        # Take a slot, or return how long to wait before trying again
+        now = time.monotonic()
+        bucket.tokens = min(self.burst, bucket.tokens
+                            + (now - bucket.updated) * bucket.rate)
+        bucket.updated = now
+        if now < bucket.blocked_until:
+            return bucket.blocked_until - now
+        if bucket.in_flight >= int(bucket.concurrency):
+            # Released by `release`
+            return None
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / bucket.rate
+        bucket.tokens -= 1
+        bucket.in_flight += 1
+        return 0
+
+    @staticmethod
+    def _until(scope, wait, deadline):
+        # `wait` cut to the `time.monotonic()` deadline, if any
+        if deadline is None:
+            return wait
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('The %r rate limit was not lifted before '
+                               'the call deadline' % (scope, ))
+        return remaining if wait is None else min(wait, remaining)
+
+    def acquire(self, scope, deadline=None):
+        """Block until a request for `scope` can be sent, raise
+        `TimeoutError` once the `time.monotonic()` `deadline` passed"""
+        with self._condition:
+            bucket = self._bucket(scope)
+            bucket.waiting += 1
+            try:
+                wait = self._reserve(bucket)
+                while wait != 0:
+                    self._condition.wait(self._until(scope, wait, deadline))
+                    wait = self._reserve(bucket)
+            finally:
+                bucket.waiting -= 1
+
+    async def acquire_async(self, scope, deadline=None):
+        """Like `acquire` but waits without blocking the event loop"""
+        import asyncio
+        with self._condition:
+            bucket = self._bucket(scope)
+            bucket.waiting += 1
+        try:
+            while True:
+                with self._condition:
+                    wait = self._reserve(bucket)
+                if wait == 0:
+                    return
+                await asyncio.sleep(self._until(
+                    scope, 0.01 if wait is None else wait, deadline))
+        finally:
+            with self._condition:
+                bucket.waiting -= 1
+
+    def release(self, scope, response=None):
+        """Give back the slot taken by `acquire`. `response` is None if
+        the request failed without one."""
+        with self._condition:
+            bucket = self._bucket(scope)
+            bucket.in_flight -= 1
+            if response is not None and _status(response) == 429:
+                bucket.rate = max(self.min_rate, bucket.rate / 2)
+                bucket.concurrency = max(self.min_concurrency,
+                                         bucket.concurrency / 2)
+                bucket.tokens = min(bucket.tokens, 0)
+                delay = _retry_after(response)
+                if delay:
+                    bucket.blocked_until = max(bucket.blocked_until,
+                                               time.monotonic() + delay)
+            elif response is not None:
+                bucket.rate = min(self.max_rate,
+                                  bucket.rate + self.max_rate / 100)
+                bucket.concurrency = min(self.max_concurrency,
+                                         bucket.concurrency
+                                         + 1 / bucket.concurrency)
+            self._condition.notify_all()
+
+    def stats(self):
+        """Current `rate`, `concurrency`, `in_flight` requests and
+        `queue_depth` by scope"""
+        with self._condition:
+            return {scope: {'rate': bucket.rate,
+                            'concurrency': int(bucket.concurrency),
+                            'in_flight': bucket.in_flight,
+                            'queue_depth': bucket.waiting}
+                    for scope, bucket in self._buckets.items()}
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying a failed request.
+
+    Connection errors and responses with a status in `statuses` are
+    retried up to `max_retries` times, waiting an exponential backoff of
+    `backoff_factor * 2 ** retry` seconds, at most `max_backoff`, with
+    full jitter, or the `Retry-After` time when given. No retry is
+    started after `deadline` seconds since the first attempt.
+
+    Only requests with a method in `methods` are retried, plus those the
+    client knows to be idempotent: `create_notification` attaches an
+    `external_id` so OneSignal drops duplicated sends.
+    """
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30,
+                 jitter=True, statuses=(429, 500, 502, 503, 504),
+                 methods=('get', 'put', 'delete'), deadline=None):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(methods)
+        self.deadline = deadline
+
+    def allows(self, method_name, idempotent=None):
+        """Whether a request can be retried, `idempotent` is None when
+        it depends on the HTTP method"""
+        if idempotent is None:
+            return method_name in self.methods
+        return idempotent
+
+    def delay(self, retry, started, response=None):
+        """Seconds to wait before the `retry`-th retry of a request
+        `started` at that `time.monotonic()`, or None to give up"""
+        import random
+        if retry >= self.max_retries:
+            return None
+        if response is not None and _status(response) not in self.statuses:
+            return None
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** retry)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if response is not None:
+            delay = max(delay, _retry_after(response) or 0)
+        if (self.deadline is not None
+                and time.monotonic() + delay - started > self.deadline):
+            return None
+        return delay
+
+
+def _timeouts(timeout):
+    # `(connect, read)` seconds of a timeout, a number is both
+    if isinstance(timeout, (tuple, list)):
+        return tuple(timeout)
+    return timeout, timeout
+
+
+_call_options = contextvars.ContextVar('yaosac_call_options', default=None)
+
+
+@contextlib.contextmanager
+def call_options(timeout=None, deadline=None):
+    """Limit the calls made in the block, from this thread or task.
+
+    `timeout` replaces the client's for every request, seconds or
+    `(connect, read)` seconds. The calls, retries included, must finish
+    within `deadline` seconds of entering the block or they raise
+    `TimeoutError`, with the transport's timeout error as its cause when
+    it was raised in a request. Blocks can be nested.
+    """
+    outer = _call_options.get()
+    if deadline is not None:
+        deadline += time.monotonic()
+    if outer is not None:
+        if timeout is None:
+            timeout = outer[0]
+        if deadline is None or (outer[1] is not None
+                                and outer[1] < deadline):
+            deadline = outer[1]
+    token = _call_options.set((timeout, deadline))
+    try:
+        yield
+    finally:
+        _call_options.reset(token)
+
+
+def _attempt_timeout(request):
+    # The timeout of an attempt of `request`, within its deadline
+    if request.deadline is None:
+        return request.timeout
+    remaining = request.deadline - time.monotonic()
+    if remaining <= 0:
+        raise _deadline_error(request)
+    return tuple(remaining if value is None else min(value, remaining)
+                 for value in _timeouts(request.timeout))
+
+
+def _deadline_error(request):
+    return TimeoutError('The %s call deadline was exceeded'
+                        % request.endpoint)
+
+
+def _raise_past_deadline(request, error):
+    # The transports time out in their own way, a call that ran out of
+    # time raises `TimeoutError` whatever the transport. The timeout
+    # fired at the deadline, give or take the clock resolution
+    if not _within_deadline(request, 0.001):
+        raise _deadline_error(request) from error
+
+
+def _within_deadline(request, delay):
+    return (request.deadline is None
+            or time.monotonic() + delay < request.deadline)
+
+
+class HedgePolicy:
+    """When to hedge a slow read: send it again and use the first answer.
+
+    A GET to one of `endpoints`, any by default, is hedged once it takes
+    longer than the `percentile` latency of the last `samples` calls to
+    its end-point, or `default_delay` seconds until `min_samples` are
+    known, and never before `min_delay` seconds. `hedges` counts the
+    hedged requests.
+    """
+
+    def __init__(self, percentile=95, default_delay=0.5, min_delay=0.01,
+                 samples=100, min_samples=20, endpoints=None):
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.endpoints = None if endpoints is None else frozenset(endpoints)
+        self.hedges = 0
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=samples))
+        self._lock = threading.Lock()
+
+    def allows(self, request):
+        return request.method == 'get' and (self.endpoints is None
+                                            or request.endpoint
+                                            in self.endpoints)
+
+    def delay(self, endpoint):
+        """Seconds to wait for an answer before hedging"""
+        with self._lock:
+            samples = sorted(self._latencies[endpoint])
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        return max(Metrics._percentile(samples, self.percentile),
+                   self.min_delay)
+
+    def record(self, endpoint, latency):
+        with self._lock:
+            self._latencies[endpoint].append(latency)
+
+
+class _ThreadPool:
+    # A thread pool started on first use and again after `shutdown`, so
+    # the copies of a client can share it. Idle threads are reused and
+    # new ones started when every thread is busy, nothing waits for a
+    # thread unless `max_workers` are running
+
+    def __init__(self, max_workers=1024):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        import concurrent.futures
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers)
+            return self._executor.submit(function, *args)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the API while an end-point's circuit is
+    open"""
+
+
+class LoadShedError(Exception):
+    """Raised without calling the API when there are too many calls in
+    flight for the end-point's priority"""
+
+
+class _Circuit:
+    __slots__ = ('state', 'outcomes', 'opened_at', 'probes', 'rejected')
+
+    def __init__(self, window):
+        self.state = 'closed'
+        # True for every failed call of the window
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened_at = None
+        self.probes = 0
+        self.rejected = 0
+
+
+class CircuitBreaker:
+    """Fail fast the calls to an end-point that is failing, and shed the
+    less important calls when too many are in flight.
+
+    A call fails when it raises, gets a 5xx status or, given
+    `slow_call_duration`, takes that many seconds or more. Once
+    `failure_rate` of the last `window` calls to an end-point failed,
+    with at least `min_calls` of them, its circuit opens and its calls
+    raise `CircuitOpenError` for `reset_timeout` seconds. Then up to
+    `half_open_calls` probe calls are let through, the circuit closes if
+    they succeed and opens again otherwise.
+
+    With `max_in_flight` calls in flight every end-point can use its
+    `priorities` share of them, `DEFAULT_PRIORITY` when missing; further
+    calls raise `LoadShedError`. By default telemetry is shed first and
+    `create_notification` last.
+    """
+
+    PRIORITIES = {'increment_session_length': 0.5, 'track_open': 0.5,
+                  'new_session': 0.5, 'new_purchase': 0.5,
+                  'create_notification': 1}
+    DEFAULT_PRIORITY = 0.8
+
+    def __init__(self, failure_rate=0.5, slow_call_duration=None, window=20,
+                 min_calls=10, reset_timeout=30, half_open_calls=1,
+                 max_in_flight=None, priorities=None):
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.window = window
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.max_in_flight = max_in_flight
+        self.priorities = dict(self.PRIORITIES, **(priorities or {}))
+        self.in_flight = 0
+        self.shed = 0
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, endpoint):
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits[endpoint] = _Circuit(self.window)
+        return circuit
+
+    def state(self, endpoint):
+        """'closed', 'open' or 'half_open'"""
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if (circuit.state == 'open' and time.monotonic()
+                    - circuit.opened_at >= self.reset_timeout):
+                return 'half_open'
+            return circuit.state
+
+    def _admit(self, endpoint):
+        now = time.monotonic()
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == 'open':
+                if now - circuit.opened_at < self.reset_timeout:
+                    circuit.rejected += 1
+                    raise CircuitOpenError('The %s circuit is open'
+                                           % endpoint)
+                circuit.state = 'half_open'
+            if (circuit.state == 'half_open'
+                    and circuit.probes >= self.half_open_calls):
+                circuit.rejected += 1
+                raise CircuitOpenError('The %s circuit is half open'
+                                       % endpoint)
+            if self.max_in_flight is not None:
+                share = self.priorities.get(endpoint, self.DEFAULT_PRIORITY)
+                if self.in_flight >= self.max_in_flight * share:
+                    self.shed += 1
+                    raise LoadShedError('%s calls in flight, %s shed'
+                                        % (self.in_flight, endpoint))
+            if circuit.state == 'half_open':
+                circuit.probes += 1
+            self.in_flight += 1
+        return now
+
+    def _record(self, endpoint, started, response=None, error=None):
+        # Without `response` nor `error` the call was interrupted, it
+        # neither failed nor succeeded
+        now = time.monotonic()
+        failed = (error is not None
+                  or (response is not None and _status(response) >= 500)
+                  or (self.slow_call_duration is not None
+                      and now - started >= self.slow_call_duration))
+        with self._lock:
+            self.in_flight -= 1
+            circuit = self._circuit(endpoint)
+            if circuit.state == 'half_open':
+                circuit.probes = max(circuit.probes - 1, 0)
+                if response is None and error is None:
+                    return
+                circuit.probes = 0
+                if failed:
+                    circuit.state = 'open'
+                    circuit.opened_at = now
+                else:
+                    circuit.state = 'closed'
+                    circuit.outcomes.clear()
+            elif circuit.state == 'closed' and (response is not None
+                                                or error is not None):
+                outcomes = circuit.outcomes
+                outcomes.append(failed)
+                if (len(outcomes) >= self.min_calls and sum(outcomes)
+                        >= self.failure_rate * len(outcomes)):
+                    circuit.state = 'open'
+                    circuit.opened_at = now
+                    outcomes.clear()
+
+    def stats(self):
+        """The state of the breaker for monitoring"""
+        endpoints = {}
+        for endpoint in list(self._circuits):
+            state = self.state(endpoint)
+            with self._lock:
+                circuit = self._circuits[endpoint]
+                outcomes = circuit.outcomes
+                endpoints[endpoint] = {
+                    'state': state,
+                    'failure_rate': (sum(outcomes) / len(outcomes)
+                                     if outcomes else 0),
+                    'rejected': circuit.rejected}
+        return {'in_flight': self.in_flight, 'shed': self.shed,
+                'endpoints': endpoints}
+
+
+class ResponseCache:
+    """In-process LRU cache of read responses.
+
+    `ttls` maps API method names to the seconds their responses are
+    kept, only those methods are cached. Up to `maxsize` responses are
+    kept, the least recently used are evicted first. Any write request
+    invalidates the cached reads of the same resource and of its parent,
+    e.g. `edit_device` drops `view_device` for that device and
+    `update_an_app` drops `view_an_app` and `view_apps`.
+    """
+
+    TTLS = {'view_apps': 60,
+            'view_an_app': 60,
+            'view_notification': 5,
+            'view_device': 30}
+
+    def __init__(self, ttls=None, maxsize=1024):
+        self.ttls = self.TTLS if ttls is None else ttls
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _path(url):
+        return url.split('?', 1)[0].rstrip('/')
+
+    def get(self, endpoint, auth, url):
+        """The cached response or None"""
+        if endpoint not in self.ttls:
+            return None
+        key = (auth, url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, endpoint, auth, url, response):
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return
+        with self._lock:
+            self._entries[(auth, url)] = (time.monotonic() + ttl,
+                                          self._path(url), response)
+            self._entries.move_to_end((auth, url))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url):
+        """Drop the responses of the resource at `url` and its parent"""
+        path = self._path(url)
+        paths = {path, path.rsplit('/', 1)[0]}
+        with self._lock:
+            for key in [key for key, entry in self._entries.items()
+                        if entry[1] in paths]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries)}
+
+
+class RequestInfo:
+    """An API call as it goes through the client, it is what the
+    `Instrumentation` hooks get."""
+
+    __slots__ = ('url', 'method', 'data', 'body', 'auth', 'scope',
+                 'idempotent', 'endpoint', 'full_url', 'headers', 'timeout',
+                 'deadline', 'compressed', 'retries', 'cached', 'started',
+                 'latency', 'status', 'error', 'request_bytes',
+                 'response_bytes')
+
+    def __init__(self, url, method, data=None, auth=None, idempotent=None,
+                 endpoint=None, body=None, scope=None):
+        self.url = url
+        self.method = method
+        self.data = data
+        # The already encoded `data`
+        self.body = body
+        self.auth = auth
+        # What the rate limits and cached responses are keyed on
+        self.scope = auth if scope is None else scope
+        self.idempotent = idempotent
+        self.endpoint = endpoint
+        self.full_url = None
+        self.headers = None
+        self.timeout = None
+        # The `time.monotonic()` the call must finish by
+        self.deadline = None
+        # Whether `body` is gzipped
+        self.compressed = False
+        self.retries = 0
+        self.cached = False
+        self.started = None
+        self.latency = None
+        self.status = None
+        self.error = None
+        self.request_bytes = None
+        self.response_bytes = None
+
+    def __repr__(self):
+        return '<RequestInfo %s %s %s>' % (self.endpoint, self.method.upper(),
+                                           self.status)
+
+
+def _body_size(body):
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return None
+
+
+class Instrumentation:
+    """Hooks called with the `RequestInfo` of every API call.
+
+    `request_hooks` are called before the request is made and
+    `response_hooks` once it finished, with its `status` (None if it
+    raised `error`), `latency` in seconds, `retries`, whether it was
+    `compressed` and payload sizes, when known, filled. `metrics`, a
+    `Metrics` by default, is a response hook aggregating them.
+    """
+
+    def __init__(self, metrics=None):
+        self.request_hooks = []
+        self.response_hooks = []
+        self.metrics = Metrics() if metrics is None else metrics
+        if self.metrics:
+            self.response_hooks.append(self.metrics.record)
+
+    def _start(self, request):
+        for hook in self.request_hooks:
+            hook(request)
+        request.started = time.perf_counter()
+
+    def _finish(self, request, response=None, error=None):
+        request.latency = time.perf_counter() - request.started
+        request.error = error
+        if response is not None:
+            request.status = _status(response)
+            request.request_bytes = _body_size(getattr(
+                getattr(response, 'request', None), 'body', None))
+            if request.request_bytes is None:
+                request.request_bytes = _body_size(request.body)
+            request.response_bytes = _body_size(getattr(
+                response, 'content', None)) or _body_size(getattr(
+                    response, '_body', None))
+        for hook in self.response_hooks:
+            hook(request)
+
+
+class _EndpointMetrics:
+    def __init__(self, buckets, samples):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.statuses = collections.Counter()
+        self.latency_sum = 0
+        self.buckets = [0] * buckets
+        self.samples = collections.deque(maxlen=samples)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.compressed = 0
+
+
+class Metrics:
+    """Request counts, errors, retries, sizes and latencies by API method.
+
+    Latency percentiles are computed over the last `samples` requests of
+    each method, the histogram counts every request in `BUCKETS`.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, request):
+        status = request.status
+        with self._lock:
+            metrics = self._endpoints.get(request.endpoint)
+            if metrics is None:
+                metrics = self._endpoints[request.endpoint] = (
+                    _EndpointMetrics(len(self.BUCKETS), self.samples))
+            metrics.count += 1
+            metrics.retries += request.retries
+            metrics.statuses[status or 'error'] += 1
+            if status is None or status >= 400:
+                metrics.errors += 1
+            metrics.latency_sum += request.latency
+            metrics.samples.append(request.latency)
+            for index, bound in enumerate(self.BUCKETS):
+                if request.latency <= bound:
+                    metrics.buckets[index] += 1
+                    break
+            metrics.request_bytes += request.request_bytes or 0
+            metrics.response_bytes += request.response_bytes or 0
+            metrics.compressed += request.compressed
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    @staticmethod
+    def _percentile(samples, percent):
+        return samples[max(math.ceil(percent / 100 * len(samples)) - 1, 0)]
+
+    def snapshot(self):
+        """The metrics of every API method as a dict"""
+        snapshot = {}
+        with self._lock:
+            for endpoint, metrics in self._endpoints.items():
+                samples = sorted(metrics.samples)
+                snapshot[endpoint] = {
+                    'count': metrics.count,
+                    'errors': metrics.errors,
+                    'error_rate': metrics.errors / metrics.count,
+                    'retries': metrics.retries,
+                    'statuses': dict(metrics.statuses),
+                    'request_bytes': metrics.request_bytes,
+                    'response_bytes': metrics.response_bytes,
+                    'compressed': metrics.compressed,
+                    'latency': {
+                        'mean': metrics.latency_sum / metrics.count,
+                        'p50': self._percentile(samples, 50),
+                        'p95': self._percentile(samples, 95),
+                        'p99': self._percentile(samples, 99)}}
+        return snapshot
+
+    def prometheus(self, prefix='yaosac'):
+        """The metrics in Prometheus text exposition format"""
+        requests_total = []
+        errors_total = []
+        retries_total = []
+        bytes_total = []
+        compressed_total = []
+        duration = []
+        with self._lock:
+            for endpoint, metrics in sorted(self._endpoints.items(),
+                                            key=lambda item: str(item[0])):
+                label = 'endpoint="%s"' % (endpoint or '')
+                for status, count in sorted(metrics.statuses.items(),
+                                            key=lambda item: str(item[0])):
+                    requests_total.append(
+                        '%s_requests_total{%s,status="%s"} %d'
+                        % (prefix, label, status, count))
+                errors_total.append('%s_request_errors_total{%s} %d'
+                                    % (prefix, label, metrics.errors))
+                retries_total.append('%s_request_retries_total{%s} %d'
+                                     % (prefix, label, metrics.retries))
+                bytes_total.append(
+                    '%s_payload_bytes_total{%s,direction="request"} %d'
+                    % (prefix, label, metrics.request_bytes))
+                bytes_total.append(
+                    '%s_payload_bytes_total{%s,direction="response"} %d'
+                    % (prefix, label, metrics.response_bytes))
+                compressed_total.append(
+                    '%s_compressed_requests_total{%s} %d'
+                    % (prefix, label, metrics.compressed))
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, metrics.buckets):
+                    cumulative += count
+                    duration.append(
+                        '%s_request_duration_seconds_bucket{%s,le="%s"} %d'
+                        % (prefix, label, bound, cumulative))
+                duration.append(
+                    '%s_request_duration_seconds_bucket{%s,le="+Inf"} %d'
+                    % (prefix, label, metrics.count))
+                duration.append('%s_request_duration_seconds_sum{%s} %r'
+                                % (prefix, label, metrics.latency_sum))
+                duration.append('%s_request_duration_seconds_count{%s} %d'
+                                % (prefix, label, metrics.count))
+        lines = []
+        for name, kind, samples in (
+                ('requests_total', 'counter', requests_total),
+                ('request_errors_total', 'counter', errors_total),
+                ('request_retries_total', 'counter', retries_total),
+                ('payload_bytes_total', 'counter', bytes_total),
+                ('compressed_requests_total', 'counter', compressed_total),
+                ('request_duration_seconds', 'histogram', duration)):
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+class _SingleFlight:
+    """Share the result of a call with the concurrent identical ones"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        import concurrent.futures
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = concurrent.futures.Future()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            return call.result()
+        try:
+            result = function(*args)
+        except BaseException as exc:
+            self._done(key)
+            call.set_exception(exc)
+            raise
+        self._done(key)
+        call.set_result(result)
+        return result
+
+    def _done(self, key):
+        with self._lock:
+            del self._calls[key]
+
+
+class _AsyncSingleFlight:
+    """`_SingleFlight` for coroutines running in one event loop"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, function, *args):
+        import asyncio
+        call = self._calls.get(key)
+        if call is not None:
+            return await asyncio.shield(call)
+        call = self._calls[key] = asyncio.ensure_future(function(*args))
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                del self._calls[key]
+            else:
+                # The leader was cancelled, the call goes on for the rest
+                call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+
+def _status(response):
+    # `requests` and `aiohttp` responses
+    return getattr(response, 'status_code', None) or response.status
+
+
+def _stdlib_json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+_default_json_dumps = None
+
+
+def _json_dumps():
+    # The default encoder, `orjson` is much faster when it's installed.
+    # Importing it is not free, it's loaded on first use
+    global _default_json_dumps
+    if _default_json_dumps is None:
+        try:
+            from orjson import dumps
+        except ImportError:
+            dumps = _stdlib_json_dumps
+        _default_json_dumps = dumps
+    return _default_json_dumps
+
+
+class NotificationTemplate:
+    """A notification payload encoded to JSON once.
+
+    `render` adds the per send fields, e.g. the recipients, encoding only
+    them. `dumps` encodes an object to JSON bytes.
+    """
+
+    def __init__(self, data, dumps=None):
+        self.data = data
+        self.dumps = dumps or _json_dumps()
+        # The static fields without the closing brace
+        self._prefix = self.dumps(data)[:-1]
+        if data:
+            self._prefix += b','
+
+    def render(self, **fields):
+        """The JSON bytes of the payload with `fields`"""
+        if not fields:
+            return self.dumps(self.data)
+        if not self.data.keys().isdisjoint(fields):
+            # Replaced fields, encode everything
+            return self.dumps(dict(self.data, **fields))
+        dumps = self.dumps
+        return self._prefix + b','.join(
+            [dumps(key) + b':' + dumps(value)
+             for key, value in fields.items()]) + b'}'
+
+
+def _batch_fields(recipient_field, batch, index, external_id=None):
+    # The per batch fields of a bulk send. Sharing the caller's
+    # `external_id` OneSignal would only send the first batch, each one
+    # gets a key of its own derived from it, the same on every run
+    fields = {recipient_field: batch}
+    if external_id is not None:
+        import uuid
+        fields['external_id'] = str(uuid.uuid5(
+            uuid.NAMESPACE_OID, '%s/%s' % (external_id, index)))
+    return fields
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DeviceTable:
+    """Devices stored by column, in a fraction of the memory of their
+    dicts.
+
+    The numeric `COLUMNS` are kept in arrays, the tags and the text
+    `fields` as codes of their distinct values. A row is rebuilt as a
+    dict when it's read, `mask`, `count` and `filter` scan the columns
+    without building them::
+
+        table = client.device_table()
+        table.count(last_active__gte=since, tags={'plan': 'pro'})
+    """
+
+    # Name, array type code and conversion of the numeric fields
+    COLUMNS = (('session_count', 'q', int), ('last_active', 'q', int),
+               ('created_at', 'q', int), ('playtime', 'q', int),
+               ('device_type', 'h', int), ('invalid_identifier', 'b', int),
+               ('amount_spent', 'd', float))
+    OPERATORS = {'lt': operator.lt, 'lte': operator.le, 'eq': operator.eq,
+                 'ne': operator.ne, 'gte': operator.ge, 'gt': operator.gt}
+
+    def __init__(self, devices=(), fields=('language', )):
+        import array
+        self.fields = tuple(fields)
+        self.ids = []
+        self._numeric = {name: array.array(typecode)
+                         for name, typecode, _ in self.COLUMNS}
+        self._codes = {}
+        self._values = {}
+        self._known = {}
+        for name in ('tags', ) + self.fields:
+            self._codes[name] = array.array('l')
+            self._values[name] = []
+            self._known[name] = {}
+        self.extend(devices)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+
+    def __getitem__(self, index):
+        row = {'id': self.ids[index]}
+        for name, column in self._numeric.items():
+            row[name] = column[index]
+        row['tags'] = dict(self._values['tags'][self._codes['tags'][index]])
+        for name in self.fields:
+            row[name] = self._values[name][self._codes[name][index]]
+        return row
+
+    def _encode(self, name, value):
+        code = self._known[name].get(value)
+        if code is None:
+            code = self._known[name][value] = len(self._values[name])
+            self._values[name].append(value)
+        self._codes[name].append(code)
+
+    def append(self, device):
+        """Add a device dict, as `view_devices` returns them"""
+        self.ids.append(device['id'])
+        for name, _, convert in self.COLUMNS:
+            self._numeric[name].append(convert(device.get(name) or 0))
+        self._encode('tags',
+                     tuple(sorted((device.get('tags') or {}).items())))
+        for name in self.fields:
+            self._encode(name, device.get(name))
+
+    def extend(self, devices):
+        for device in devices:
+            self.append(device)
+
+    def column(self, name):
+        """The values of a field, an `array.array` for the numeric
+        ones"""
+        if name in self._numeric:
+            return self._numeric[name]
+        if name == 'id':
+            return self.ids
+        if name not in self.fields:
+            raise ValueError("Unknown field '%s'" % name)
+        return list(map(self._values[name].__getitem__, self._codes[name]))
+
+    def mask(self, **conditions):
+        """`bytes` with a 1 for every row matching all the conditions.
+
+        A condition is `field=value` or `field__op=value`, with `op` one
+        of `OPERATORS`, for the numeric and text fields.
+        `tags={'key': 'value'}` matches the rows with those tags, a None
+        value any row with the key.
+        """
+        mask = b'\x01' * len(self)
+        for condition, value in conditions.items():
+            (name, _, op) = condition.partition('__')
+            compare = self.OPERATORS[op or 'eq']
+            if name in self._numeric:
+                matches = map(compare, self._numeric[name],
+                              itertools.repeat(value))
+            elif name == 'tags' or name in self.fields:
+                # Test every distinct value once, then map the codes
+                if name == 'tags':
+                    def test(items):
+                        tags = dict(items)
+                        return all(key in tags and (
+                            wanted is None or tags[key] == wanted)
+                            for key, wanted in value.items())
+                else:
+                    def test(item):
+                        try:
+                            return compare(item, value)
+                        except TypeError:
+                            return False
+                selected = {code for code, item
+                            in enumerate(self._values[name]) if test(item)}
+                matches = map(selected.__contains__, self._codes[name])
+            else:
+                raise ValueError("Unknown field '%s'" % name)
+            mask = bytes(map(operator.and_, mask, bytes(matches)))
+        return mask
+
+    def count(self, **conditions):
+        """Number of rows matching the `mask` conditions"""
+        return self.mask(**conditions).count(1)
+
+    def filter(self, **conditions):
+        """Iterate over the rows matching the `mask` conditions"""
+        return map(self.__getitem__, itertools.compress(
+            range(len(self)), self.mask(**conditions)))
+
+
+class HTTPError(Exception):
+    """An error status raised by `Response.raise_for_status`"""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class Response:
+    """The response of `HTTPClientTransport`, with the most used parts
+    of the `requests.Response` API."""
+
+    def __init__(self, status_code, headers, content=None, url=None,
+                 raw=None, connection=None):
+        self.status_code = status_code
+        self.headers = headers
+        self._content = content
+        self.url = url
+        # The undecoded body stream of streamed responses
+        self.raw = raw
+        self._connection = connection
+
+    def __repr__(self):
+        return '<Response [%d]>' % self.status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.raw.read() if self.raw is not None else b''
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise HTTPError('%d Error for url: %s'
+                            % (self.status_code, self.url), response=self)
+
+    def iter_content(self, chunk_size=1):
+        if self.raw is None:
+            yield self.content
+            return
+        yield from iter(lambda: self.raw.read(chunk_size), b'')
+
+    def close(self):
+        if self.raw is not None:
+            self.raw.close()
+        if self._connection is not None:
+            self._connection.close()
+
+
+class RequestsTransport:
+    """Sends the requests of a `Client` through a pooled `requests`
+    session, the default when `requests` is installed.
+
+    `pool_connections` is the number of hosts kept in the pool,
+    `pool_maxsize` the number of keep-alive connections per host and
+    `pool_block` turns `pool_maxsize` into a hard per-host limit instead
+    of opening throwaway connections when full.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 pool_block=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The pooled session shared by every API method and thread"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method_name, url, headers, json=None, body=None,
+                timeout=None):
+        """Send a request with a `json` payload or an encoded `body`,
+        `timeout` is seconds or `(connect, read)` seconds"""
+        method = getattr(self.session, method_name)
+        kwargs = {'headers': headers}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if body is None:
+            return method(url, json=json, **kwargs)
+        return method(url, data=body, **kwargs)
+
+    def stream(self, url, timeout=None):
+        """GET `url` without reading the body, `timeout` is that of
+        `request`"""
+        if timeout is None:
+            return self.session.get(url, stream=True)
+        return self.session.get(url, stream=True, timeout=timeout)
+
+    def transient_errors(self):
+        import requests
+        return (requests.ConnectionError, requests.Timeout)
+
+    def close(self):
+        """Close the pooled connections. The transport can still be
+        used, a new pool is created on the next request."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class HTTPClientTransport:
+    """Sends the requests of a `Client` with `http.client`, it needs no
+    third party package and starts faster than `requests`.
+
+    Connections are kept alive and reused, up to `pool_maxsize` idle
+    connections are kept per host. `json_dumps` encodes the payloads.
+    Responses are asked gzipped, as the other transports do.
+    """
+
+    def __init__(self, pool_maxsize=10, json_dumps=None):
+        self.pool_maxsize = pool_maxsize
+        # None for the default, see `_json_dumps`
+        self.json_dumps = json_dumps
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _connect(self, scheme, netloc):
+        import http.client
+        if scheme == 'https':
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(netloc,
+                                               context=self._ssl_context)
+        return http.client.HTTPConnection(netloc)
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle[key]
+            if idle:
+                return idle.pop(), True
+        return self._connect(*key), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.pool_maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    @staticmethod
+    def _exchange(connection, method_name, target, body, headers,
+                  timeout):
+        (connect, read) = _timeouts(timeout)
+        # Used when the connection is opened, the socket timeout is set
+        # for the response
+        connection.timeout = connect
+        connection.request(method_name.upper(), target, body, headers)
+        connection.sock.settimeout(read)
+        return connection.getresponse()
+
+    def _send(self, method_name, url, headers, body, timeout=None):
+        import http.client
+        import urllib.parse
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                          parts.query, ''))
+        connection, reused = self._checkout(key)
+        try:
+            return key, connection, self._exchange(
+                connection, method_name, target, body, headers, timeout)
+        except (ConnectionError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+        except BaseException:
+            connection.close()
+            raise
+        # The server closed the idle connection before it got the
+        # request, try again on a new one.
+        connection = self._connect(*key)
+        try:
+            return key, connection, self._exchange(
+                connection, method_name, target, body, headers, timeout)
+        except BaseException:
+            connection.close()
+            raise
+
+    def request(self, method_name, url, headers, json=None, body=None,
+                timeout=None):
+        """Send a request with a `json` payload or an encoded `body`,
+        `timeout` is seconds or `(connect, read)` seconds"""
+        if body is None and json is not None:
+            body = (self.json_dumps or _json_dumps())(json)
+        headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+        key, connection, response = self._send(method_name, url, headers,
+                                                body, timeout)
+        try:
+            content = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+        if response.getheader('Content-Encoding') == 'gzip':
+            import gzip
+            content = gzip.decompress(content)
+        return Response(response.status, response.headers, content, url)
+
+    def stream(self, url, timeout=None):
+        """GET `url` without reading the body, the connection is closed
+        with the response"""
+        _, connection, response = self._send('get', url, {}, None, timeout)
+        return Response(response.status, response.headers, url=url,
+                        raw=response, connection=connection)
+
+    def transient_errors(self):
+        import http.client
+        return (OSError, http.client.HTTPException)
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, collections.defaultdict(list)
+        for connection in itertools.chain.from_iterable(idle.values()):
+            connection.close()
+
+
+class AiohttpTransport:
+    """Sends the requests of an `AsyncClient` through a pooled `aiohttp`
+    session. There are up to `pool_maxsize` connections per host and
+    `pool_connections * pool_maxsize` in total, once the pool is full
+    requests wait for a free connection."""
+
+    def __init__(self, pool_connections=10, pool_maxsize=10):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImproperlyConfigured(("'aiohttp' is required by "
+                                        "AsyncClient. You can install it "
+                                        "with 'pip install yaosac[async]'."))
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_connections * self.pool_maxsize,
+            limit_per_host=self.pool_maxsize)
+        return aiohttp.ClientSession(connector=connector)
+
+    @staticmethod
+    def _timeout(timeout):
+        import aiohttp
+        (connect, read) = _timeouts(timeout)
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def request(self, method_name, url, headers, json=None,
+                      body=None, timeout=None):
+        if body is None:
+            payload = {'json': json}
+        else:
+            payload = {'data': body}
+        if timeout is not None:
+            payload['timeout'] = self._timeout(timeout)
+        async with self.session.request(method_name.upper(), url,
+                                        headers=headers,
+                                        **payload) as response:
+            # Read the body before the connection goes back to the pool
+            await response.read()
+        return response
+
+    async def stream(self, url, timeout=None):
+        """GET `url` without reading the body, `release` the response
+        when done"""
+        if timeout is None:
+            return await self.session.request('GET', url)
+        return await self.session.request('GET', url,
+                                          timeout=self._timeout(timeout))
+
+    def transient_errors(self):
+        import asyncio
+        import aiohttp
+        return (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+    async def close(self):
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None:
+            await session.close()
+
+
 class Client:
     """Client methods are a map of the server API end-points"""
 
     OS_URL = 'https://onesignal.com/api/v1/'
+    # Maximum `include_player_ids`/`include_external_user_ids` per call
+    MAX_RECIPIENTS = 2000
+    # Maximum `limit` of `view_devices` and `view_notifications`
+    MAX_DEVICES_PAGE = 300
+    MAX_NOTIFICATIONS_PAGE = 50
+
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, rate_limiter=None, retry_policy=None,
+                 cache=None, coalesce_reads=False, instrumentation=None,
+                 json_dumps=None, transport=None, timeout=None,
+                 deadline=None, hedge_policy=None, compress_threshold=None,
+                 circuit_breaker=None, validate=False):
+        # The connection pool settings of the default transport, see
+        # `RequestsTransport`
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        # A `RateLimiter` throttling the requests, can be shared
+        self.rate_limiter = rate_limiter
+        # A `RetryPolicy`, failed requests are not retried without it
+        self.retry_policy = retry_policy
+        # A `ResponseCache` for read requests, can be shared
+        self.cache = cache
+        # Concurrent identical reads share one request when enabled
+        self._in_flight = self._single_flight() if coalesce_reads else None
+        # An `Instrumentation`, nothing is measured without it
+        self.instrumentation = instrumentation
+        # Encodes the payloads we serialise ourselves to JSON bytes, None
+        # for the default, see `_json_dumps`
+        self.json_dumps = json_dumps
+        # Created on first use so creating a client costs nothing
+        self._transport = transport
+        self._transport_lock = threading.Lock()
+        # Seconds, or `(connect, read)` seconds, to wait for the server.
+        # With none requests can wait forever
+        self.timeout = timeout
+        # Seconds a call can take, retries included
+        self.deadline = deadline
+        # A `HedgePolicy`, reads are not hedged without it
+        self.hedge_policy = hedge_policy
+        # Shared by the copies `MultiAppClient` makes
+        self._hedge_executor = _ThreadPool()
+        # Payloads of at least this many bytes are sent gzipped
+        self.compress_threshold = compress_threshold
+        # A `CircuitBreaker`, can be shared
+        self.circuit_breaker = circuit_breaker
+        # Check the arguments of every call before sending it, see
+        # `validate`
+        self.validate = validate
+        # The app the requests are scoped to when many apps share the
+        # rate limiter and cache, see `MultiAppClient`
+        self._tenant = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def transport(self):
+        """Sends the requests, shared by every API method and thread"""
+        if self._transport is None:
+            with self._transport_lock:
+                if self._transport is None:
+                    self._transport = self._default_transport()
+        return self._transport
+
+    @transport.setter
+    def transport(self, value):
+        self._transport = value
+
+    def _default_transport(self):
+        # `requests` when it's installed, the standard library otherwise
+        if importlib.util.find_spec('requests') is None:
+            return HTTPClientTransport(self.pool_maxsize, self.json_dumps)
+        return RequestsTransport(self.pool_connections, self.pool_maxsize,
+                                 self.pool_block)
+
+    @property
+    def session(self):
+        """The pooled session of the `requests` transport"""
+        return self.transport.session
+
+    def close(self):
+        """Close the pooled connections. The client can still be used,
+        a new pool is created on the next request."""
+        if self._transport is not None:
+            self._transport.close()
+        self._hedge_executor.shutdown()
 
     def _check_an_auth_key(self, key_name):
         value = os.environ.get(key_name, None)
@@ -59,24 +1570,230 @@ class Client:
             headers.update({'Authorization': 'Basic %s' % auth})
         return headers
 
-    def _make_request(self, url, method_name, data=None, auth=None):
-        full_url = self.OS_URL + url
-        headers = self._get_headers(auth)
-        method = getattr(requests, method_name)
+    def _single_flight(self):
+        return _SingleFlight()
+
+    def _limits(self):
+        # The timeout and deadline of a call, see `call_options`
+        timeout = self.timeout
+        deadline = None
+        if self.deadline is not None:
+            deadline = time.monotonic() + self.deadline
+        options = _call_options.get()
+        if options is not None:
+            if options[0] is not None:
+                timeout = options[0]
+            if options[1] is not None and (deadline is None
+                                           or options[1] < deadline):
+                deadline = options[1]
+        return timeout, deadline
+
+    def _scope(self, auth):
+        # The user auth key is account wide, only app requests are
+        # told apart
+        if self._tenant is None or auth == 'user':
+            return auth
+        return (self._tenant, auth)
+
+    def _make_request(self, url, method_name, data=None, auth=None,
+                      idempotent=None, endpoint=None, body=None):
+        request = RequestInfo(url, method_name, data, auth, idempotent,
+                              endpoint, body, self._scope(auth))
+        (request.timeout, request.deadline) = self._limits()
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self._dispatch(request)
+        instrumentation._start(request)
+        try:
+            response = self._dispatch(request)
+        except Exception as exc:
+            instrumentation._finish(request, error=exc)
+            raise
+        instrumentation._finish(request, response)
+        return response
+
+    def _dispatch(self, request):
+        cache = self.cache
+        if request.method != 'get':
+            response = self._request(request)
+            if cache is not None:
+                cache.invalidate(request.url)
+            return response
+        if cache is not None:
+            response = cache.get(request.endpoint, request.scope, request.url)
+            if response is not None:
+                request.cached = True
+                return response
+        if self._in_flight is None:
+            response = self._request(request)
+        else:
+            response = self._in_flight.do((request.scope, request.url),
+                                          self._request, request)
+        if cache is not None and response.ok:
+            cache.set(request.endpoint, request.scope, request.url,
+                      response)
+        return response
+
+    def _request(self, request):
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return self._retry(request)
+        started = breaker._admit(request.endpoint)
+        try:
+            response = self._retry(request)
+        except Exception as exc:
+            breaker._record(request.endpoint, started, error=exc)
+            raise
+        except BaseException:
+            breaker._record(request.endpoint, started)
+            raise
+        breaker._record(request.endpoint, started, response)
+        return response
+
+    def _retry(self, request):
+        request.full_url = self.OS_URL + request.url
+        request.headers = self._get_headers(request.auth)
+        self._compress(request)
+
+        policy = self.retry_policy
+        if policy is None or not policy.allows(request.method,
+                                               request.idempotent):
+            return self._attempt(request)
+        started = time.monotonic()
+        while True:
+            try:
+                response = self._attempt(request)
+            except self._transient_errors():
+                delay = policy.delay(request.retries, started)
+                if delay is None or not _within_deadline(request, delay):
+                    raise
+            else:
+                delay = policy.delay(request.retries, started, response)
+                if delay is None or not _within_deadline(request, delay):
+                    return response
+            time.sleep(delay)
+            request.retries += 1
+
+    def _transient_errors(self):
+        return self.transport.transient_errors()
+
+    def _compress(self, request):
+        # Before the first attempt, the retries send the same body
+        threshold = self.compress_threshold
+        if threshold is None or request.method == 'get':
+            return
+        body = request.body
+        if body is None:
+            if request.data is None:
+                return
+            body = (self.json_dumps or _json_dumps())(request.data)
+        if len(body) < threshold:
+            return
+        import gzip
+        request.body = gzip.compress(body, compresslevel=6)
+        request.headers['Content-Encoding'] = 'gzip'
+        request.compressed = True
+
+    def _attempt(self, request):
+        import concurrent.futures
+        hedge_policy = self.hedge_policy
+        if hedge_policy is None or not hedge_policy.allows(request):
+            return self._send(request)
+        running = threading.Event()
 
-        response = method(full_url, json=data, headers=headers)
+        def send():
+            running.set()
+            return self._send(request)
+        attempts = {self._hedge_executor.submit(send)}
+        # The delay counts from the time the request is sent
+        running.wait()
+        started = time.monotonic()
+        done, attempts = concurrent.futures.wait(
+            attempts, hedge_policy.delay(request.endpoint))
+        if not done:
+            hedge_policy.hedges += 1
+            attempts.add(self._hedge_executor.submit(self._send, request))
+        while not done:
+            # The first answer, or the last error
+            done, attempts = concurrent.futures.wait(
+                attempts, return_when=concurrent.futures.FIRST_COMPLETED)
+            done = ([future for future in done if future.exception() is None]
+                    or (not attempts and list(done)))
+        hedge_policy.record(request.endpoint, time.monotonic() - started)
+        return list(done)[0].result()
+
+    def _send(self, request):
+        transport = self.transport
+        rate_limiter = self.rate_limiter
+
+        if rate_limiter is not None:
+            rate_limiter.acquire(request.scope, request.deadline)
+        response = None
+        try:
+            # What is left of the deadline after waiting for the limiter
+            timeout = _attempt_timeout(request)
+            response = transport.request(request.method, request.full_url,
+                                         request.headers, request.data,
+                                         request.body, timeout)
+        except self._transient_errors() as exc:
+            _raise_past_deadline(request, exc)
+            raise
+        finally:
+            if rate_limiter is not None:
+                rate_limiter.release(request.scope, response)
         return response
 
+    def _validate(self, method_name, *args, **kwargs):
+        if self.validate:
+            _VALIDATORS[method_name](*args, **kwargs)
+
     #
     # API methods
     #
     def create_notification(self, contents=None, template_id=None, **kwargs):
         url = 'notifications'
+        data = self._notification_data(contents, template_id, kwargs)
+        return self._make_request(url, 'post', data=data, auth='app',
+                                  idempotent=self._add_idempotency_key(data),
+                                  endpoint='create_notification')
+
+    def _add_idempotency_key(self, data, static=()):
+        # With a key OneSignal ignores repeated sends, so a retried
+        # request can't notify twice.
+        if self.retry_policy is None:
+            return None
+        if 'external_id' not in static:
+            import uuid
+            data.setdefault('external_id', str(uuid.uuid4()))
+        return True
+
+    def compile_notification(self, contents=None, template_id=None,
+                             **kwargs):
+        """Build and encode a notification once to send it many times
+        with `send_notification_template`. The arguments are the same
+        as `create_notification`'s."""
+        data = self._notification_data(contents, template_id, kwargs)
+        return NotificationTemplate(data, self.json_dumps)
+
+    def send_notification_template(self, template, **fields):
+        """Send a `NotificationTemplate`, `fields` are the per send
+        payload fields, e.g. `include_player_ids`."""
+        self._validate('send_notification_template', **fields)
+        idempotent = self._add_idempotency_key(fields, template.data)
+        return self._make_request('notifications', 'post', auth='app',
+                                  idempotent=idempotent,
+                                  endpoint='create_notification',
+                                  body=template.render(**fields))
+
+    def _notification_data(self, contents, template_id, kwargs):
         # Be sure we don't send a empty `template_id`
         if not template_id:
             template_id = None
-        assert contents or template_id, ('A required field is missing '
-                                         '`contents` or `template_id`')
+        if not (contents or template_id):
+            raise ValidationError('A required field is missing '
+                                  '`contents` or `template_id`')
+        self._validate('create_notification', contents, template_id,
+                       **kwargs)
         data = {'app_id': self.app_id}
         if contents is not None:
             if isinstance(contents, str):
@@ -86,103 +1803,1991 @@ class Client:
         else:
             data.update({'template_id': template_id})
         data.update(kwargs)
-        return self._make_request(url, 'post', data=data, auth='app')
+        return data
 
     def cancel_notification(self, notification_id):
+        self._validate('cancel_notification', notification_id)
         _url = 'notifications'
         url = (_url + '/' + notification_id + '?app_id=' + self.app_id)
-        return self._make_request(url, 'delete', auth='app')
+        return self._make_request(url, 'delete', auth='app',
+                                  endpoint='cancel_notification')
 
     def view_apps(self):
         url = 'apps'
-        return self._make_request(url, 'get', auth='user')
+        return self._make_request(url, 'get', auth='user',
+                                  endpoint='view_apps')
         
     def view_an_app(self, app_id):
+        self._validate('view_an_app', app_id)
         _url = 'apps'
         url = _url + '/' + app_id
-        return self._make_request(url, 'get', auth='user')
+        return self._make_request(url, 'get', auth='user',
+                                  endpoint='view_an_app')
 
     def create_an_app(self, **kwargs):
+        self._validate('create_an_app', **kwargs)
         url = 'apps'
-        return self._make_request(url, 'post', data=kwargs, auth='user')
+        return self._make_request(url, 'post', data=kwargs, auth='user',
+                                  endpoint='create_an_app')
         
     def update_an_app(self, **kwargs):
+        self._validate('update_an_app', **kwargs)
         _url = 'apps'
         url = _url + '/' + self.app_id
-        return self._make_request(url, 'put', data=kwargs, auth='user')
+        return self._make_request(url, 'put', data=kwargs, auth='user',
+                                  endpoint='update_an_app')
 
     def view_devices(self, limit=None, offset=None):
+        self._validate('view_devices', limit, offset)
         _url = 'players'
         url = _url + '/?app_id=' + self.app_id
         if limit is not None:
             url += '&limit=' + str(limit)
         if offset is not None:
             url += '&offset=' + str(offset)
-        return self._make_request(url, 'get', auth='app')
+        return self._make_request(url, 'get', auth='app',
+                                  endpoint='view_devices')
 
     def view_device(self, device_id):
+        self._validate('view_device', device_id)
         _url = 'players'
         url = _url + '/' + device_id + '?app_id=' + self.app_id
-        return self._make_request(url, 'get')
+        return self._make_request(url, 'get', endpoint='view_device')
 
     def add_a_device(self, **kwargs):
+        self._validate('add_a_device', **kwargs)
         url = 'players'
         kwargs.update({'app_id': self.app_id})
-        return self._make_request(url, 'post', data=kwargs)
+        return self._make_request(url, 'post', data=kwargs,
+                                  endpoint='add_a_device')
 
     def edit_device(self, device_id, **kwargs):
+        self._validate('edit_device', device_id, **kwargs)
         _url = 'players'
         url = _url + '/' + device_id
         kwargs.update({'app_id': self.app_id})
-        return self._make_request(url, 'put', data=kwargs)
+        return self._make_request(url, 'put', data=kwargs,
+                                  endpoint='edit_device')
 
     def new_session(self, device_id, **kwargs):
+        self._validate('new_session', device_id, **kwargs)
         _url = 'players'
         url = _url + '/' + device_id + '/on_session'
-        return self._make_request(url, 'post', data=kwargs)
+        return self._make_request(url, 'post', data=kwargs,
+                                  endpoint='new_session')
 
     def new_purchase(self, device_id, **kwargs):
+        self._validate('new_purchase', device_id, **kwargs)
         _url = 'players'
         url = _url + '/' + device_id + '/on_purchase'
-        return self._make_request(url, 'post', data=kwargs)
+        return self._make_request(url, 'post', data=kwargs,
+                                  endpoint='new_purchase')
 
     def increment_session_length(self, device_id, active_time):
+        self._validate('increment_session_length', device_id,
+                       active_time)
         _url = 'players'
         url = _url + '/' + device_id + '/on_focus'
         data = {'state': 'ping', 'active_time': active_time}
-        return self._make_request(url, 'post', data=data)
+        return self._make_request(url, 'post', data=data,
+                                  endpoint='increment_session_length')
 
-    def csv_export(self, **kwargs):
+    def csv_export(self, last_active_since=None, segment_name=None,
+                   **kwargs):
+        self._validate('csv_export', last_active_since, segment_name,
+                       **kwargs)
         _url = 'players'
         url = _url + '/csv_export' + '?app_id=' + self.app_id
         data = {'extra_fields': list(kwargs.keys())}
-        return self._make_request(url, 'post', data=data, auth='app')
+        # Only the devices active since this Unix time
+        if last_active_since is not None:
+            data.update({'last_active_since': str(int(last_active_since))})
+        if segment_name is not None:
+            data.update({'segment_name': segment_name})
+        return self._make_request(url, 'post', data=data, auth='app',
+                                  endpoint='csv_export')
 
     def view_notification(self, notification_id):
         # We rise an exception here because if not id is given the
         # call is equal to `view_notifications`. If we let this
         # happens the call to OneSignal will be valid but the content
         # unexpected.
-        assert notification_id, "`notification_id`({}) is not a valid id".format(notification_id)
+        if not notification_id:
+            raise ValidationError('`notification_id`(%r) is not a valid id'
+                                  % (notification_id, ))
+        self._validate('view_notification', notification_id)
         _url = 'notifications'
         url = (_url + '/' + notification_id + '?app_id=' + self.app_id)
-        return self._make_request(url, 'get', auth='app')
+        return self._make_request(url, 'get', auth='app',
+                                  endpoint='view_notification')
 
     def view_notifications(self, limit=None, offset=None):
+        self._validate('view_notifications', limit, offset)
         _url = 'notifications'
         url = _url + '/' + '?app_id=' + self.app_id
         if limit is not None:
             url += '&limit=' + str(limit)
         if offset is not None:
             url += '&offset=' + str(offset)
-        return self._make_request(url, 'get', auth='app')
+        return self._make_request(url, 'get', auth='app',
+                                  endpoint='view_notifications')
 
     def track_open(self, notification_id):
+        self._validate('track_open', notification_id)
         _url = 'notifications'
         url = _url + '/' + notification_id
         data = {'app_id': self.app_id,
                 'opened': True}
-        return self._make_request(url, 'put', data=data)
+        # Every call counts as an open, not safe to retry
+        return self._make_request(url, 'put', data=data, idempotent=False,
+                                  endpoint='track_open')
+
+    #
+    # Bulk helpers
+    #
+    def create_notifications_bulk(self, recipients, contents=None,
+                                  template_id=None,
+                                  recipient_field='include_player_ids',
+                                  batch_size=None, max_workers=4, **kwargs):
+        """Send the same notification to any number of `recipients`.
+
+        `recipients` is an iterable of ids, consumed lazily, that is
+        split in batches of `batch_size` (`MAX_RECIPIENTS` by default)
+        sent as `recipient_field`, e.g. 'include_external_user_ids'. Up
+        to `max_workers` batches are sent concurrently. Returns a
+        `BulkResult`. With an `external_id` every batch is sent with a
+        key derived from it.
+        """
+        import concurrent.futures
+        external_id = kwargs.pop('external_id', None)
+        template = self.compile_notification(contents, template_id,
+                                             **kwargs)
+        batches = _chunks(recipients, batch_size or self.MAX_RECIPIENTS)
+        result = BulkResult()
+        pending = {}
+
+        def send(batch, index):
+            return self.send_notification_template(
+                template, **_batch_fields(recipient_field, batch, index,
+                                          external_id))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            for index, batch in enumerate(batches):
+                # Keep a bounded number of batches in memory
+                if len(pending) >= max_workers * 2:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        result._add(*pending.pop(future), future)
+                # In the caller's `call_options`
+                future = executor.submit(contextvars.copy_context().run,
+                                         send, batch, index)
+                pending[future] = (index, batch)
+            for future in concurrent.futures.as_completed(pending):
+                result._add(*pending[future], future)
+        return result._sort()
+
+    def iter_devices(self, page_size=None, prefetch=True, max_workers=1):
+        """Iterate over every device of the app, see `_iter_pages`"""
+        return self._iter_pages(self.view_devices, 'players',
+                                page_size or self.MAX_DEVICES_PAGE,
+                                prefetch, max_workers)
+
+    def iter_notifications(self, page_size=None, prefetch=True,
+                           max_workers=1):
+        """Iterate over every notification of the app, see
+        `_iter_pages`"""
+        return self._iter_pages(self.view_notifications, 'notifications',
+                                page_size or self.MAX_NOTIFICATIONS_PAGE,
+                                prefetch, max_workers)
+
+    def device_table(self, page_size=None, prefetch=True, max_workers=1,
+                     fields=('language', )):
+        """Every device of the app in a `DeviceTable`, the arguments are
+        those of `iter_devices` and `DeviceTable`."""
+        return DeviceTable(self.iter_devices(page_size, prefetch,
+                                             max_workers), fields)
+
+    def _iter_pages(self, view, key, page_size, prefetch, max_workers):
+        """Walk all the pages of `view` lazily, yielding the `key` items.
+
+        While a page is consumed the next `max_workers` pages are fetched
+        in the background. Without `prefetch` pages are fetched one by
+        one when needed. A failed page raises the transport's
+        `HTTPError`.
+        """
+        import concurrent.futures
+        def fetch(offset):
+            response = view(limit=page_size, offset=offset)
+            response.raise_for_status()
+            return response.json()
+
+        items = fetch(0)
+        total = items.get('total_count')
+        items = items[key]
+        if total is None:
+            # Unknown size, stop at the first short page
+            offsets = itertools.count(page_size, page_size)
+        else:
+            offsets = iter(range(page_size, total, page_size))
+        if not prefetch:
+            max_workers = 0
+
+        window = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(
+                max(max_workers, 1)) as executor:
+            try:
+                while True:
+                    while len(window) < max_workers:
+                        offset = next(offsets, None)
+                        if offset is None:
+                            break
+                        window.append(executor.submit(
+                            contextvars.copy_context().run, fetch, offset))
+                    yield from items
+                    if not items or (total is None
+                                     and len(items) < page_size):
+                        return
+                    if window:
+                        items = window.popleft().result()[key]
+                    else:
+                        offset = next(offsets, None)
+                        if offset is None:
+                            return
+                        items = fetch(offset)[key]
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def iter_csv_export(self, poll_interval=5, timeout=600, **kwargs):
+        """Export the devices with `csv_export` and yield every row as a
+        dict, `kwargs` are the `csv_export` arguments.
+
+        The export is polled until it is ready, then downloaded and
+        decompressed while it is parsed so memory use does not depend
+        on the export size.
+        """
+        import csv
+        import gzip
+        with self._download_csv_export(poll_interval, timeout,
+                                       kwargs) as download:
+            with gzip.GzipFile(fileobj=download.raw) as source:
+                text = io.TextIOWrapper(source, encoding='utf-8',
+                                        newline='')
+                yield from csv.DictReader(text)
+
+    def download_csv_export(self, path, poll_interval=5, timeout=600,
+                            decompress=False, chunk_size=64 * 1024,
+                            **kwargs):
+        """Export the devices with `csv_export` and save the file to
+        `path`, gzipped unless `decompress`. Returns `path`."""
+        import gzip
+        import shutil
+        with self._download_csv_export(poll_interval, timeout,
+                                       kwargs) as download:
+            with open(path, 'wb') as destination:
+                if decompress:
+                    with gzip.GzipFile(fileobj=download.raw) as source:
+                        shutil.copyfileobj(source, destination, chunk_size)
+                else:
+                    for chunk in download.iter_content(chunk_size):
+                        destination.write(chunk)
+        return path
+
+    def _stream_request(self, url):
+        # The export download, limited like the API calls
+        request = RequestInfo(url, 'get', endpoint='csv_export')
+        (request.timeout, request.deadline) = self._limits()
+        return request
+
+    def _download_csv_export(self, poll_interval, timeout, kwargs):
+        response = self.csv_export(**kwargs)
+        response.raise_for_status()
+        url = response.json()['csv_file_url']
+        deadline = time.monotonic() + timeout
+        request = self._stream_request(url)
+        # The file is not there until the export finishes
+        while True:
+            download = self.transport.stream(url, _attempt_timeout(request))
+            if download.status_code not in (403, 404):
+                try:
+                    download.raise_for_status()
+                except BaseException:
+                    download.close()
+                    raise
+                return download
+            download.close()
+            if time.monotonic() + poll_interval >= deadline:
+                raise TimeoutError('The export %s was not ready after %s '
+                                   'seconds' % (url, timeout))
+            time.sleep(poll_interval)
+
+
+def _is_id(value):
+    # OneSignal ids are UUIDs, we only refuse what can't be one in the
+    # URL path they are sent in
+    return (isinstance(value, str) and value.isascii()
+            and value.replace('-', '').replace('_', '').isalnum())
+
+
+def _check_id(name, value):
+    if not _is_id(value):
+        raise ValidationError('`%s`(%r) is not a valid id' % (name, value))
+
+
+def _type_check(*types):
+    names = ' or '.join(type_.__name__ for type_ in types)
+    # `bool` is an `int` but never a count or a time
+    exclude = () if bool in types else (bool, )
+
+    def check(name, value):
+        if not isinstance(value, types) or isinstance(value, exclude):
+            raise ValidationError('`%s` must be %s, not %s'
+                                  % (name, names, type(value).__name__))
+    return check
+
+
+def _list_check(check_item, maximum=None):
+    def check(name, value):
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError('`%s` must be a list, not %s'
+                                  % (name, type(value).__name__))
+        if maximum is not None and len(value) > maximum:
+            raise ValidationError('`%s` has %s items, the maximum is %s'
+                                  % (name, len(value), maximum))
+        for item in value:
+            check_item(name, item)
+    return check
+
+
+def _dict_check(check_value):
+    def check(name, value):
+        _check_dict(name, value)
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise ValidationError('`%s` keys must be str, not %s'
+                                      % (name, type(key).__name__))
+            check_value(name, item)
+    return check
+
+
+_check_str = _type_check(str)
+_check_int = _type_check(int)
+_check_number = _type_check(int, float)
+_check_bool = _type_check(bool)
+_check_dict = _type_check(dict)
+# Language code to text, e.g. `contents`
+_check_texts = _dict_check(_check_str)
+
+
+def _check_fields(fields, checks, required=()):
+    for name in required:
+        if fields.get(name) is None:
+            raise ValidationError('A required field is missing `%s`'
+                                  % name)
+    # Fields we don't know are the server's business
+    for name, value in fields.items():
+        check = checks.get(name)
+        if check is not None and value is not None:
+            check(name, value)
+
+
+def _check_purchase(name, value):
+    _check_dict(name, value)
+    for key, check in (('sku', _check_str), ('amount', _check_number),
+                       ('iso', _check_str)):
+        if key not in value:
+            raise ValidationError('A required field of `%s` is missing '
+                                  '`%s`' % (name, key))
+        check(key, value[key])
+
+
+_NOTIFICATION_FIELDS = {
+    'contents': _check_texts,
+    'headings': _check_texts,
+    'subtitle': _check_texts,
+    'template_id': _check_str,
+    'external_id': _check_str,
+    'include_player_ids': _list_check(_check_id, Client.MAX_RECIPIENTS),
+    'include_external_user_ids': _list_check(_check_str,
+                                             Client.MAX_RECIPIENTS),
+    'included_segments': _list_check(_check_str),
+    'excluded_segments': _list_check(_check_str),
+    'filters': _list_check(_check_dict),
+    'buttons': _list_check(_check_dict),
+    'data': _check_dict,
+    'url': _check_str,
+    'send_after': _check_str,
+    'delayed_option': _check_str,
+    'delivery_time_of_day': _check_str,
+    'ttl': _check_int,
+    'priority': _check_int,
+}
+_DEVICE_FIELDS = {
+    'device_type': _check_int,
+    'identifier': _check_str,
+    'external_user_id': _check_str,
+    'language': _check_str,
+    'country': _check_str,
+    'timezone': _check_int,
+    'game_version': _check_str,
+    'device_model': _check_str,
+    'device_os': _check_str,
+    'ad_id': _check_str,
+    'sdk': _check_str,
+    'session_count': _check_int,
+    'tags': _dict_check(_type_check(str, int, float)),
+    'amount_spent': _type_check(str, int, float),
+    'created_at': _check_int,
+    'last_active': _check_int,
+    'playtime': _check_int,
+    'badge_count': _check_int,
+    'notification_types': _check_int,
+    'test_type': _check_int,
+    'long': _check_number,
+    'lat': _check_number,
+}
+_PURCHASE_FIELDS = {
+    'purchases': _list_check(_check_purchase),
+    'existing': _check_bool,
+}
+_APP_FIELDS = {
+    'name': _check_str,
+    'site_name': _check_str,
+    'chrome_web_origin': _check_str,
+    'apns_env': _check_str,
+    'gcm_key': _check_str,
+}
+
+
+def _validate_notification(contents=None, template_id=None, **kwargs):
+    if not (contents or template_id):
+        raise ValidationError('A required field is missing `contents` or '
+                              '`template_id`')
+    if contents is not None and not isinstance(contents, str):
+        _check_texts('contents', contents)
+    if template_id:
+        _check_str('template_id', template_id)
+    _check_fields(kwargs, _NOTIFICATION_FIELDS)
+
+
+def _validate_session_length(device_id, active_time):
+    _check_id('device_id', device_id)
+    _check_int('active_time', active_time)
+    if active_time < 0:
+        raise ValidationError("`active_time`(%s) can't be negative"
+                              % active_time)
+
+
+def _validate_csv_export(last_active_since=None, segment_name=None,
+                         **kwargs):
+    if last_active_since is not None:
+        _check_number('last_active_since', last_active_since)
+    if segment_name is not None:
+        _check_str('segment_name', segment_name)
+
+
+def _fields_validator(checks, required=()):
+    def validate(**kwargs):
+        _check_fields(kwargs, checks, required)
+    return validate
+
+
+def _device_validator(checks):
+    def validate(device_id, **kwargs):
+        _check_id('device_id', device_id)
+        _check_fields(kwargs, checks)
+    return validate
+
+
+def _id_validator(name):
+    def validate(value):
+        _check_id(name, value)
+    return validate
+
+
+def _page_validator(maximum):
+    def validate(limit=None, offset=None):
+        if limit is not None:
+            _check_int('limit', limit)
+            if not 0 < limit <= maximum:
+                raise ValidationError('`limit`(%s) must be between 1 and %s'
+                                      % (limit, maximum))
+        if offset is not None:
+            _check_int('offset', offset)
+            if offset < 0:
+                raise ValidationError("`offset`(%s) can't be negative"
+                                      % offset)
+    return validate
+
+
+# The checks of every API method, built once. They take the method's
+# arguments
+_VALIDATORS = {
+    'create_notification': _validate_notification,
+    'send_notification_template': _fields_validator(_NOTIFICATION_FIELDS),
+    'cancel_notification': _id_validator('notification_id'),
+    'view_an_app': _id_validator('app_id'),
+    'create_an_app': _fields_validator(_APP_FIELDS, required=('name', )),
+    'update_an_app': _fields_validator(_APP_FIELDS),
+    'view_devices': _page_validator(Client.MAX_DEVICES_PAGE),
+    'view_device': _id_validator('device_id'),
+    'add_a_device': _fields_validator(_DEVICE_FIELDS,
+                                      required=('device_type', )),
+    'edit_device': _device_validator(_DEVICE_FIELDS),
+    'new_session': _device_validator(_DEVICE_FIELDS),
+    'new_purchase': _device_validator(_PURCHASE_FIELDS),
+    'increment_session_length': _validate_session_length,
+    'csv_export': _validate_csv_export,
+    'view_notification': _id_validator('notification_id'),
+    'view_notifications': _page_validator(Client.MAX_NOTIFICATIONS_PAGE),
+    'track_open': _id_validator('notification_id'),
+}
+
+
+def validate(method_name, *args, **kwargs):
+    """Check the arguments of a `Client` API method call, e.g.
+    `validate('edit_device', device_id, tags={...})`, without sending
+    it. Raises `ValidationError`, what `Client(validate=True)` raises
+    instead of sending an invalid call."""
+    if method_name not in _VALIDATORS:
+        raise ValueError('`%s` is not an API method that can be validated'
+                         % method_name)
+    try:
+        _VALIDATORS[method_name](*args, **kwargs)
+    except TypeError as exc:
+        # Missing or unexpected arguments, the call would fail too
+        message = str(exc).partition('() ')[2] or str(exc)
+        raise ValidationError('%s: %s' % (method_name, message)) from None
+
+
+def validate_calls(method_name, calls):
+    """Check a whole batch of calls up front, `calls` are the keyword
+    arguments of each. Returns the `(index, ValidationError)` of the
+    invalid ones."""
+    errors = []
+    for index, kwargs in enumerate(calls):
+        try:
+            validate(method_name, **kwargs)
+        except ValidationError as exc:
+            errors.append((index, exc))
+    return errors
+
+
+class TelemetryBatcher:
+    """Queue the device telemetry calls of `client` and send them in the
+    background.
+
+    Every call returns a `concurrent.futures.Future` of the response.
+    Redundant calls are coalesced while queued: `increment_session_length`
+    pings of a device are summed in one call and repeated `track_open`s
+    of a notification are sent once, sharing the future. Queued calls are
+    sent, up to `max_workers` at a time, every `flush_interval` seconds
+    or as soon as `max_batch` are queued. `close` sends what is left.
+    """
+
+    def __init__(self, client, flush_interval=1.0, max_batch=500,
+                 max_workers=8):
+        import concurrent.futures
+        self.client = client
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._ids = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def increment_session_length(self, device_id, active_time):
+        def merge(args, kwargs):
+            return (device_id, args[1] + active_time), kwargs
+        return self._enqueue(('increment_session_length', device_id),
+                             (device_id, active_time), {}, merge)
+
+    def new_session(self, device_id, **kwargs):
+        return self._enqueue(('new_session', next(self._ids)),
+                             (device_id, ), kwargs)
+
+    def new_purchase(self, device_id, **kwargs):
+        return self._enqueue(('new_purchase', next(self._ids)),
+                             (device_id, ), kwargs)
+
+    def track_open(self, notification_id):
+        def merge(args, kwargs):
+            return args, kwargs
+        return self._enqueue(('track_open', notification_id),
+                             (notification_id, ), {}, merge)
+
+    def _enqueue(self, key, args, kwargs, merge=None):
+        import concurrent.futures
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The batcher is closed')
+            entry = self._pending.get(key)
+            if entry is not None and merge is not None:
+                entry[1:3] = merge(entry[1], entry[2])
+                return entry[3]
+            future = concurrent.futures.Future()
+            self._pending[key] = [key[0], args, kwargs, future]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.max_batch:
+                self._condition.notify()
+            return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed and len(self._pending) < self.max_batch:
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def _call(self, method_name, args, kwargs, future):
+        try:
+            response = getattr(self.client, method_name)(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(response)
+
+    def flush(self):
+        """Send the queued calls now and wait for them"""
+        import concurrent.futures
+        with self._condition:
+            pending, self._pending = self._pending, collections.OrderedDict()
+        concurrent.futures.wait([self._executor.submit(self._call, *entry)
+                                 for entry in pending.values()])
+
+    def close(self):
+        """Send the queued calls and stop accepting new ones"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+        self._executor.shutdown()
+
+
+class _NotificationGroup:
+    # Calls of a `NotificationAggregator` sent as one notification
+    __slots__ = ('deadline', 'contents', 'template_id', 'kwargs', 'field',
+                 'recipients', 'futures')
+
+    def __init__(self, deadline, contents, template_id, kwargs,
+                 field=None):
+        self.deadline = deadline
+        self.contents = contents
+        self.template_id = template_id
+        self.kwargs = kwargs
+        self.field = field
+        # Ordered and without duplicates
+        self.recipients = {}
+        self.futures = []
+
+
+class NotificationAggregator:
+    """Merge the identical notifications sent through `create_notification`
+    within `window` seconds into one `client.create_notification` call.
+
+    Calls are identical when every argument but the recipients, one of
+    `recipient_fields`, is equal. Their recipients are merged, up to
+    `max_recipients` (`MAX_RECIPIENTS` by default) in a call, and every
+    caller gets a `concurrent.futures.Future` of the list of responses
+    of the requests it was sent in, one unless its recipients were over
+    `max_recipients`. Calls without recipients, e.g. to segments, are
+    sent as they are. `close` sends what is left.
+    """
+
+    def __init__(self, client, window=1.0, max_recipients=None,
+                 max_workers=4,
+                 recipient_fields=('include_player_ids',
+                                   'include_external_user_ids')):
+        import concurrent.futures
+        self.client = client
+        self.window = window
+        self.max_recipients = max_recipients or client.MAX_RECIPIENTS
+        self.recipient_fields = recipient_fields
+        self.calls = 0
+        self.requests = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        """Number of calls waiting to be sent"""
+        return sum(len(group.futures) for group in self._pending.values())
+
+    def create_notification(self, contents=None, template_id=None,
+                            **kwargs):
+        """Queue a notification, the arguments are those of
+        `Client.create_notification`. Returns a future of the list of
+        responses of the requests it is sent in."""
+        import concurrent.futures
+        # Fail now for the caller on invalid arguments
+        self.client._notification_data(contents, template_id, dict(kwargs))
+        fields = [field for field in self.recipient_fields
+                  if field in kwargs]
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The aggregator is closed')
+            self.calls += 1
+            if len(fields) != 1 or not kwargs[fields[0]]:
+                # Nothing to merge on
+                future = concurrent.futures.Future()
+                group = _NotificationGroup(None, contents, template_id,
+                                           kwargs)
+                group.futures.append(future)
+                self._submit(group)
+                return self._gather([future])
+            recipients = list(dict.fromkeys(kwargs.pop(fields[0])))
+            key = json.dumps([contents, template_id, kwargs, fields[0]],
+                             sort_keys=True, default=repr)
+            group = self._pending.get(key)
+            if (group is not None and len(group.recipients) + len(recipients)
+                    > self.max_recipients):
+                self._submit(self._pending.pop(key))
+                group = None
+            parts = []
+            for start in range(0, len(recipients), self.max_recipients):
+                if group is None:
+                    group = self._pending[key] = _NotificationGroup(
+                        time.monotonic() + self.window, contents,
+                        template_id, kwargs, fields[0])
+                    if self._thread is None:
+                        self._thread = threading.Thread(target=self._run,
+                                                        daemon=True)
+                        self._thread.start()
+                group.recipients.update(dict.fromkeys(
+                    recipients[start:start + self.max_recipients]))
+                parts.append(concurrent.futures.Future())
+                group.futures.append(parts[-1])
+                if len(group.recipients) >= self.max_recipients:
+                    self._submit(self._pending.pop(key))
+                    group = None
+        return self._gather(parts)
+
+    @staticmethod
+    def _gather(parts):
+        # A future of the responses of every part of a call, or of the
+        # first error
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        remaining = [len(parts)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [part.exception() for part in parts
+                      if part.exception() is not None]
+            if errors:
+                future.set_exception(errors[0])
+            else:
+                future.set_result([part.result() for part in parts])
+        for part in parts:
+            part.add_done_callback(done)
+        return future
+
+    def _submit(self, group):
+        self.requests += 1
+        self._executor.submit(self._send, group)
+
+    def _send(self, group):
+        kwargs = dict(group.kwargs)
+        if group.field is not None:
+            kwargs[group.field] = list(group.recipients)
+        try:
+            response = self.client.create_notification(
+                group.contents, group.template_id, **kwargs)
+        except BaseException as exc:
+            for future in group.futures:
+                future.set_exception(exc)
+        else:
+            for future in group.futures:
+                future.set_result(response)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed:
+                    deadline = min((group.deadline for group
+                                    in self._pending.values()),
+                                   default=time.monotonic() + self.window)
+                    self._condition.wait(max(deadline - time.monotonic(),
+                                             0))
+                closed = self._closed
+                now = time.monotonic()
+                for key, group in list(self._pending.items()):
+                    if closed or group.deadline <= now:
+                        self._submit(self._pending.pop(key))
+            if closed:
+                return
+
+    def flush(self):
+        """Send the queued calls now, without waiting for them"""
+        with self._condition:
+            while self._pending:
+                self._submit(self._pending.popitem(last=False)[1])
+
+    def close(self):
+        """Send the queued calls, wait for them and stop accepting new
+        ones"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+        self._executor.shutdown()
+
+
+class NotificationSpool:
+    """A durable queue of `create_notification` calls of `client` in the
+    SQLite database at `path`.
+
+    `enqueue` stores a notification with an `external_id` idempotency key
+    and returns the key, without waiting for the API. `drain` sends the
+    queued notifications, up to `max_workers` at a time, and `start` keeps
+    draining them in a background thread until `close`.
+
+    Delivery is at least once: a notification is removed once the API
+    accepts it. Those being sent are leased for `lease` seconds, if the
+    process dies they are sent again after that time, by this or any other
+    spool on the same file, and OneSignal drops the duplicates by their
+    `external_id`. Failures are retried as `retry_policy` says, those it
+    gives up on are kept and listed by `failures`.
+    """
+
+    def __init__(self, path, client, max_workers=4, lease=60,
+                 poll_interval=1.0, retry_policy=None):
+        import concurrent.futures
+        import sqlite3
+        self.client = client
+        self.max_workers = max_workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=10,
+                                                        max_backoff=300)
+        self._db = sqlite3.connect(path, isolation_level=None,
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS notifications ('
+                             'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'external_id TEXT NOT NULL, '
+                             'payload TEXT NOT NULL, '
+                             'attempts INTEGER NOT NULL DEFAULT 0, '
+                             'available_at REAL NOT NULL, '
+                             'failed INTEGER NOT NULL DEFAULT 0, '
+                             'status INTEGER, error TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS notifications_due '
+                             'ON notifications (failed, available_at)')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        """Number of notifications waiting to be sent"""
+        return self._execute('SELECT COUNT(*) FROM notifications '
+                             'WHERE failed = 0').fetchone()[0]
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters)
+
+    def enqueue(self, contents=None, template_id=None, **kwargs):
+        """Queue a notification, the arguments are the same as
+        `create_notification`'s. Returns its `external_id`."""
+        import uuid
+        data = self.client._notification_data(contents, template_id, kwargs)
+        data.setdefault('external_id', str(uuid.uuid4()))
+        self._execute('INSERT INTO notifications '
+                      '(external_id, payload, available_at) VALUES (?, ?, ?)',
+                      (data['external_id'], json.dumps(data), time.time()))
+        self._wake.set()
+        return data['external_id']
+
+    def failures(self):
+        """`(payload, status, error)` of the notifications given up on"""
+        rows = self._execute('SELECT payload, status, error '
+                             'FROM notifications WHERE failed = 1 '
+                             'ORDER BY id').fetchall()
+        return [(json.loads(payload), status, error)
+                for payload, status, error in rows]
+
+    def _claim(self, limit):
+        # Lease the due notifications so no other worker sends them
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute(
+                    'SELECT id, payload, attempts FROM notifications '
+                    'WHERE failed = 0 AND available_at <= ? '
+                    'ORDER BY id LIMIT ?', (now, limit)).fetchall()
+                self._db.executemany(
+                    'UPDATE notifications SET available_at = ?, '
+                    'attempts = attempts + 1 WHERE id = ?',
+                    [(now + self.lease, row[0]) for row in rows])
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        return rows
+
+    def _send(self, row):
+        (row_id, payload, attempts) = row
+        response = error = None
+        try:
+            response = self.client._make_request(
+                'notifications', 'post', data=json.loads(payload),
+                auth='app', idempotent=True, endpoint='create_notification')
+        except self.client._transient_errors() as exc:
+            error = exc
+        except (CircuitOpenError, LoadShedError) as exc:
+            error = exc
+        except Exception as exc:
+            self._execute('UPDATE notifications SET failed = 1, error = ? '
+                          'WHERE id = ?', (repr(exc), row_id))
+            return False
+        if response is not None and response.ok:
+            self._execute('DELETE FROM notifications WHERE id = ?',
+                          (row_id, ))
+            return True
+        status = None if response is None else _status(response)
+        error = None if error is None else repr(error)
+        delay = self.retry_policy.delay(attempts, time.monotonic(), response)
+        if delay is None:
+            self._execute('UPDATE notifications SET failed = 1, status = ?, '
+                          'error = ? WHERE id = ?', (status, error, row_id))
+        else:
+            self._execute('UPDATE notifications SET available_at = ?, '
+                          'status = ?, error = ? WHERE id = ?',
+                          (time.time() + delay, status, error, row_id))
+        return False
+
+    def drain(self):
+        """Send the due notifications now and wait for them. Returns the
+        number of notifications sent."""
+        sent = 0
+        while not self._closed:
+            rows = self._claim(self.max_workers * 4)
+            if not rows:
+                break
+            sent += sum(self._executor.map(self._send, rows))
+        return sent
+
+    def _run(self):
+        while not self._closed:
+            self._wake.clear()
+            self.drain()
+            self._wake.wait(self.poll_interval)
+
+    def start(self):
+        """Keep sending the notifications in a background thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop sending, wait for the notifications being sent. The queued
+        ones are sent by the next spool opened on the file."""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown()
+        self._db.close()
+
+
+def _timestamp(value):
+    # Unix time of an API time, a number or a UTC date as in exports
+    if value is None or value == '':
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    import datetime
+    date = datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+class DeviceMirror:
+    """A local copy of the devices of `client`'s app in the SQLite
+    database at `path`, indexed by tag and `last_active`.
+
+    The first `sync` loads every device with a `csv_export`, the next
+    ones only the devices active since the last sync, minus `overlap`
+    seconds to allow for clock skew. Changes to devices that were not
+    active, and deleted devices, are only seen by a `full` sync, which
+    replaces the copy once the whole export was read.
+    """
+
+    def __init__(self, path, client, overlap=3600, poll_interval=5,
+                 timeout=600):
+        import sqlite3
+        self.client = client
+        self.overlap = overlap
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS devices ('
+                             'id TEXT PRIMARY KEY, last_active INTEGER, '
+                             'data TEXT NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS devices_active '
+                             'ON devices (last_active)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS tags ('
+                             'device_id TEXT, key TEXT, value TEXT, '
+                             'PRIMARY KEY (device_id, key)) WITHOUT ROWID')
+            self._db.execute('CREATE INDEX IF NOT EXISTS tags_value '
+                             'ON tags (key, value)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS sync ('
+                             'id INTEGER PRIMARY KEY, synced_at REAL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM devices')[0][0]
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    @property
+    def synced_at(self):
+        """Unix time of the last sync, None before the first one"""
+        rows = self._query('SELECT synced_at FROM sync WHERE id = 1')
+        return rows[0][0] if rows else None
+
+    def sync(self, full=False, batch_size=1000):
+        """Update the copy, returns the number of devices written"""
+        started = time.time()
+        since = self.synced_at
+        kwargs = {}
+        if not full and since is not None:
+            kwargs['last_active_since'] = since - self.overlap
+        rows = self.client.iter_csv_export(self.poll_interval,
+                                           self.timeout, **kwargs)
+        tables = ('devices', 'tags')
+        if full:
+            # Loaded aside and swapped in once the whole export was read,
+            # a failed sync leaves the copy as it was
+            tables = ('staged_devices', 'staged_tags')
+            self._stage()
+        written = 0
+        try:
+            for batch in _chunks(rows, batch_size):
+                self._write(batch, *tables)
+                written += len(batch)
+            with self._lock, self._db:
+                if full:
+                    self._db.execute('DELETE FROM devices')
+                    self._db.execute('DELETE FROM tags')
+                    self._db.execute('INSERT INTO devices '
+                                     'SELECT * FROM staged_devices')
+                    self._db.execute('INSERT INTO tags '
+                                     'SELECT * FROM staged_tags')
+                self._db.execute('INSERT OR REPLACE INTO sync '
+                                 '(id, synced_at) VALUES (1, ?)',
+                                 (started, ))
+        finally:
+            if full:
+                self._stage(create=False)
+        return written
+
+    def _stage(self, create=True):
+        # The tables of a full sync, private to the connection
+        with self._lock, self._db:
+            self._db.execute('DROP TABLE IF EXISTS temp.staged_devices')
+            self._db.execute('DROP TABLE IF EXISTS temp.staged_tags')
+            if create:
+                self._db.execute('CREATE TEMP TABLE staged_devices ('
+                                 'id TEXT PRIMARY KEY, '
+                                 'last_active INTEGER, data TEXT NOT NULL)')
+                self._db.execute('CREATE TEMP TABLE staged_tags ('
+                                 'device_id TEXT, key TEXT, value TEXT, '
+                                 'PRIMARY KEY (device_id, key)) '
+                                 'WITHOUT ROWID')
+
+    def _write(self, rows, devices_table='devices', tags_table='tags'):
+        devices = []
+        tags = []
+        for row in rows:
+            device = dict(row)
+            device_tags = device.get('tags') or {}
+            if isinstance(device_tags, str):
+                device_tags = json.loads(device_tags)
+            device['tags'] = device_tags
+            device['last_active'] = _timestamp(device.get('last_active'))
+            devices.append((device['id'], device['last_active'],
+                            json.dumps(device)))
+            tags.extend((device['id'], key, str(value))
+                        for key, value in device_tags.items())
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM %s WHERE device_id = ?'
+                                 % tags_table,
+                                 [device[:1] for device in devices])
+            self._db.executemany('INSERT OR REPLACE INTO %s '
+                                 '(id, last_active, data) VALUES (?, ?, ?)'
+                                 % devices_table, devices)
+            self._db.executemany('INSERT INTO %s (device_id, key, value) '
+                                 'VALUES (?, ?, ?)' % tags_table, tags)
+
+    def _where(self, tags, active_since):
+        conditions = []
+        parameters = []
+        for key, value in (tags or {}).items():
+            if value is None:
+                conditions.append('id IN (SELECT device_id FROM tags '
+                                  'WHERE key = ?)')
+                parameters.append(key)
+            else:
+                conditions.append('id IN (SELECT device_id FROM tags '
+                                  'WHERE key = ? AND value = ?)')
+                parameters.extend((key, str(value)))
+        if active_since is not None:
+            conditions.append('last_active >= ?')
+            parameters.append(active_since)
+        if not conditions:
+            return '', parameters
+        return ' WHERE ' + ' AND '.join(conditions), parameters
+
+    def get(self, device_id):
+        """The device `device_id`, or None"""
+        rows = self._query('SELECT data FROM devices WHERE id = ?',
+                           (device_id, ))
+        return json.loads(rows[0][0]) if rows else None
+
+    def devices(self, tags=None, active_since=None, limit=None):
+        """The devices with `tags`, a None value matching any value of
+        the key, and active since the Unix time `active_since`"""
+        where, parameters = self._where(tags, active_since)
+        sql = 'SELECT data FROM devices' + where + ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return [json.loads(row[0]) for row in self._query(sql, parameters)]
+
+    def count(self, tags=None, active_since=None):
+        """Number of `devices` matching"""
+        where, parameters = self._where(tags, active_since)
+        return self._query('SELECT COUNT(*) FROM devices' + where,
+                           parameters)[0][0]
+
+    def close(self):
+        self._db.close()
+
+
+def _finished(notification):
+    return bool(notification.get('canceled')
+                or notification.get('completed_at'))
+
+
+class NotificationPoller:
+    """Track the delivery of notifications of `client`, calling
+    `callback(notification_id, notification, previous)` when a
+    notification changes.
+
+    Every notification is polled at its own interval: `min_interval`
+    seconds while it is being sent, doubling up to `max_interval` while
+    it doesn't change and `max_interval` once completed or cancelled.
+    Up to `max_workers` notifications are fetched at a time, and when
+    `page_threshold` or more are due the latest `max_pages` pages of
+    `view_notifications` are read first, refreshing many in each
+    request.
+    """
+
+    def __init__(self, client, callback=None, min_interval=5,
+                 max_interval=300, max_workers=8, page_threshold=20,
+                 max_pages=4):
+        import concurrent.futures
+        self.client = client
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.page_threshold = page_threshold
+        self.max_pages = max_pages
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        # id: [interval, due time, last notification]
+        self._tracked = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def __contains__(self, notification_id):
+        return notification_id in self._tracked
+
+    def track(self, *notification_ids):
+        """Start polling the notifications, they are due right away"""
+        with self._lock:
+            for notification_id in notification_ids:
+                self._tracked.setdefault(notification_id,
+                                         [self.min_interval, 0, None])
+        self._wake.set()
+
+    def untrack(self, *notification_ids):
+        with self._lock:
+            for notification_id in notification_ids:
+                self._tracked.pop(notification_id, None)
+
+    def status(self, notification_id):
+        """The last fetched notification, None before the first poll"""
+        return self._tracked[notification_id][2]
+
+    def _fetch(self, notification_id):
+        try:
+            response = self.client.view_notification(notification_id)
+        except Exception:
+            return None
+        return response.json() if response.ok else None
+
+    def _fetch_pages(self, notification_ids):
+        found = {}
+        page_size = self.client.MAX_NOTIFICATIONS_PAGE
+        for page in range(self.max_pages):
+            try:
+                response = self.client.view_notifications(
+                    limit=page_size, offset=page * page_size)
+            except Exception:
+                break
+            if not response.ok:
+                break
+            notifications = response.json().get('notifications') or []
+            for notification in notifications:
+                if notification.get('id') in notification_ids:
+                    found[notification['id']] = notification
+            if (len(found) == len(notification_ids)
+                    or len(notifications) < page_size):
+                break
+        return found
+
+    def poll(self):
+        """Fetch the notifications due now. Returns the changes, a list
+        of `(notification_id, notification, previous)`."""
+        now = time.monotonic()
+        with self._lock:
+            due = [notification_id for notification_id, state
+                   in self._tracked.items() if state[1] <= now]
+        if not due:
+            return []
+        fetched = {}
+        if self.page_threshold is not None and len(due) >= self.page_threshold:
+            fetched = self._fetch_pages(set(due))
+        missing = [notification_id for notification_id in due
+                   if notification_id not in fetched]
+        fetched.update(zip(missing, self._executor.map(self._fetch,
+                                                       missing)))
+
+        changes = []
+        now = time.monotonic()
+        with self._lock:
+            for notification_id in due:
+                state = self._tracked.get(notification_id)
+                if state is None:
+                    continue
+                (interval, _, previous) = state
+                notification = fetched[notification_id]
+                if notification is None:
+                    interval = min(interval * 2, self.max_interval)
+                elif _finished(notification):
+                    interval = self.max_interval
+                elif (notification.get('remaining')
+                      or notification != previous):
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 2, self.max_interval)
+                if notification is not None and notification != previous:
+                    state[2] = notification
+                    changes.append((notification_id, notification,
+                                    previous))
+                state[0:2] = [interval, now + interval]
+        if self.callback is not None:
+            for change in changes:
+                self.callback(*change)
+        return changes
+
+    def _run(self):
+        while not self._closed:
+            self._wake.clear()
+            self.poll()
+            with self._lock:
+                due = min((state[1] for state in self._tracked.values()),
+                          default=time.monotonic() + self.max_interval)
+            self._wake.wait(max(due - time.monotonic(), 0))
+
+    def start(self):
+        """Keep polling in a background thread, the callback is called
+        from it"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown()
+
+
+class AsyncClient(Client):
+    """Same API methods as `Client` but they return coroutines.
+
+    Requests go through an `AiohttpTransport` by default, which needs the
+    optional dependency, `pip install yaosac[async]`.
+    """
+
+    def __enter__(self):
+        # `close` is a coroutine, `with` could not wait for it
+        raise TypeError("Use 'async with' with an AsyncClient")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _default_transport(self):
+        return AiohttpTransport(self.pool_connections, self.pool_maxsize)
+
+    async def close(self):
+        """Close the pooled connections. The client can still be used,
+        a new pool is created on the next request."""
+        if self._transport is not None:
+            await self._transport.close()
+
+    def _single_flight(self):
+        return _AsyncSingleFlight()
+
+    async def _make_request(self, url, method_name, data=None, auth=None,
+                            idempotent=None, endpoint=None, body=None):
+        request = RequestInfo(url, method_name, data, auth, idempotent,
+                              endpoint, body, self._scope(auth))
+        (request.timeout, request.deadline) = self._limits()
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return await self._dispatch(request)
+        instrumentation._start(request)
+        try:
+            response = await self._dispatch(request)
+        except Exception as exc:
+            instrumentation._finish(request, error=exc)
+            raise
+        instrumentation._finish(request, response)
+        return response
+
+    async def _dispatch(self, request):
+        cache = self.cache
+        if request.method != 'get':
+            response = await self._request(request)
+            if cache is not None:
+                cache.invalidate(request.url)
+            return response
+        if cache is not None:
+            response = cache.get(request.endpoint, request.scope, request.url)
+            if response is not None:
+                request.cached = True
+                return response
+        if self._in_flight is None:
+            response = await self._request(request)
+        else:
+            response = await self._in_flight.do(
+                (request.scope, request.url), self._request, request)
+        if cache is not None and response.ok:
+            cache.set(request.endpoint, request.scope, request.url,
+                      response)
+        return response
+
+    async def _request(self, request):
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return await self._retry(request)
+        started = breaker._admit(request.endpoint)
+        try:
+            response = await self._retry(request)
+        except Exception as exc:
+            breaker._record(request.endpoint, started, error=exc)
+            raise
+        except BaseException:
+            breaker._record(request.endpoint, started)
+            raise
+        breaker._record(request.endpoint, started, response)
+        return response
+
+    async def _retry(self, request):
+        import asyncio
+        request.full_url = self.OS_URL + request.url
+        request.headers = self._get_headers(request.auth)
+        self._compress(request)
+
+        policy = self.retry_policy
+        if policy is None or not policy.allows(request.method,
+                                               request.idempotent):
+            return await self._attempt(request)
+        started = time.monotonic()
+        while True:
+            try:
+                response = await self._attempt(request)
+            except self._transient_errors():
+                delay = policy.delay(request.retries, started)
+                if delay is None or not _within_deadline(request, delay):
+                    raise
+            else:
+                delay = policy.delay(request.retries, started, response)
+                if delay is None or not _within_deadline(request, delay):
+                    return response
+            await asyncio.sleep(delay)
+            request.retries += 1
+
+    async def _attempt(self, request):
+        import asyncio
+        hedge_policy = self.hedge_policy
+        if hedge_policy is None or not hedge_policy.allows(request):
+            return await self._send(request)
+        started = time.monotonic()
+        attempts = {asyncio.ensure_future(self._send(request))}
+        try:
+            done, attempts = await asyncio.wait(
+                attempts, timeout=hedge_policy.delay(request.endpoint))
+            if not done:
+                hedge_policy.hedges += 1
+                attempts.add(asyncio.ensure_future(self._send(request)))
+            while not done:
+                # The first answer, or the last error
+                done, attempts = await asyncio.wait(
+                    attempts, return_when=asyncio.FIRST_COMPLETED)
+                done = ([task for task in done if task.exception() is None]
+                        or (not attempts and list(done)))
+        finally:
+            for task in attempts:
+                task.cancel()
+        hedge_policy.record(request.endpoint, time.monotonic() - started)
+        return list(done)[0].result()
+
+    async def _send(self, request):
+        _attempt_timeout(request)
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(request.scope,
+                                                  request.deadline)
+        response = None
+        try:
+            timeout = _attempt_timeout(request)
+            response = await self.transport.request(
+                request.method, request.full_url, request.headers,
+                request.data, request.body, timeout)
+        except self._transient_errors() as exc:
+            _raise_past_deadline(request, exc)
+            raise
+        finally:
+            if self.rate_limiter is not None:
+                self.rate_limiter.release(request.scope, response)
+        return response
+
+    async def create_notifications_bulk(self, recipients, contents=None,
+                                        template_id=None,
+                                        recipient_field='include_player_ids',
+                                        batch_size=None, max_workers=4,
+                                        **kwargs):
+        """Coroutine version of `Client.create_notifications_bulk`,
+        `max_workers` is the number of batches in flight."""
+        import asyncio
+        external_id = kwargs.pop('external_id', None)
+        template = self.compile_notification(contents, template_id,
+                                             **kwargs)
+        batches = _chunks(recipients, batch_size or self.MAX_RECIPIENTS)
+        result = BulkResult()
+        pending = {}
+
+        async def send(batch, index):
+            return await self.send_notification_template(
+                template, **_batch_fields(recipient_field, batch, index,
+                                          external_id))
+
+        for index, batch in enumerate(batches):
+            if len(pending) >= max_workers:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result._add(*pending.pop(task), task)
+            pending[asyncio.ensure_future(send(batch, index))] = (index,
+                                                                  batch)
+        if pending:
+            await asyncio.wait(pending)
+            for task in pending:
+                result._add(*pending[task], task)
+        return result._sort()
+
+    async def device_table(self, page_size=None, prefetch=True,
+                           max_workers=1, fields=('language', )):
+        """Coroutine version of `Client.device_table`"""
+        table = DeviceTable(fields=fields)
+        async for device in self.iter_devices(page_size, prefetch,
+                                              max_workers):
+            table.append(device)
+        return table
+
+    async def iter_csv_export(self, poll_interval=5, timeout=600,
+                              **kwargs):
+        """Asynchronous generator version of `Client.iter_csv_export`,
+        use it with `async for`. The export is downloaded to a temporary
+        file first, then parsed from it."""
+        import csv
+        import gzip
+        import tempfile
+        with tempfile.TemporaryFile() as temporary:
+            download = await self._download_csv_export(poll_interval,
+                                                       timeout, kwargs)
+            try:
+                async for chunk in download.content.iter_chunked(64 * 1024):
+                    temporary.write(chunk)
+            finally:
+                download.release()
+            temporary.seek(0)
+            with gzip.GzipFile(fileobj=temporary) as source:
+                text = io.TextIOWrapper(source, encoding='utf-8',
+                                        newline='')
+                for row in csv.DictReader(text):
+                    yield row
+
+    async def download_csv_export(self, path, poll_interval=5,
+                                  timeout=600, decompress=False,
+                                  chunk_size=64 * 1024, **kwargs):
+        """Coroutine version of `Client.download_csv_export`"""
+        import zlib
+        # The export is gzipped
+        decompressor = zlib.decompressobj(wbits=31) if decompress else None
+        download = await self._download_csv_export(poll_interval, timeout,
+                                                   kwargs)
+        try:
+            with open(path, 'wb') as destination:
+                async for chunk in download.content.iter_chunked(chunk_size):
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    destination.write(chunk)
+                if decompressor is not None:
+                    destination.write(decompressor.flush())
+        finally:
+            download.release()
+        return path
+
+    async def _download_csv_export(self, poll_interval, timeout, kwargs):
+        import asyncio
+        response = await self.csv_export(**kwargs)
+        response.raise_for_status()
+        url = (await response.json())['csv_file_url']
+        deadline = time.monotonic() + timeout
+        request = self._stream_request(url)
+        # The file is not there until the export finishes
+        while True:
+            download = await self.transport.stream(
+                url, _attempt_timeout(request))
+            if download.status not in (403, 404):
+                try:
+                    download.raise_for_status()
+                except BaseException:
+                    download.release()
+                    raise
+                return download
+            download.release()
+            if time.monotonic() + poll_interval >= deadline:
+                raise TimeoutError('The export %s was not ready after %s '
+                                   'seconds' % (url, timeout))
+            await asyncio.sleep(poll_interval)
+
+    async def _iter_pages(self, view, key, page_size, prefetch,
+                          max_workers):
+        """Asynchronous generator version of `Client._iter_pages`, use
+        it with `async for`."""
+        import asyncio
+        async def fetch(offset):
+            response = await view(limit=page_size, offset=offset)
+            response.raise_for_status()
+            return await response.json()
+
+        items = await fetch(0)
+        total = items.get('total_count')
+        items = items[key]
+        if total is None:
+            offsets = itertools.count(page_size, page_size)
+        else:
+            offsets = iter(range(page_size, total, page_size))
+        if not prefetch:
+            max_workers = 0
+
+        window = collections.deque()
+        try:
+            while True:
+                while len(window) < max_workers:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    window.append(asyncio.ensure_future(fetch(offset)))
+                for item in items:
+                    yield item
+                if not items or (total is None and len(items) < page_size):
+                    return
+                if window:
+                    items = (await window.popleft())[key]
+                else:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        return
+                    items = (await fetch(offset))[key]
+        finally:
+            for task in window:
+                task.cancel()
+
+
+class MultiAppClient:
+    """Routes the API calls of many apps to their own credentials.
+
+    `apps` maps app ids to their App Auth Keys, or is a callable returning
+    the key of an app id (`None` when it's unknown) for registries loaded
+    on demand. The clients `app` returns share one transport, rate
+    limiter, cache and instrumentation, and can be used from any thread;
+    app requests are rate limited per app. The other arguments are those
+    of `client_class`, `Client` by default.
+    """
+
+    def __init__(self, apps=None, user_auth_key=None, client_class=None,
+                 **kwargs):
+        self.client_class = client_class or Client
+        self._base = self.client_class(**kwargs)
+        if user_auth_key is not None:
+            self._base.user_auth_key = user_auth_key
+        if callable(apps):
+            self._load_key = apps
+            apps = None
+        else:
+            self._load_key = None
+        self._keys = dict(apps or {})
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if issubclass(self.client_class, AsyncClient):
+            raise TypeError("Use 'async with' with AsyncClient apps")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __contains__(self, app_id):
+        return app_id in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def transport(self):
+        """The transport every app shares"""
+        return self._base.transport
+
+    def close(self):
+        """Close the shared pooled connections, a coroutine when
+        `client_class` is `AsyncClient`."""
+        return self._base.close()
+
+    def register(self, app_id, app_auth_key):
+        """Add an app, or replace the key of a registered one"""
+        with self._lock:
+            self._keys[app_id] = app_auth_key
+            self._clients.pop(app_id, None)
+
+    def unregister(self, app_id):
+        with self._lock:
+            self._keys.pop(app_id, None)
+            self._clients.pop(app_id, None)
+
+    def app(self, app_id):
+        """The client of the app `app_id`"""
+        client = self._clients.get(app_id)
+        if client is not None:
+            return client
+        app_auth_key = self._keys.get(app_id)
+        if app_auth_key is None and self._load_key is not None:
+            # Outside of the lock, loading a key may be slow
+            app_auth_key = self._load_key(app_id)
+        if app_auth_key is None:
+            raise ImproperlyConfigured("Unknown app '%s'." % app_id)
+        with self._lock:
+            client = self._clients.get(app_id)
+            if client is None:
+                self._keys.setdefault(app_id, app_auth_key)
+                client = self._clients[app_id] = self._create_client(
+                    app_id, self._keys[app_id])
+        return client
+
+    def _create_client(self, app_id, app_auth_key):
+        # Create the transport first so every copy shares it
+        self._base.transport
+        client = copy.copy(self._base)
+        client.app_id = app_id
+        client.app_auth_key = app_auth_key
+        client._tenant = app_id
+        return client
 
 
 client = Client()
+
+
+def _record_call(command, record):
+    # The API method and keyword arguments of a record
+    if command == 'devices':
+        record = dict(record)
+        record['device_id'] = record.pop('id', None)
+        return ('edit_device', record)
+    return ('create_notification', record)
+
+
+def _call_record(client, command, record):
+    method_name, kwargs = _record_call(command, record)
+    return getattr(client, method_name)(**kwargs)
+
+
+def _check_records(command, source, offset, stream):
+    # Returns how many records after `offset` are invalid
+    invalid = 0
+    for index, line in enumerate(source):
+        if index < offset or not line.strip():
+            continue
+        try:
+            method_name, kwargs = _record_call(command, json.loads(line))
+            validate(method_name, **kwargs)
+        except (ValueError, TypeError) as exc:
+            invalid += 1
+            stream.write('record %s: %s\n' % (index, exc))
+    return invalid
+
+
+class _RecordJob:
+    # Outcomes of the records of a `main` run
+
+    def __init__(self, offset, results=None, failures=None, checkpoint=None):
+        # Every record before `offset` is done, it's where to resume
+        self.offset = offset
+        self.sent = 0
+        self.failed = 0
+        self.results = results
+        self.failures = failures
+        self.checkpoint = checkpoint
+        self._done = set()
+
+    def finish(self, index, line, response=None, error=None):
+        ok = response is not None and response.ok
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+            if self.failures is not None:
+                self.failures.write(line.rstrip('\n') + '\n')
+        if self.results is not None:
+            outcome = {'record': index, 'ok': ok, 'error': error}
+            if response is not None:
+                outcome['status'] = _status(response)
+                try:
+                    outcome['body'] = response.json()
+                except ValueError:
+                    outcome['body'] = response.text
+            self.results.write(json.dumps(outcome) + '\n')
+        self.skip(index)
+
+    def skip(self, index):
+        self._done.add(index)
+        while self.offset in self._done:
+            self._done.remove(self.offset)
+            self.offset += 1
+
+    def report(self, stream, started):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        stream.write('%s sent, %s failed, %.1f records/s, resume offset %s\n'
+                     % (self.sent, self.failed,
+                        (self.sent + self.failed) / elapsed, self.offset))
+        stream.flush()
+        for output in (self.results, self.failures):
+            if output is not None:
+                output.flush()
+        if self.checkpoint is not None:
+            with open(self.checkpoint + '.tmp', 'w') as checkpoint:
+                checkpoint.write(str(self.offset))
+            os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+
+def main(argv=None, client=None):
+    """`python -m yaosac`, streams the JSONL records of a file into API
+    calls. Returns the exit status, 1 when a record failed and 2 when
+    `--check` found invalid records."""
+    import argparse
+    import concurrent.futures
+    import sys
+    parser = argparse.ArgumentParser(
+        prog='yaosac', description='Send a JSONL file of records, '
+        'create_notification arguments or edit_device arguments with the '
+        'device `id`, to OneSignal. The credentials are read from the '
+        'OS_APP_ID and OS_APP_AUTH_KEY environment variables.')
+    parser.add_argument('command', choices=('notifications', 'devices'))
+    parser.add_argument('input', nargs='?', default='-',
+                        help='JSONL file, the standard input by default')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='concurrent requests')
+    parser.add_argument('--rate', type=float,
+                        help='maximum requests per second')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries of transient errors')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='skip this many records')
+    parser.add_argument('--checkpoint',
+                        help='file keeping the offset to resume from, '
+                        'read on start and updated on every report')
+    parser.add_argument('--results',
+                        help='append the outcome of every record here')
+    parser.add_argument('--failures',
+                        help='append the records that failed here')
+    parser.add_argument('--progress', type=float, default=5,
+                        help='seconds between progress reports')
+    parser.add_argument('--check', action='store_true',
+                        help='validate every record before sending any, '
+                        'nothing is sent when one is invalid')
+    args = parser.parse_args(argv)
+    if args.check and args.input == '-':
+        parser.error('--check needs an input file, it is read twice')
+
+    offset = args.offset
+    if args.checkpoint is not None and os.path.exists(args.checkpoint):
+        with open(args.checkpoint) as checkpoint:
+            offset = max(offset, int(checkpoint.read() or 0))
+    if args.check:
+        with open(args.input) as source:
+            invalid = _check_records(args.command, source, offset,
+                                     sys.stderr)
+        if invalid:
+            sys.stderr.write('%s invalid records, nothing sent\n' % invalid)
+            return 2
+    own_client = client is None
+    if own_client:
+        rate_limiter = None
+        if args.rate:
+            rate_limiter = RateLimiter(args.rate,
+                                       max_concurrency=args.workers)
+        # Invalid records fail without a request
+        client = Client(pool_maxsize=args.workers, rate_limiter=rate_limiter,
+                        retry_policy=RetryPolicy(max_retries=args.retries),
+                        validate=True)
+
+    def open_output(path):
+        return None if path is None else open(path, 'a')
+    source = sys.stdin if args.input == '-' else open(args.input)
+    job = _RecordJob(offset, open_output(args.results),
+                     open_output(args.failures), args.checkpoint)
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            (index, line) = pending.pop(future)
+            try:
+                response = future.result()
+            except Exception as exc:
+                job.finish(index, line, error=repr(exc))
+            else:
+                job.finish(index, line, response)
+
+    started = reported = time.monotonic()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+            for index, line in enumerate(source):
+                if index < offset:
+                    continue
+                try:
+                    record = json.loads(line) if line.strip() else None
+                except ValueError as exc:
+                    job.finish(index, line, error=repr(exc))
+                    continue
+                if record is None:
+                    job.skip(index)
+                    continue
+                # Keep a bounded number of records in memory
+                if len(pending) >= args.workers * 2:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(_call_record, client, args.command,
+                                         record)
+                pending[future] = (index, line)
+                if time.monotonic() - reported >= args.progress:
+                    job.report(sys.stderr, started)
+                    reported = time.monotonic()
+            collect(list(concurrent.futures.as_completed(pending)))
+        job.report(sys.stderr, started)
+    finally:
+        for stream in (source, job.results, job.failures):
+            if stream is not None and stream is not sys.stdin:
+                stream.close()
+        if own_client:
+            client.close()
+    return 1 if job.failed else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())